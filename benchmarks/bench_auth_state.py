@@ -0,0 +1,108 @@
+"""Compares the size and decoding time of the auth_state formats
+
+auth_state is stored encrypted in the database (Fernet, as JupyterHub's
+CryptKeeper) and decrypted and deserialized on every get_auth_state(). This
+measures the encrypted blob size and the time to decrypt, deserialize and
+get the server options out of it for the version 1 format (whole xmltodict
+document) and the compact version 2 format.
+
+Usage: python benchmarks/bench_auth_state.py [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import xmltodict
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from d4science_hub import auth_state  # noqa: E402
+from d4science_hub.catalog import ResourceCatalog  # noqa: E402
+from d4science_hub.registry import parse  # noqa: E402
+from d4science_hub.spawner import D4ScienceSpawner  # noqa: E402
+from synthetic import generic_resources  # noqa: E402
+
+SIZES = (10, 100, 1000, 10000)
+ROLES = ["Data-Manager"]
+
+
+def permissions(n_options):
+    return [
+        {"rsid": f"id-{i}", "rsname": f"option-{i}", "scopes": ["access"]}
+        for i in range(0, n_options, 2)
+    ]
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+async def measure(spawner, fernet, state, repeat):
+    blob = fernet.encrypt(json.dumps(state).encode("utf8"))
+
+    def decode():
+        decoded = json.loads(fernet.decrypt(blob).decode("utf8"))
+        catalog = auth_state.load_catalog(decoded)
+        if catalog is None:
+            spawner.build_resource_options(ROLES, decoded["resources"])
+
+    return {"blob_bytes": len(blob), "decode_seconds": timeit(decode, repeat)}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    spawner = D4ScienceSpawner(_mock=True)
+    fernet = Fernet(Fernet.generate_key())
+    results = []
+    print(
+        "%8s %12s %12s %12s %12s"
+        % ("options", "v1 KiB", "v2 KiB", "v1 decode s", "v2 decode s")
+    )
+    for size in SIZES:
+        document = generic_resources(size)
+        perms = permissions(size)
+        old = {
+            "permissions": perms,
+            "roles": ROLES,
+            "resources": xmltodict.parse(document),
+        }
+        resources = parse(document)
+        catalog = ResourceCatalog(resources.server_options, resources.volume_options)
+        new = auth_state.pack(perms, ROLES, catalog)
+        repeat = args.repeat if size < 10000 else 1
+        v1 = await measure(spawner, fernet, old, repeat)
+        v2 = await measure(spawner, fernet, new, repeat)
+        results.append({"options": size, "v1": v1, "v2": v2})
+        print(
+            "%8d %12d %12d %12.4f %12.4f"
+            % (
+                size,
+                v1["blob_bytes"] // 1024,
+                v2["blob_bytes"] // 1024,
+                v1["decode_seconds"],
+                v2["decode_seconds"],
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "auth_state", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,211 @@
+"""GPU spawns with and without the admission queue
+
+A pool of --gpus GPUs (a fake Kubernetes API) gets a burst of --burst
+spawns from one context plus --spawns spawns spread over --contexts other
+contexts arriving every --interval seconds. Servers run for --session
+seconds (exponentially distributed) and spawns fail after --start-timeout:
+
+- pending: the pods are created right away and wait in Pending for a GPU
+  (scheduled in creation order) until the start timeout
+- queue: spawns wait in the GpuAdmission queue (refreshed every
+  --refresh seconds and whenever a server stops) and create their pod once
+  admitted
+
+Reports the spawns that started or failed, the peak of pods in Pending and
+the median wait of the spawns of the bursting context and of the others.
+Times are scaled by --scale to run quickly.
+
+Usage: python benchmarks/bench_gpu_admission.py [--gpus 4] [--burst 20]
+           [--spawns 20] [--contexts 5] [--interval 10] [--session 60]
+           [--start-timeout 300] [--refresh 10] [--scale 0.002] [--seed 0]
+           [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from d4science_hub import admission  # noqa: E402
+
+RESOURCE = "nvidia.com/gpu"
+
+
+class FakeCluster:
+    """Nodes with GPUs and the pods using them, with a FIFO scheduler"""
+
+    def __init__(self, gpus):
+        self.gpus = gpus
+        self.pods = {}
+        self.pending = []
+        self.peak_pending = 0
+        self.api_client = SimpleNamespace(sanitize_for_serialization=lambda o: o)
+
+    def free(self):
+        return self.gpus - sum(
+            1 for pod in self.pods.values() if pod["spec"].get("nodeName")
+        )
+
+    def schedule(self):
+        while self.pending and self.free() > 0:
+            name, scheduled = self.pending.pop(0)
+            self.pods[name]["spec"]["nodeName"] = "gpu-1"
+            scheduled.set()
+
+    def create(self, name):
+        pod = {
+            "metadata": {"name": name},
+            "spec": {
+                "containers": [{"resources": {"limits": {RESOURCE: 1}}}],
+            },
+        }
+        self.pods[name] = pod
+        scheduled = asyncio.Event()
+        self.pending.append((name, scheduled))
+        self.schedule()
+        self.peak_pending = max(self.peak_pending, len(self.pending))
+        return scheduled
+
+    def delete(self, name):
+        self.pods.pop(name, None)
+        self.pending = [(n, e) for n, e in self.pending if n != name]
+        self.schedule()
+
+    async def list_node(self, label_selector):
+        return {
+            "items": [
+                {
+                    "metadata": {"name": "gpu-1"},
+                    "status": {"allocatable": {RESOURCE: str(self.gpus)}},
+                }
+            ]
+        }
+
+    async def list_pod_for_all_namespaces(self, field_selector):
+        return {"items": list(self.pods.values())}
+
+
+def workload(args):
+    rng = random.Random(args.seed)
+    spawns = [(0.0, "/gcube/burst") for _ in range(args.burst)]
+    for i in range(args.spawns):
+        spawns.append((i * args.interval, f"/gcube/vre{rng.randrange(args.contexts)}"))
+    return [
+        (at, context, f"pod-{i}", rng.expovariate(1 / args.session))
+        for i, (at, context) in enumerate(spawns)
+    ]
+
+
+async def run(args, mode):
+    cluster = FakeCluster(args.gpus)
+    gpus = admission.GpuAdmission(cluster, {"pool": "gpu"}, resource=RESOURCE)
+    await gpus.refresh()
+    scale = args.scale
+    waits = {"burst": [], "others": []}
+    outcome = {"started": 0, "failed": 0}
+
+    async def refresher():
+        while True:
+            await asyncio.sleep(args.refresh * scale)
+            await gpus.refresh()
+
+    async def spawn(at, context, name, session):
+        await asyncio.sleep(at * scale)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = args.start_timeout * scale
+        ticket = None
+        try:
+            if mode == "queue":
+                ticket = gpus.enqueue(context, 1, name)
+                await gpus.wait(ticket, deadline)
+                deadline -= loop.time() - start
+            scheduled = cluster.create(name)
+            await asyncio.wait_for(scheduled.wait(), deadline)
+        except asyncio.TimeoutError:
+            outcome["failed"] += 1
+            cluster.delete(name)
+            return
+        finally:
+            if ticket is not None and ticket.admitted:
+                gpus.release(ticket, created=True)
+        outcome["started"] += 1
+        key = "burst" if context == "/gcube/burst" else "others"
+        waits[key].append((loop.time() - start) / scale)
+        await asyncio.sleep(session * scale)
+        cluster.delete(name)
+        await gpus.refresh()
+
+    task = asyncio.ensure_future(refresher())
+    await asyncio.gather(*[spawn(*s) for s in workload(args)])
+    task.cancel()
+    return {
+        "mode": mode,
+        "started": outcome["started"],
+        "failed": outcome["failed"],
+        "peak_pending_pods": cluster.peak_pending,
+        "wait_p50_burst": statistics.median(waits["burst"] or [0]),
+        "wait_p50_others": statistics.median(waits["others"] or [0]),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--gpus", type=int, default=4)
+    parser.add_argument("--burst", type=int, default=20)
+    parser.add_argument("--spawns", type=int, default=20)
+    parser.add_argument("--contexts", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=10)
+    parser.add_argument("--session", type=float, default=60)
+    parser.add_argument("--start-timeout", type=float, default=300)
+    parser.add_argument("--refresh", type=float, default=10)
+    parser.add_argument("--scale", type=float, default=0.002)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = []
+    print(
+        "%8s %8s %8s %13s %13s %13s"
+        % ("mode", "started", "failed", "peak pending", "p50 burst s", "p50 others s")
+    )
+    for mode in ("pending", "queue"):
+        result = await run(args, mode)
+        results.append(result)
+        print(
+            "%8s %8d %8d %13d %13.1f %13.1f"
+            % (
+                mode,
+                result["started"],
+                result["failed"],
+                result["peak_pending_pods"],
+                result["wait_p50_burst"],
+                result["wait_p50_others"],
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "gpu_admission",
+                    "gpus": args.gpus,
+                    "burst": args.burst,
+                    "spawns": args.spawns,
+                    "contexts": args.contexts,
+                    "session": args.session,
+                    "start_timeout": args.start_timeout,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+"""Measures D4ScienceOauthenticator.authenticate against local stand-ins
+
+The OAuth code exchange of GenericOAuthenticator is replaced by a fixed
+access token, everything after it (UMA tokens, JWKS, Information System and
+DataMiner discovery) goes over HTTP to the stand-ins in stubs.py.
+
+Usage: python benchmarks/bench_login.py [--logins 200] [--concurrency 1 10 50]
+           [--latency 0.05] [--options 100] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from d4science_hub.authenticator import D4ScienceOauthenticator  # noqa: E402
+from oauthenticator.generic import GenericOAuthenticator  # noqa: E402
+from oauthenticator.oauth2 import _serialize_state  # noqa: E402
+from stubs import Stubs  # noqa: E402
+
+CONTEXT = "/gcube/devsec/vre0"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def make_authenticator(stubs):
+    authenticator = D4ScienceOauthenticator(
+        client_id="jupyterhub",
+        token_url=stubs.token_url,
+        d4science_oidc_url=stubs.oidc_url,
+        jupyterhub_infosys_url=stubs.jupyterhub_infosys_url,
+        dm_infosys_url=stubs.dm_infosys_url,
+        discover_wps=True,
+    )
+    return authenticator
+
+
+def oauth_user(handler, data=None):
+    return {"name": handler.user, "auth_state": {"access_token": "at"}}
+
+
+def callback_handler(user):
+    state = _serialize_state({"state_id": user, "d4science": {"context": CONTEXT}})
+    handler = mock.MagicMock(user=user)
+    handler.get_state_cookie.return_value = state
+    return handler
+
+
+async def login(authenticator, i):
+    start = time.perf_counter()
+    await authenticator.authenticate(callback_handler(f"user-{i}"))
+    return time.perf_counter() - start
+
+
+async def run(stubs, logins, concurrency):
+    authenticator = make_authenticator(stubs)
+    authenticator.log.setLevel("WARNING")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(i):
+        async with semaphore:
+            return await login(authenticator, i)
+
+    stubs.requests.clear()
+    start = time.perf_counter()
+    with mock.patch.object(
+        GenericOAuthenticator, "authenticate", side_effect=oauth_user
+    ):
+        latencies = await asyncio.gather(*[limited(i) for i in range(logins)])
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "logins": logins,
+        "seconds": elapsed,
+        "throughput": logins / elapsed,
+        "mean": statistics.mean(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "upstream_requests": dict(stubs.requests),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--options", type=int, default=100)
+    parser.add_argument("--permissions", type=int, default=10)
+    args = parser.parse_args()
+
+    stubs = Stubs(
+        n_options=args.options, n_permissions=args.permissions, latency=args.latency
+    )
+    stubs.start()
+    results = []
+    print(
+        "%6s %8s %10s %10s %10s %10s"
+        % ("conc", "logins", "logins/s", "p50 ms", "p95 ms", "p99 ms")
+    )
+    try:
+        for concurrency in args.concurrency:
+            result = await run(stubs, args.logins, concurrency)
+            results.append(result)
+            print(
+                "%6d %8d %10.1f %10.1f %10.1f %10.1f"
+                % (
+                    concurrency,
+                    args.logins,
+                    result["throughput"],
+                    result["p50"] * 1000,
+                    result["p95"] * 1000,
+                    result["p99"] * 1000,
+                )
+            )
+    finally:
+        stubs.stop()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "login",
+                    "latency": args.latency,
+                    "options": args.options,
+                    "permissions": args.permissions,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+"""Compares the streaming registry parser with the xmltodict based parsing
+
+Usage: python benchmarks/bench_registry.py [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import xmltodict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from d4science_hub.registry import RegistryParser  # noqa: E402
+from synthetic import generic_resources  # noqa: E402
+
+SIZES = (10, 100, 1000, 10000)
+CHUNK_SIZE = 64 * 1024
+
+
+def xmltodict_path(document):
+    doc = xmltodict.parse(document)
+    options = []
+    for opt in doc["genericResources"]["Resource"]:
+        body = opt.get("Profile", {}).get("Body", {})
+        if body.get("ServerOption", None):
+            options.append(body["ServerOption"])
+    return options
+
+
+def streaming_path(document):
+    parser = RegistryParser()
+    for i in range(0, len(document), CHUNK_SIZE):
+        parser.feed(document[i : i + CHUNK_SIZE])
+    return parser.close().server_options
+
+
+def measure(func, document, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(document)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    result = func(document)
+    _, peak = tracemalloc.get_traced_memory()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return {"seconds": best, "peak_bytes": peak, "retained_bytes": retained}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    print(
+        "%8s %10s %12s %12s %14s %14s"
+        % (
+            "options",
+            "doc KiB",
+            "xmltodict s",
+            "stream s",
+            "xmltodict KiB",
+            "stream KiB",
+        )
+    )
+    for size in SIZES:
+        document = generic_resources(size)
+        repeat = args.repeat if size < 10000 else 1
+        old = measure(xmltodict_path, document, repeat)
+        new = measure(streaming_path, document, repeat)
+        results.append(
+            {
+                "options": size,
+                "doc_bytes": len(document),
+                "xmltodict": old,
+                "streaming": new,
+            }
+        )
+        print(
+            "%8d %10d %12.4f %12.4f %14d %14d"
+            % (
+                size,
+                len(document) // 1024,
+                old["seconds"],
+                new["seconds"],
+                old["peak_bytes"] // 1024,
+                new["peak_bytes"] // 1024,
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "registry_parser", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
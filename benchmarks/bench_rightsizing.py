@@ -0,0 +1,150 @@
+"""Projected node packing with right-sized guarantees
+
+Generates the usage of --pods pods spread over --contexts contexts and
+--options server options per context (Cuts of 2, 4 and 8 cores with 4 GB
+per core), the usage of every pod being a lognormal fraction of the limits
+of its option, and reports the nodes needed for those pods with the static
+guarantees and with the guarantees right-sized at every --percentiles.
+
+The usage is synthetic: the gain depends on how far below their limits the
+actual pods run.
+
+Usage: python benchmarks/bench_rightsizing.py [--pods 2000] [--contexts 10]
+           [--options 6] [--percentiles 50 90 95 99] [--headroom 1.2]
+           [--node-cpu 16] [--node-memory 64] [--seed 0] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from d4science_hub import rightsizing  # noqa: E402
+from d4science_hub.registry import ServerOption  # noqa: E402
+
+GB = 2**30
+
+
+class SyntheticUsageSource(rightsizing.UsageSource):
+    def __init__(self, usage):
+        self._usage = usage
+
+    async def usage(self):
+        return self._usage
+
+
+def make_options(args):
+    options = []
+    for c in range(args.contexts):
+        for i in range(args.options):
+            cores = (2, 4, 8)[i % 3]
+            opt = ServerOption(
+                "ServerOption",
+                f"option-{i}",
+                cores=str(cores),
+                memory=str(4 * cores),
+                memory_unit="G",
+            )
+            options.append((f"/gcube/vre{c}", opt))
+    return options
+
+
+def make_usage(args, options):
+    rng = random.Random(args.seed)
+    usage = {}
+    for _ in range(args.pods):
+        context, opt = rng.choice(options)
+        cpu_limit, memory_limit = rightsizing.declared_limits(opt)
+        samples = usage.setdefault((context, opt.auth_id), {"cpu": [], "memory": []})
+        # most notebooks idle, some use the whole Cut
+        samples["cpu"].append(min(cpu_limit, cpu_limit * rng.lognormvariate(-2.5, 1)))
+        samples["memory"].append(
+            min(memory_limit, memory_limit * rng.lognormvariate(-1.8, 0.7))
+        )
+    return usage
+
+
+async def run(args, options, usage, percentile):
+    sizer = rightsizing.RightSizer(
+        SyntheticUsageSource(usage),
+        cpu_percentile=percentile,
+        memory_percentile=percentile,
+        memory_headroom=args.headroom,
+        min_samples=args.min_samples,
+    )
+    start = time.perf_counter()
+    await sizer.refresh()
+    elapsed = time.perf_counter() - start
+    report = sizer.report(options, args.node_cpu, args.node_memory * GB)
+    return {
+        "percentile": percentile,
+        "options": len(report["options"]),
+        "nodes_current": report["nodes"]["current"],
+        "nodes_proposed": report["nodes"]["proposed"],
+        "gain": report["gain"],
+        "refresh_seconds": elapsed,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--pods", type=int, default=2000)
+    parser.add_argument("--contexts", type=int, default=10)
+    parser.add_argument("--options", type=int, default=6)
+    parser.add_argument(
+        "--percentiles", type=float, nargs="+", default=[50, 90, 95, 99]
+    )
+    parser.add_argument("--headroom", type=float, default=1.2)
+    parser.add_argument("--min-samples", type=int, default=10)
+    parser.add_argument("--node-cpu", type=float, default=16)
+    parser.add_argument("--node-memory", type=float, default=64, help="GB")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    options = make_options(args)
+    usage = make_usage(args, options)
+    results = []
+    print(
+        "%10s %8s %10s %10s %8s %10s"
+        % ("percentile", "options", "nodes now", "nodes new", "gain", "refresh ms")
+    )
+    for percentile in args.percentiles:
+        result = await run(args, options, usage, percentile)
+        results.append(result)
+        print(
+            "%10g %8d %10d %10d %7.2fx %10.1f"
+            % (
+                percentile,
+                result["options"],
+                result["nodes_current"],
+                result["nodes_proposed"],
+                result["gain"],
+                result["refresh_seconds"] * 1000,
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "rightsizing",
+                    "pods": args.pods,
+                    "contexts": args.contexts,
+                    "options": args.options,
+                    "headroom": args.headroom,
+                    "node_cpu": args.node_cpu,
+                    "node_memory": args.node_memory,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
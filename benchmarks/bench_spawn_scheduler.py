@@ -0,0 +1,176 @@
+"""Spawns of a course start with and without the spawn scheduler
+
+--course spawns of one VRE arrive at once while --others spawns of
+--contexts other VREs arrive every --interval seconds. Every spawn makes
+--calls sequential calls to a fake Kubernetes API that serves --api-inflight
+calls at once (--latency seconds each), queues up to --api-queue calls and
+throttles (rejects) the rest, as the API priority and fairness of the
+Kubernetes API server does. Calls throttled or waiting longer than --timeout
+fail their spawn.
+
+- unbounded: every spawn calls the API right away
+- scheduler: spawns wait for a slot of the SpawnScheduler
+  (--concurrency, --per-context) before calling the API
+
+Reports the failed spawns and the median and p95 time from the request to
+the pod creation of the spawns of the course and of the other VREs. Times
+are scaled by --scale to run quickly.
+
+Usage: python benchmarks/bench_spawn_scheduler.py [--course 300]
+           [--others 30] [--contexts 5] [--interval 1] [--calls 4]
+           [--api-inflight 20] [--api-queue 50] [--latency 0.2] [--timeout 10]
+           [--concurrency 20] [--per-context 10] [--scale 0.01]
+           [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from d4science_hub import scheduler  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Throttled(Exception):
+    pass
+
+
+class FakeApi:
+    """Serves inflight calls at once, queues up to queue calls"""
+
+    def __init__(self, args):
+        self.semaphore = asyncio.Semaphore(args.api_inflight)
+        self.queue = args.api_queue
+        self.waiting = 0
+        self.latency = args.latency * args.scale
+        self.timeout = args.timeout * args.scale
+
+    async def call(self):
+        if self.semaphore.locked() and self.waiting >= self.queue:
+            raise Throttled()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        finally:
+            self.waiting -= 1
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.semaphore.release()
+
+
+async def run(args, mode):
+    api = FakeApi(args)
+    spawns = scheduler.SpawnScheduler(args.concurrency, args.per_context)
+    loop = asyncio.get_running_loop()
+    times = {"course": [], "others": []}
+    failed = {"course": 0, "others": 0}
+
+    async def spawn(at, context):
+        await asyncio.sleep(at * args.scale)
+        group = "course" if context == "/gcube/course" else "others"
+        start = loop.time()
+        ticket = None
+        try:
+            if mode == "scheduler":
+                ticket = spawns.enqueue(context)
+                await spawns.wait(ticket)
+            for _ in range(args.calls):
+                await api.call()
+        except (asyncio.TimeoutError, Throttled):
+            failed[group] += 1
+            return
+        finally:
+            if ticket is not None:
+                spawns.release(ticket)
+        times[group].append((loop.time() - start) / args.scale)
+
+    requests = [(0, "/gcube/course")] * args.course + [
+        (i * args.interval, f"/gcube/vre{i % args.contexts}")
+        for i in range(args.others)
+    ]
+    await asyncio.gather(*[spawn(*r) for r in requests])
+    result = {"mode": mode}
+    for group in ("course", "others"):
+        result[f"{group}_failed"] = failed[group]
+        result[f"{group}_p50"] = percentile(times[group], 50)
+        result[f"{group}_p95"] = percentile(times[group], 95)
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--course", type=int, default=300)
+    parser.add_argument("--others", type=int, default=30)
+    parser.add_argument("--contexts", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=1)
+    parser.add_argument("--calls", type=int, default=4)
+    parser.add_argument("--api-inflight", type=int, default=20)
+    parser.add_argument("--api-queue", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--per-context", type=int, default=10)
+    parser.add_argument("--scale", type=float, default=0.01)
+    args = parser.parse_args()
+
+    results = []
+    print(
+        "%10s %12s %10s %10s %12s %10s %10s"
+        % (
+            "mode",
+            "course fail",
+            "p50 s",
+            "p95 s",
+            "others fail",
+            "p50 s",
+            "p95 s",
+        )
+    )
+    for mode in ("unbounded", "scheduler"):
+        result = await run(args, mode)
+        results.append(result)
+        print(
+            "%10s %12d %10.1f %10.1f %12d %10.1f %10.1f"
+            % (
+                mode,
+                result["course_failed"],
+                result["course_p50"],
+                result["course_p95"],
+                result["others_failed"],
+                result["others_p50"],
+                result["others_p95"],
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "spawn_scheduler",
+                    "course": args.course,
+                    "others": args.others,
+                    "api_inflight": args.api_inflight,
+                    "api_queue": args.api_queue,
+                    "concurrency": args.concurrency,
+                    "per_context": args.per_context,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
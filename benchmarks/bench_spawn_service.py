@@ -0,0 +1,215 @@
+"""Measures the redirect throughput of the d4science_spawn service
+
+The service runs as a subprocess (with the given number of processes and
+user cache size) against a local stand-in of the Hub API (GET /hub/api/user)
+with configurable latency. Every request carries the OAuth cookie of one of
+--users users.
+
+Usage: python benchmarks/bench_spawn_service.py [--requests 2000]
+           [--concurrency 50] [--processes 1 4] [--cache-size 0 10000]
+           [--users 100] [--latency 0.01] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler, create_signed_value
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = b"d4science-spawn-benchmark-secret"
+CLIENT_ID = "service-d4science"
+PREFIX = "/services/d4science"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class HubUserHandler(RequestHandler):
+    def initialize(self, hub):
+        self.hub = hub
+
+    async def get(self):
+        self.hub.calls += 1
+        await asyncio.sleep(self.hub.latency)
+        token = self.request.headers.get("Authorization", "").split()[-1]
+        self.write({"kind": "user", "name": token.replace("token", "user")})
+
+
+class HubStub:
+    """Hub API stand-in running in its own thread"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.port = None
+        self._started = threading.Event()
+
+    def _run(self):
+        async def serve():
+            app = Application([("/hub/api/user", HubUserHandler, {"hub": self})])
+            [sock] = bind_sockets(0, "127.0.0.1", family=socket.AF_INET)
+            HTTPServer(app).add_sockets([sock])
+            self.port = sock.getsockname()[1]
+            self._started.set()
+            await asyncio.Event().wait()
+
+        asyncio.run(serve())
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._started.wait()
+
+
+def start_service(hub, processes, cache_size):
+    port = free_port()
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT,
+        JUPYTERHUB_API_URL=f"http://127.0.0.1:{hub.port}/hub/api",
+        JUPYTERHUB_API_TOKEN="service-token",
+        JUPYTERHUB_CLIENT_ID=CLIENT_ID,
+        JUPYTERHUB_SERVICE_PREFIX=PREFIX,
+        JUPYTERHUB_SERVICE_URL=f"http://127.0.0.1:{port}",
+        D4SCIENCE_SPAWN_COOKIE_SECRET=SECRET.hex(),
+        D4SCIENCE_SPAWN_PROCESSES=str(processes),
+        D4SCIENCE_SPAWN_USER_CACHE_SIZE=str(cache_size),
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "d4science_hub.services.d4science_spawn"],
+        env=env,
+        stderr=subprocess.DEVNULL,
+        # to stop the forked processes with it
+        start_new_session=True,
+    )
+    return proc, port
+
+
+async def wait_healthy(port, timeout=10):
+    client = AsyncHTTPClient()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await client.fetch(f"http://127.0.0.1:{port}/health")
+            return
+        except (OSError, HTTPClientError):
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run(hub, args, processes, cache_size):
+    proc, port = start_service(hub, processes, cache_size)
+    try:
+        await wait_healthy(port)
+        cookies = [
+            create_signed_value(SECRET, CLIENT_ID, f"token-{i}").decode()
+            for i in range(args.users)
+        ]
+        client = AsyncHTTPClient(force_instance=True, max_clients=args.concurrency)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def redirect(i):
+            async with semaphore:
+                start = time.perf_counter()
+                resp = await client.fetch(
+                    f"http://127.0.0.1:{port}{PREFIX}/RStudio",
+                    headers={"Cookie": f"{CLIENT_ID}={cookies[i % args.users]}"},
+                    follow_redirects=False,
+                    raise_error=False,
+                )
+                if resp.code != 302:
+                    raise RuntimeError(f"Unexpected response {resp.code}")
+                return time.perf_counter() - start
+
+        hub.calls = 0
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*[redirect(i) for i in range(args.requests)])
+        elapsed = time.perf_counter() - start
+        client.close()
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait()
+    return {
+        "processes": processes,
+        "cache_size": cache_size,
+        "requests": args.requests,
+        "seconds": elapsed,
+        "throughput": args.requests / elapsed,
+        "mean": statistics.mean(latencies),
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "hub_calls": hub.calls,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--cache-size", type=int, nargs="+", default=[0, 10000])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.01)
+    args = parser.parse_args()
+
+    hub = HubStub(args.latency)
+    hub.start()
+    results = []
+    print(
+        "%6s %8s %10s %10s %10s %10s"
+        % ("procs", "cache", "req/s", "p50 ms", "p99 ms", "hub calls")
+    )
+    for processes in args.processes:
+        for cache_size in args.cache_size:
+            result = await run(hub, args, processes, cache_size)
+            results.append(result)
+            print(
+                "%6d %8d %10.1f %10.1f %10.1f %10d"
+                % (
+                    processes,
+                    cache_size,
+                    result["throughput"],
+                    result["p50"] * 1000,
+                    result["p99"] * 1000,
+                    result["hub_calls"],
+                )
+            )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "spawn_service",
+                    "latency": args.latency,
+                    "users": args.users,
+                    "concurrency": args.concurrency,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,219 @@
+"""Scaling of the spawner hooks run in the hub for every spawn
+
+Measures the wall time (best of --repeat) and the memory allocated (peak and
+retained, with tracemalloc) of build_resource_options, auth_state_hook,
+profile_list (with an empty and a warm memo) and pre_spawn_hook while one
+input grows and the others stay fixed:
+
+- options: server options in the Information System (10 to 10k)
+- permissions: UMA permissions of the user (1 to 1k)
+- volumes: volume options with a volume_mappings entry (1 to 1k)
+- extra_profiles: number of extra_profiles (1 to 1k)
+
+For every hook and input the exponent between consecutive sizes is
+reported (time ~ size^exponent), exponents clearly above 1 mean the hook
+became superlinear.
+
+Usage: python benchmarks/bench_spawner_hooks.py [--axis options ...]
+           [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+import xmltodict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from d4science_hub import auth_state  # noqa: E402
+from d4science_hub.catalog import ResourceCatalog  # noqa: E402
+from d4science_hub.registry import parse  # noqa: E402
+from d4science_hub.spawner import D4ScienceSpawner  # noqa: E402
+from synthetic import generic_resources  # noqa: E402
+
+ROLES = ["Data-Manager"]
+CONTEXT = "/gcube/devsec/vre0"
+
+# size of each input when it is not the one growing
+BASELINE = {"options": 1000, "permissions": 100, "volumes": 10, "extra_profiles": 1}
+AXES = {
+    "options": (10, 100, 1000, 10000),
+    "permissions": (1, 10, 100, 1000),
+    "volumes": (1, 10, 100, 1000),
+    "extra_profiles": (1, 10, 100, 1000),
+}
+HOOKS = (
+    "build_resource_options",
+    "auth_state_hook",
+    "profile_list_cold",
+    "profile_list_warm",
+    "pre_spawn_hook",
+)
+
+
+def extra_profile(i):
+    return {
+        "display_name": f"Extra profile {i}",
+        "description": f"Extra profile number {i}",
+        "slug": f"extra-{i}",
+        "kubespawner_override": {
+            "image": f"eginotebooks/extra-{i}:latest",
+            "volumes": [
+                {"name": "data", "persistentVolumeClaim": {"claimName": f"data-{i}"}}
+            ],
+            "volume_mounts": [{"name": "data", "mountPath": "/data"}],
+        },
+        "default": False,
+    }
+
+
+def volume_mappings(n_volumes):
+    return {
+        f"Volume {i}": {
+            "mount_path": f"/home/jovyan/volume-{i}",
+            "volume": {"persistentVolumeClaim": {"claimName": f"volume-{i}"}},
+        }
+        for i in range(n_volumes)
+    }
+
+
+def make_inputs(options, permissions, volumes, extra_profiles):
+    document = generic_resources(options, volumes)
+    resources = parse(document)
+    catalog = ResourceCatalog(resources.server_options, resources.volume_options)
+    perms = [
+        {"rsid": f"id-{i}", "rsname": f"option-{i}"}
+        for i in range(min(permissions, options))
+    ]
+    spawner = D4ScienceSpawner(
+        _mock=True,
+        volume_mappings=volume_mappings(volumes),
+        extra_profiles=[extra_profile(i) for i in range(extra_profiles)],
+    )
+    spawner.log.setLevel("WARNING")
+    spawner.environment = {
+        "D4SCIENCE_CONTEXT": CONTEXT,
+        "D4SCIENCE_TOKEN": "token",
+    }
+    return spawner, xmltodict.parse(document), auth_state.pack(perms, ROLES, catalog)
+
+
+async def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    result = await func()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {"seconds": best, "peak_bytes": peak, "retained_bytes": retained}
+
+
+async def measure_hooks(spawner, document, state, repeat):
+    async def build_resource_options():
+        return spawner.build_resource_options(ROLES, document)
+
+    async def auth_state_hook():
+        await spawner.auth_state_hook(spawner, state)
+
+    async def profile_list_cold():
+        D4ScienceSpawner._profiles_cache.clear()
+        spawner._profiles_fingerprint = None
+        return spawner.profile_list(spawner)
+
+    async def profile_list_warm():
+        return spawner.profile_list(spawner)
+
+    async def pre_spawn_hook():
+        await spawner.pre_spawn_hook(spawner)
+
+    hooks = {
+        "build_resource_options": build_resource_options,
+        "auth_state_hook": auth_state_hook,
+        "profile_list_cold": profile_list_cold,
+        "profile_list_warm": profile_list_warm,
+        "pre_spawn_hook": pre_spawn_hook,
+    }
+    return {name: await measure(hook, repeat) for name, hook in hooks.items()}
+
+
+def exponents(sizes, points):
+    """Returns the exponent between consecutive sizes"""
+    result = []
+    for (s1, p1), (s2, p2) in zip(zip(sizes, points), zip(sizes[1:], points[1:])):
+        if p1["seconds"] > 0 and p2["seconds"] > 0:
+            result.append(math.log(p2["seconds"] / p1["seconds"]) / math.log(s2 / s1))
+        else:
+            result.append(None)
+    return result
+
+
+async def run_axis(axis, repeat):
+    sizes = AXES[axis]
+    points = {hook: [] for hook in HOOKS}
+    for size in sizes:
+        inputs = dict(BASELINE, **{axis: size})
+        spawner, document, state = make_inputs(**inputs)
+        # auth_state_hook sets the inputs of profile_list
+        await spawner.auth_state_hook(spawner, state)
+        # the largest sizes take too long to repeat
+        results = await measure_hooks(
+            spawner, document, state, repeat if size < 10000 else 1
+        )
+        for hook, result in results.items():
+            points[hook].append(dict(result, size=size))
+    curves = {}
+    print(f"\n{axis} (others at {BASELINE})")
+    print("%24s %s %s" % ("hook", " ".join("%10d" % s for s in sizes), "  exponents"))
+    for hook in HOOKS:
+        curve_exponents = exponents(sizes, points[hook])
+        curves[hook] = {"points": points[hook], "exponents": curve_exponents}
+        print(
+            "%24s %s   %s"
+            % (
+                hook,
+                " ".join("%8.2fms" % (p["seconds"] * 1000) for p in points[hook]),
+                " ".join("-" if e is None else "%.2f" % e for e in curve_exponents),
+            )
+        )
+    return curves
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--axis", nargs="+", choices=list(AXES), default=list(AXES), dest="axes"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for axis in args.axes:
+        results[axis] = await run_axis(axis, args.repeat)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "spawner_hooks",
+                    "baseline": BASELINE,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+"""Memory held by the spawners of many users
+
+Creates --users spawners (configured through a traitlets Config, as in the
+hub) spread over --contexts contexts, runs auth_state_hook and profile_list
+on every one of them and measures the memory retained (with tracemalloc) by
+the spawners:
+
+- shared: the configuration, volumes and profiles are interned
+- copies: every spawner keeps its own copies (interning disabled)
+
+Usage: python benchmarks/bench_spawner_memory.py [--users 5000]
+           [--contexts 10] [--options 50] [--volumes 10]
+           [--extra-profiles 5] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_spawner_hooks import extra_profile, volume_mappings  # noqa: E402
+from d4science_hub import auth_state, frozen  # noqa: E402
+from d4science_hub.catalog import ResourceCatalog  # noqa: E402
+from d4science_hub.registry import parse  # noqa: E402
+from d4science_hub.spawner import D4ScienceSpawner  # noqa: E402
+from synthetic import generic_resources  # noqa: E402
+from traitlets.config import Config  # noqa: E402
+
+ROLES = ["Data-Manager"]
+
+
+def make_config(args):
+    config = Config()
+    config.D4ScienceSpawner.volume_mappings = volume_mappings(args.volumes)
+    config.D4ScienceSpawner.extra_profiles = [
+        extra_profile(i) for i in range(args.extra_profiles)
+    ]
+    config.D4ScienceSpawner.volumes = [
+        {"name": "home", "persistentVolumeClaim": {"claimName": "claim-{username}"}}
+    ]
+    config.D4ScienceSpawner.volume_mounts = [
+        {"name": "home", "mountPath": "/home/jovyan"}
+    ]
+    return config
+
+
+def make_states(args):
+    resources = parse(generic_resources(args.options, args.volumes))
+    catalog = ResourceCatalog.intern(resources.server_options, resources.volume_options)
+    perms = [{"rsid": f"id-{i}", "rsname": f"option-{i}"} for i in range(args.options)]
+    return [
+        dict(
+            auth_state.pack(perms, ROLES, catalog),
+            context=f"%2Fgcube%2Fvre{i}",
+        )
+        for i in range(args.contexts)
+    ]
+
+
+async def run(args, mode):
+    config = make_config(args)
+    states = make_states(args)
+    D4ScienceSpawner._profiles_cache.clear()
+    gc.collect()
+    patch = (
+        mock.patch.object(frozen, "intern", lambda obj: obj)
+        if mode == "copies"
+        else contextlib.nullcontext()
+    )
+    with patch:
+        tracemalloc.start()
+        start = time.perf_counter()
+        spawners = []
+        for i in range(args.users):
+            spawner = D4ScienceSpawner(_mock=True, config=config)
+            spawner.log.setLevel("WARNING")
+            await spawner.auth_state_hook(spawner, states[i % args.contexts])
+            spawner.profile_list(spawner)
+            spawners.append(spawner)
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    del spawners
+    return {
+        "mode": mode,
+        "users": args.users,
+        "seconds": elapsed,
+        "retained_bytes": retained,
+        "peak_bytes": peak,
+        "bytes_per_user": retained / args.users,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--contexts", type=int, default=10)
+    parser.add_argument("--options", type=int, default=50)
+    parser.add_argument("--volumes", type=int, default=10)
+    parser.add_argument("--extra-profiles", type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    print("%8s %8s %12s %12s %12s" % ("mode", "users", "retained MB", "KB/user", "s"))
+    for mode in ("copies", "shared"):
+        result = await run(args, mode)
+        results.append(result)
+        print(
+            "%8s %8d %12.1f %12.1f %12.1f"
+            % (
+                mode,
+                result["users"],
+                result["retained_bytes"] / 2**20,
+                result["bytes_per_user"] / 1024,
+                result["seconds"],
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "spawner_memory",
+                    "contexts": args.contexts,
+                    "options": args.options,
+                    "volumes": args.volumes,
+                    "extra_profiles": args.extra_profiles,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
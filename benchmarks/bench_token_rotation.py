@@ -0,0 +1,211 @@
+"""Long running servers with and without token rotation
+
+--users users start 1 to --servers servers each during the first hour,
+running for --session hours (exponentially distributed, at most
+--duration hours). Every server uses its context token every
+--call-interval seconds and the call fails if the token expired. Context
+tokens live --lifetime seconds.
+
+- baked: the token of the spawn is in the environment of the server
+- per-server: a TokenRotator replaces the token in the Secret of every
+  server --ahead seconds before its expiry with a token fetched for it
+- cached: as per-server, with the tokens fetched through the TokenCache
+  of the authenticator (as get_context_token), shared by the servers of a
+  user
+
+The containers see the new token in the Secret after --sync-delay seconds
+(the kubelet sync). Reports the failed calls, the servers that would need
+a restart to get a valid token again and the calls to the token endpoint.
+Times are scaled by --scale to run quickly.
+
+Usage: python benchmarks/bench_token_rotation.py [--users 50] [--servers 3]
+           [--session 4] [--duration 8] [--lifetime 3600] [--ahead 600]
+           [--interval 60] [--sync-delay 60] [--call-interval 300]
+           [--scale 0.0002] [--seed 0] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import jwt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from d4science_hub import token_rotation  # noqa: E402
+from d4science_hub.tokens import TokenCache  # noqa: E402
+
+
+class FakeCoreApi:
+    """Secrets whose new values are seen after sync_delay seconds"""
+
+    def __init__(self, sync_delay):
+        self.sync_delay = sync_delay
+        self.history = {}
+        self.patches = 0
+
+    async def create_namespaced_secret(self, namespace, body):
+        token = body["stringData"]["token"]
+        self.history[body["metadata"]["name"]] = [(0, token)]
+
+    async def patch_namespaced_secret(self, name, namespace, body):
+        self.patches += 1
+        self.history[name].append((time.time(), body["stringData"]["token"]))
+
+    async def delete_namespaced_secret(self, name, namespace):
+        del self.history[name]
+
+    def mounted(self, name):
+        """Token in the file of the mounted Secret"""
+        visible = time.time() - self.sync_delay
+        return [token for at, token in self.history[name] if at <= visible][-1]
+
+
+class TokenEndpoint:
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.calls = 0
+
+    async def issue(self, user):
+        self.calls += 1
+        await asyncio.sleep(0)
+        exp = time.time() + self.lifetime
+        token = jwt.encode({"sub": user, "exp": exp, "n": self.calls}, "s" * 32)
+        return token, {"exp": exp}
+
+
+def workload(args):
+    rng = random.Random(args.seed)
+    servers = []
+    for user in range(args.users):
+        for _ in range(rng.randint(1, args.servers)):
+            session = min(rng.expovariate(1 / args.session), args.duration)
+            servers.append((f"user-{user}", rng.uniform(0, 1) * 3600, session * 3600))
+    return servers
+
+
+async def run(args, mode):
+    scale = args.scale
+    api = FakeCoreApi(args.sync_delay * scale)
+    endpoint = TokenEndpoint(args.lifetime * scale)
+    cache = TokenCache(skew=60 * scale)
+    rotator = token_rotation.TokenRotator(api, ahead=args.ahead * scale)
+    calls = {"ok": 0, "failed": 0}
+    restarts = set()
+
+    async def cached_token(user, min_ttl=0):
+        key = (user, "/gcube/vre", "/gcube/vre")
+        expires_in = cache.expires_in(key)
+        force = expires_in is None or expires_in <= min_ttl
+        token, _ = await cache.fetch(key, lambda: endpoint.issue(user), force=force)
+        return token
+
+    async def server(i, user, start, session):
+        await asyncio.sleep(start * scale)
+        name = f"server-{i}"
+        # the token of the spawn, as pre_spawn_start
+        token = await cached_token(user)
+        await api.create_namespaced_secret(
+            "ns", token_rotation.secret_manifest(name, token)
+        )
+        if mode == "per-server":
+
+            async def fetch():
+                return (await endpoint.issue(user))[0]
+
+            rotator.add("ns", name, fetch, token)
+        elif mode == "cached":
+            rotator.add("ns", name, lambda: cached_token(user, rotator.ahead), token)
+        end = time.time() + session * scale
+        while time.time() < end:
+            await asyncio.sleep(args.call_interval * scale)
+            current = token if mode == "baked" else api.mounted(name)
+            if token_rotation.token_expiry(current) > time.time():
+                calls["ok"] += 1
+            else:
+                calls["failed"] += 1
+                restarts.add(name)
+        await rotator.delete("ns", name)
+
+    servers = workload(args)
+    task = asyncio.ensure_future(rotator.run(args.interval * scale))
+    await asyncio.gather(*[server(i, *s) for i, s in enumerate(servers)])
+    task.cancel()
+    total = calls["ok"] + calls["failed"]
+    return {
+        "mode": mode,
+        "servers": len(servers),
+        "calls": total,
+        "failed_calls_pct": 100 * calls["failed"] / (total or 1),
+        "servers_needing_restart": len(restarts),
+        "token_requests": endpoint.calls,
+        "secret_patches": api.patches,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--session", type=float, default=4)
+    parser.add_argument("--duration", type=float, default=8)
+    parser.add_argument("--lifetime", type=float, default=3600)
+    parser.add_argument("--ahead", type=float, default=600)
+    parser.add_argument("--interval", type=float, default=60)
+    parser.add_argument("--sync-delay", type=float, default=60)
+    parser.add_argument("--call-interval", type=float, default=300)
+    parser.add_argument("--scale", type=float, default=0.0002)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = []
+    print(
+        "%11s %8s %10s %14s %15s %15s"
+        % (
+            "mode",
+            "servers",
+            "failed %",
+            "need restart",
+            "token requests",
+            "secret patches",
+        )
+    )
+    for mode in ("baked", "per-server", "cached"):
+        result = await run(args, mode)
+        results.append(result)
+        print(
+            "%11s %8d %10.1f %14d %15d %15d"
+            % (
+                mode,
+                result["servers"],
+                result["failed_calls_pct"],
+                result["servers_needing_restart"],
+                result["token_requests"],
+                result["secret_patches"],
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "token_rotation",
+                    "users": args.users,
+                    "servers": args.servers,
+                    "session": args.session,
+                    "lifetime": args.lifetime,
+                    "ahead": args.ahead,
+                    "sync_delay": args.sync_delay,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,238 @@
+"""Per-pod memory and spawn-to-ready time of the workspace modes
+
+Pods are built by D4ScienceSpawner.get_pod_manifest in both modes and
+created in a fake Kubernetes API that runs them locally:
+
+- sidecar: the workspace-sidecar container is a stub process per pod that
+  takes --mount-latency to mount, after --container-start to create the
+  container
+- daemon: the postStart hook of the notebook container runs the real client
+  against a stub storage daemon (the real StorageDaemon handling the mounts
+  in-process, taking --mount-latency each)
+
+The notebook container takes --notebook-start in both modes and a pod is
+ready once all its containers (and hooks) are. Memory is the RSS of the
+sidecar processes, or of the daemon, divided by the number of pods. The
+stubs model the number of processes per pod, not the memory of the actual
+FUSE client.
+
+Usage: python benchmarks/bench_workspace_storage.py [--pods 20]
+           [--mount-latency 1] [--container-start 0.5] [--notebook-start 1]
+           [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from d4science_hub.storage_daemon import StorageDaemon  # noqa: E402
+
+# stands for the sidecar: mounts and keeps running
+SIDECAR = (
+    "import os, sys, time; time.sleep(float(sys.argv[1])); "
+    "open(os.path.join(os.environ['MNTPATH'], '.mounted'), 'w').close(); "
+    "time.sleep(3600)"
+)
+
+
+class StubStorageDaemon(StorageDaemon):
+    """Storage daemon mounting in-process after mount_latency seconds"""
+
+    mount_latency = 0
+
+    async def _start_mount(self, path, token):
+        await asyncio.sleep(self.mount_latency)
+        open(os.path.join(path, ".mounted"), "w").close()
+        return path
+
+    async def _stop_mount(self, path, handle):
+        pass
+
+
+def rss(pid):
+    """Resident memory of the process in bytes"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def wait_for(path, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise TimeoutError(path)
+        await asyncio.sleep(0.01)
+
+
+class FakeCoreApi:
+    """Creates the pods running their workspace parts locally"""
+
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.processes = []
+        self.ready = {}
+
+    async def _run_sidecar(self, pod_dir):
+        await asyncio.sleep(self.args.container_start)
+        proc = subprocess.Popen(
+            [sys.executable, "-c", SIDECAR, str(self.args.mount_latency)],
+            env=dict(os.environ, MNTPATH=pod_dir),
+        )
+        self.processes.append(proc)
+        await wait_for(os.path.join(pod_dir, ".mounted"))
+
+    async def _run_hook(self, command, volumes):
+        # the socket of the pod is in its hostPath, created by the kubelet
+        socket_dir = volumes["storage-daemon"]["hostPath"]["path"]
+        os.makedirs(socket_dir, exist_ok=True)
+        command = [sys.executable if c == "python3" else c for c in command]
+        command[-2] = os.path.join(socket_dir, os.path.basename(command[-2]))
+        proc = await asyncio.create_subprocess_exec(
+            *command, env=dict(os.environ, D4SCIENCE_TOKEN="token")
+        )
+        if await proc.wait() != 0:
+            raise RuntimeError("postStart failed")
+
+    async def create_namespaced_pod(self, namespace, body):
+        start = time.perf_counter()
+        name = body["metadata"]["name"]
+        pod_dir = os.path.join(self.workdir, name)
+        os.makedirs(pod_dir)
+        tasks = [asyncio.sleep(self.args.notebook_start)]
+        volumes = {v["name"]: v for v in body["spec"].get("volumes", [])}
+        for container in body["spec"]["containers"]:
+            if container["name"] == "workspace-sidecar":
+                tasks.append(self._run_sidecar(pod_dir))
+            post_start = (container.get("lifecycle") or {}).get("postStart")
+            if post_start:
+                tasks.append(self._run_hook(post_start["exec"]["command"], volumes))
+        await asyncio.gather(*tasks)
+        self.ready[name] = time.perf_counter() - start
+
+
+async def pod_manifest(i, mode, sockets, mounts):
+    # not imported by the stub daemon
+    from d4science_hub.spawner import D4ScienceSpawner
+
+    spawner = D4ScienceSpawner(
+        _mock=True,
+        extra_profiles=[],
+        cmd=["jupyterhub-singleuser"],
+        use_storage_daemon=mode == "daemon",
+        storage_daemon_sockets_path=sockets,
+        storage_daemon_mounts_path=mounts,
+    )
+    spawner.log.setLevel("WARNING")
+    spawner.pod_name = f"jupyter-user{i}"
+    spawner.environment = {"D4SCIENCE_TOKEN": "token"}
+    await spawner.pre_spawn_hook(spawner)
+    pod = await spawner.get_pod_manifest()
+    return spawner.api.api_client.sanitize_for_serialization(pod)
+
+
+async def run(args, mode):
+    with tempfile.TemporaryDirectory() as workdir:
+        sockets = os.path.join(workdir, "sockets")
+        mounts = os.path.join(workdir, "mounts")
+        daemon = None
+        if mode == "daemon":
+            daemon = subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--serve-daemon",
+                    sockets,
+                    mounts,
+                    "--mount-latency",
+                    str(args.mount_latency),
+                ]
+            )
+            await wait_for(sockets)
+        api = FakeCoreApi(args, os.path.join(workdir, "pods"))
+        try:
+            manifests = [
+                await pod_manifest(i, mode, sockets, mounts) for i in range(args.pods)
+            ]
+            await asyncio.gather(
+                *[api.create_namespaced_pod("jhub", body) for body in manifests]
+            )
+            if daemon is not None:
+                memory = rss(daemon.pid)
+            else:
+                memory = sum(rss(p.pid) for p in api.processes)
+        finally:
+            for proc in api.processes + ([daemon] if daemon else []):
+                proc.kill()
+                proc.wait()
+    ready = sorted(api.ready.values())
+    return {
+        "mode": mode,
+        "pods": args.pods,
+        "memory_per_pod": memory / args.pods,
+        "ready_p50": statistics.median(ready),
+        "ready_max": ready[-1],
+    }
+
+
+async def serve_daemon(sockets, mounts, mount_latency):
+    daemon = StubStorageDaemon(mounts)
+    daemon.mount_latency = mount_latency
+    await daemon.watch(sockets, interval=0.05)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--pods", type=int, default=20)
+    parser.add_argument("--mount-latency", type=float, default=1)
+    parser.add_argument("--container-start", type=float, default=0.5)
+    parser.add_argument("--notebook-start", type=float, default=1)
+    parser.add_argument("--serve-daemon", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve_daemon:
+        await serve_daemon(*args.serve_daemon, args.mount_latency)
+        return
+
+    results = []
+    print("%8s %6s %14s %14s %14s" % ("mode", "pods", "MB/pod", "ready p50 s", "max s"))
+    for mode in ("sidecar", "daemon"):
+        result = await run(args, mode)
+        results.append(result)
+        print(
+            "%8s %6d %14.2f %14.2f %14.2f"
+            % (
+                mode,
+                result["pods"],
+                result["memory_per_pod"] / 2**20,
+                result["ready_p50"],
+                result["ready_max"],
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "workspace_storage",
+                    "mount_latency": args.mount_latency,
+                    "container_start": args.container_start,
+                    "notebook_start": args.notebook_start,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,159 @@
+"""Local stand-ins of Keycloak and the D4Science Information System
+
+A Tornado application serving OIDC discovery, JWKS, the UMA token endpoint,
+the GenericResource/JupyterHub document and the DataMiner ServiceEndpoint,
+with configurable latency and document sizes. UMA tokens are signed with a
+RSA key generated at startup and published in the JWKS.
+"""
+
+import asyncio
+import collections
+import json
+import time
+import uuid
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from synthetic import generic_resources, service_endpoints
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+OIDC_PATH = "/auth/realms/d4science/"
+JUPYTERHUB_PATH = "/icproxy/gcube/service/GenericResource/JupyterHub"
+DATAMINER_PATH = "/icproxy/gcube/service/ServiceEndpoint/DataAnalysis/DataMiner"
+
+
+class StubHandler(web.RequestHandler):
+    def initialize(self, stubs):
+        self.stubs = stubs
+
+    async def prepare(self):
+        self.stubs.requests[self.request.path] += 1
+        if self.stubs.latency:
+            await asyncio.sleep(self.stubs.latency)
+
+
+class DiscoveryHandler(StubHandler):
+    def get(self):
+        self.write(
+            {
+                "issuer": self.stubs.oidc_url,
+                "jwks_uri": self.stubs.url(OIDC_PATH + "protocol/openid-connect/certs"),
+                "token_endpoint": self.stubs.token_url,
+            }
+        )
+
+
+class JWKSHandler(StubHandler):
+    def get(self):
+        self.set_header("Cache-Control", "max-age=3600")
+        self.write({"keys": [self.stubs.jwk]})
+
+
+class TokenHandler(StubHandler):
+    def post(self):
+        audience = self.get_body_argument("audience")
+        self.write({"access_token": self.stubs.uma_token(audience)})
+
+
+class DocumentHandler(StubHandler):
+    def initialize(self, stubs, document):
+        super().initialize(stubs)
+        self.document = document
+
+    def get(self):
+        self.set_header("Content-Type", "application/xml")
+        self.write(self.document)
+
+
+class Stubs:
+    """Runs the stand-ins in the current event loop
+
+    n_options: number of server options in the JupyterHub document
+    n_permissions: number of UMA permissions in the client tokens
+    latency: seconds to wait before answering every request
+    """
+
+    def __init__(self, n_options=100, n_permissions=10, latency=0, roles=()):
+        self.n_options = n_options
+        self.n_permissions = n_permissions
+        self.latency = latency
+        self.roles = list(roles)
+        self.requests = collections.Counter()
+        self.kid = uuid.uuid4().hex
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.jwk = json.loads(
+            jwt.algorithms.RSAAlgorithm.to_jwk(self._key.public_key())
+        )
+        self.jwk.update({"kid": self.kid, "alg": "RS256", "use": "sig"})
+        self.port = None
+        self._server = None
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    @property
+    def oidc_url(self):
+        return self.url(OIDC_PATH)
+
+    @property
+    def token_url(self):
+        return self.url(OIDC_PATH + "protocol/openid-connect/token")
+
+    @property
+    def jupyterhub_infosys_url(self):
+        return self.url(JUPYTERHUB_PATH)
+
+    @property
+    def dm_infosys_url(self):
+        return self.url(DATAMINER_PATH)
+
+    def uma_token(self, audience, lifetime=300):
+        claims = {"aud": audience, "exp": int(time.time()) + lifetime}
+        if audience.startswith("%2F"):
+            claims["resource_access"] = {audience: {"roles": self.roles}}
+        else:
+            claims["authorization"] = {
+                "permissions": [
+                    {"rsid": f"id-{i}", "rsname": f"option-{i}"}
+                    for i in range(self.n_permissions)
+                ]
+            }
+        return jwt.encode(
+            claims, self._key, algorithm="RS256", headers={"kid": self.kid}
+        )
+
+    def make_app(self):
+        kwargs = {"stubs": self}
+        return web.Application(
+            [
+                (
+                    OIDC_PATH + ".well-known/openid-configuration",
+                    DiscoveryHandler,
+                    kwargs,
+                ),
+                (OIDC_PATH + "protocol/openid-connect/certs", JWKSHandler, kwargs),
+                (OIDC_PATH + "protocol/openid-connect/token", TokenHandler, kwargs),
+                (
+                    JUPYTERHUB_PATH,
+                    DocumentHandler,
+                    dict(kwargs, document=generic_resources(self.n_options)),
+                ),
+                (
+                    DATAMINER_PATH,
+                    DocumentHandler,
+                    dict(kwargs, document=service_endpoints()),
+                ),
+            ]
+        )
+
+    def start(self):
+        sockets = bind_sockets(0, "127.0.0.1")
+        self.port = sockets[0].getsockname()[1]
+        self._server = HTTPServer(self.make_app())
+        self._server.add_sockets(sockets)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
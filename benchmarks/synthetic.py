@@ -0,0 +1,109 @@
+"""Synthetic D4Science Information System documents for the benchmarks"""
+
+SERVER_OPTION = """  <Resource version="0.4.x">
+    <ID>{i}</ID>
+    <Type>GenericResource</Type>
+    <Scopes><Scope>/gcube/devsec/vre{i}</Scope></Scopes>
+    <Profile>
+      <SecondaryType>JupyterHub</SecondaryType>
+      <Name>{name}</Name>
+      <Description>Server option number {i}</Description>
+      <Body>
+        <ServerOption{attrs}>
+          <AuthId>option-{i}</AuthId>
+          <Info>
+            <Name>Option {i}</Name>
+            <Description>A generated server option with id {i}</Description>
+          </Info>
+          <ImageId>eginotebooks/d4science-{i}:latest</ImageId>
+          <Cut>
+            <Cores>{cores}</Cores>
+            <Memory unit="GB">{memory}</Memory>
+          </Cut>
+        </ServerOption>
+      </Body>
+    </Profile>
+  </Resource>
+"""
+
+VOLUME_OPTION = """  <Resource version="0.4.x">
+    <ID>v{i}</ID>
+    <Profile>
+      <SecondaryType>JupyterHub</SecondaryType>
+      <Name>VolumeOption</Name>
+      <Body>
+        <VolumeOption>
+          <Name>Volume {i}</Name>
+          <Permission>{permission}</Permission>
+        </VolumeOption>
+      </Body>
+    </Profile>
+  </Resource>
+"""
+
+SERVER_OPTION_NAMES = (
+    "ServerOption",
+    "RStudioServerOption",
+    "WITOILServerOption",
+    "webODVServerOption",
+)
+
+ROLES = ("", "", "Data-Manager", "VRE-Manager")
+
+
+def server_option_attrs(i):
+    attrs = ""
+    if i == 0:
+        attrs += ' default="true"'
+    role = ROLES[i % len(ROLES)]
+    if role:
+        attrs += f' role="{role}"'
+    if i % 10 == 9:
+        attrs += ' gpu="true"'
+    return attrs
+
+
+def generic_resources(n_options, n_volumes=None):
+    """Returns a GenericResource/JupyterHub document with n_options server
+    options and n_volumes volume options (n_options // 10 by default)"""
+    if n_volumes is None:
+        n_volumes = max(1, n_options // 10)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<genericResources>\n']
+    for i in range(n_options):
+        parts.append(
+            SERVER_OPTION.format(
+                i=i,
+                name=SERVER_OPTION_NAMES[i % len(SERVER_OPTION_NAMES)],
+                attrs=server_option_attrs(i),
+                cores=2 ** (i % 4),
+                memory=8 * (i % 4 + 1),
+            )
+        )
+    for i in range(n_volumes):
+        permission = "Read-Write" if i % 2 else "Read-Only"
+        parts.append(VOLUME_OPTION.format(i=i, permission=permission))
+    parts.append("</genericResources>\n")
+    return "".join(parts).encode()
+
+
+ACCESS_POINT = """      <AccessPoint>
+        <Description>Access point {name}</Description>
+        <Interface>
+          <Endpoint EntryName="{name}">{url}</Endpoint>
+        </Interface>
+      </AccessPoint>
+"""
+
+
+def service_endpoints(n_access_points=3, url="http://dataminer.example.org/wps"):
+    """Returns a ServiceEndpoint/DataAnalysis/DataMiner document"""
+    aps = [
+        ACCESS_POINT.format(name=f"Node{i}", url=f"http://node{i}/wps")
+        for i in range(n_access_points)
+    ]
+    aps.append(ACCESS_POINT.format(name="Cluster", url=url))
+    return (
+        "<serviceEndpoints>\n  <Resource>\n    <Profile>\n"
+        + "".join(aps)
+        + "    </Profile>\n  </Resource>\n</serviceEndpoints>\n"
+    ).encode()
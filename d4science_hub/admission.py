@@ -0,0 +1,197 @@
+"""Admission of the spawns of GPU servers
+
+Tracks the GPUs of the nodes of the GPU node pool and the GPUs requested by
+the pods running in them. Spawns needing more GPUs than
+are free wait in a queue per context, the queues are served round-robin
+(FIFO within every context) as GPUs are released, so a context with many
+waiting spawns cannot starve the others.
+
+GPUs of admitted spawns count as allocated from their admission until a
+refresh lists their pod.
+"""
+
+import asyncio
+import collections
+import logging
+
+
+class Ticket:
+    """Spawn waiting for (or holding) gpus GPUs"""
+
+    __slots__ = ("context", "gpus", "name", "future")
+
+    def __init__(self, context, gpus, name):
+        self.context = context
+        self.gpus = gpus
+        self.name = name
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def admitted(self):
+        return self.future.done()
+
+
+def pod_gpus(pod, resource):
+    """Returns the number of resource requested by the containers of pod"""
+    gpus = 0
+    spec = pod.get("spec") or {}
+    for container in spec.get("containers") or []:
+        resources = container.get("resources") or {}
+        requested = [
+            int((resources.get(field) or {}).get(resource, 0))
+            for field in ("requests", "limits")
+        ]
+        gpus += max(requested)
+    return gpus
+
+
+class GpuAdmission:
+    """Admits the spawns needing GPUs of the nodes selected by node_selector
+
+    `api` is a kubernetes CoreV1Api. `capacity` is None until the first
+    refresh.
+    """
+
+    def __init__(self, api, node_selector, resource="nvidia.com/gpu", log=None):
+        self.api = api
+        self.node_selector = node_selector
+        self.resource = resource
+        self.log = log or logging.getLogger(__name__)
+        self.capacity = None
+        self.allocated = 0
+        # waiting tickets per context, in the order the contexts are served
+        self._queues = collections.OrderedDict()
+        self._admitted = set()
+        # GPUs of the pods of admitted spawns not listed yet, by pod name
+        self._created = {}
+
+    @property
+    def free(self):
+        if self.capacity is None:
+            return 0
+        reserved = sum(t.gpus for t in self._admitted) + sum(self._created.values())
+        return self.capacity - self.allocated - reserved
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def refresh(self):
+        """Updates the capacity and the allocated GPUs of the node pool"""
+        created = set(self._created)
+        selector = ",".join(f"{k}={v}" for k, v in self.node_selector.items())
+        node_list = await self.api.list_node(label_selector=selector)
+        node_list = self.api.api_client.sanitize_for_serialization(node_list)
+        nodes = set()
+        capacity = 0
+        for node in node_list["items"]:
+            if (node.get("spec") or {}).get("unschedulable"):
+                continue
+            nodes.add(node["metadata"]["name"])
+            allocatable = (node.get("status") or {}).get("allocatable") or {}
+            capacity += int(allocatable.get(self.resource, 0))
+        # only the pods of the GPU nodes, not every pod of the cluster
+        pod_lists = await asyncio.gather(
+            *[
+                self.api.list_pod_for_all_namespaces(
+                    field_selector=f"spec.nodeName={node},"
+                    "status.phase!=Succeeded,status.phase!=Failed"
+                )
+                for node in sorted(nodes)
+            ]
+        )
+        # pods of the spawns being admitted are counted by their tickets
+        spawning = {t.name for t in self._admitted}
+        allocated = 0
+        for pod_list in pod_lists:
+            pod_list = self.api.api_client.sanitize_for_serialization(pod_list)
+            for pod in pod_list["items"]:
+                if pod["metadata"]["name"] not in spawning:
+                    allocated += pod_gpus(pod, self.resource)
+        for name in created:
+            self._created.pop(name, None)
+        if capacity != self.capacity:
+            self.log.info("GPU capacity: %d %s", capacity, self.resource)
+        self.capacity = capacity
+        self.allocated = allocated
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._queues:
+            context, queue = next(iter(self._queues.items()))
+            ticket = queue[0]
+            if ticket.gpus > self.free:
+                # the next in turn keeps its place until its GPUs are free
+                return
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(context)
+            else:
+                del self._queues[context]
+            self._admitted.add(ticket)
+            ticket.future.set_result(True)
+
+    def position(self, ticket):
+        """Returns the number of waiting spawns that will be admitted before
+        ticket (as long as they do not leave the queue)"""
+        index = self._queues[ticket.context].index(ticket)
+        ahead = 0
+        before = True
+        for context, queue in self._queues.items():
+            if context == ticket.context:
+                before = False
+            ahead += min(len(queue), index + 1 if before else index)
+        return ahead
+
+    def enqueue(self, context, gpus, name):
+        """Returns the ticket of a spawn of pod name needing gpus GPUs, it
+        is admitted right away if they are free"""
+        ticket = Ticket(context, gpus, name)
+        self._queues.setdefault(context, collections.deque()).append(ticket)
+        self._dispatch()
+        return ticket
+
+    async def wait(self, ticket, timeout=None):
+        """Waits until the ticket is admitted, it leaves the queue if the
+        wait fails (e.g. timeout or cancelled)"""
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+        except BaseException:
+            self.release(ticket)
+            raise
+
+    def release(self, ticket, created=False):
+        """Frees the GPUs of the ticket, if created they are allocated to
+        its pod until a refresh lists it"""
+        if ticket in self._admitted:
+            self._admitted.discard(ticket)
+            if created:
+                self._created[ticket.name] = ticket.gpus
+        else:
+            queue = self._queues.get(ticket.context, None)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[ticket.context]
+            if not ticket.future.done():
+                ticket.future.cancel()
+        self._dispatch()
+
+    def available(self, gpus=1):
+        """Returns whether the node pool has (ever) gpus GPUs"""
+        return self.capacity is None or self.capacity >= gpus
+
+    async def run(self, interval=10):
+        """Refreshes the allocation every interval seconds"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.log.warning("Unable to refresh the GPU allocation: %s", e)
+            await asyncio.sleep(interval)
+
+
+def describe_position(position):
+    """Returns the progress message of a spawn at position in the queue"""
+    if position == 0:
+        return "Waiting for a GPU, next in the queue"
+    return f"Waiting for a GPU, {position} spawns ahead in the queue"
@@ -0,0 +1,60 @@
+"""Compact, versioned format for the D4Science information in auth_state
+
+Version 1 (no version key) stored the UMA permissions and the whole
+Information System document as parsed by xmltodict. Version 2 only stores
+the names of the allowed profiles and the server and volume options
+visible with the user roles, as compact lists (see registry.to_state).
+"""
+
+from d4science_hub.catalog import ResourceCatalog
+from d4science_hub.registry import ServerOption, VolumeOption, from_state, to_state
+
+VERSION_KEY = "d4science_version"
+VERSION = 2
+# replaced by the version 2 entries
+V1_KEYS = ("permissions", "resources")
+
+
+def pack(permissions, roles, catalog):
+    """Returns the auth_state entries for the given permissions, roles and
+    ResourceCatalog of the context"""
+    return {
+        VERSION_KEY: VERSION,
+        "allowed_profiles": [claim["rsname"] for claim in permissions],
+        "roles": roles,
+        "server_options": [to_state(o) for o in catalog.options_for_roles(roles)],
+        "volume_options": [to_state(v) for v in catalog.volume_options],
+    }
+
+
+def version(auth_state):
+    return auth_state.get(VERSION_KEY, 1)
+
+
+def allowed_profiles(auth_state):
+    """Returns the list of profiles (AuthId) the user is allowed to use"""
+    if version(auth_state) == 1:
+        return [claim["rsname"] for claim in auth_state.get("permissions", [])]
+    return auth_state.get("allowed_profiles", [])
+
+
+def needs_update(auth_state, permissions, roles):
+    """Whether the auth_state has to be packed again as the permissions or
+    roles of the user changed (or it uses an old version)"""
+    return (
+        version(auth_state) != VERSION
+        or allowed_profiles(auth_state) != [claim["rsname"] for claim in permissions]
+        or auth_state.get("roles") != roles
+    )
+
+
+def load_catalog(auth_state):
+    """Returns the (shared) ResourceCatalog with the options stored in the
+    auth_state, or None for version 1 auth_states that need to be processed
+    from the raw document"""
+    if version(auth_state) == 1:
+        return None
+    return ResourceCatalog.intern(
+        [from_state(ServerOption, o) for o in auth_state.get("server_options", [])],
+        [from_state(VolumeOption, v) for v in auth_state.get("volume_options", [])],
+    )
@@ -1,18 +1,34 @@
 """D4Science Authenticator for JupyterHub"""
 
+import asyncio
 import base64
+import functools
 import json
 import os
+import xml.etree.ElementTree as ET
 from urllib.parse import quote_plus, unquote, urlencode
 
 import jwt
-import xmltodict
-from jupyterhub.utils import url_path_join
 from oauthenticator.generic import GenericOAuthenticator
-from oauthenticator.oauth2 import OAuthLoginHandler
+from oauthenticator.oauth2 import (
+    OAuthLoginHandler,
+    _deserialize_state,
+    _serialize_state,
+)
 from tornado import web
-from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
-from traitlets import Unicode
+from tornado.httpclient import HTTPError, HTTPRequest
+from tornado.ioloop import IOLoop
+from traitlets import Bool, CaselessStrEnum, Dict, Float, Integer, Unicode
+
+from d4science_hub import auth_state as d4science_auth_state
+from d4science_hub import metrics, tracing
+from d4science_hub.cache import SingleFlight
+from d4science_hub.catalog import CatalogCache, ResourceCatalog
+from d4science_hub.httpclient import UpstreamClient, make_http_client
+from d4science_hub.jwks import JWKSKeyStore
+from d4science_hub.pipeline import Pipeline
+from d4science_hub.registry import RegistryParser
+from d4science_hub.tokens import TokenCache
 
 D4SCIENCE_REGISTRY_BASE_URL = os.environ.get(
     "D4SCIENCE_REGISTRY_BASE_URL",
@@ -35,25 +51,27 @@ D4SCIENCE_DISCOVER_WPS = os.environ.get(
 )
 
 
+# params of the login kept in the OAuth state
+D4SCIENCE_STATE_KEY = "d4science"
+D4SCIENCE_PARAMS = ("context", "namespace", "label")
+
+
 class D4ScienceContextHandler(OAuthLoginHandler):
-    """manages the params for the authenticator"""
+    """manages the params for the authenticator
+
+    The params are stored in the (signed) OAuth state cookie of the login,
+    so the callback of every login gets its own params"""
 
-    def get(self):
-        context = self.get_argument("context", None)
-        namespace = self.get_argument("namespace", None)
-        label = self.get_argument("label", None)
-        self.authenticator.d4science_context = context
-        self.authenticator.d4science_namespace = namespace
-        self.authenticator.d4science_label = label
-        return super().get()
+    def set_state_cookie(self, state_cookie_value):
+        state = _deserialize_state(state_cookie_value)
+        state[D4SCIENCE_STATE_KEY] = {
+            param: self.get_argument(param, None) for param in D4SCIENCE_PARAMS
+        }
+        super().set_state_cookie(_serialize_state(state))
 
 
 class D4ScienceOauthenticator(GenericOAuthenticator):
     login_handler = D4ScienceContextHandler
-    # some options that will come from the context handler
-    d4science_context = None
-    d4science_namespace = None
-    d4science_label = None
 
     d4science_oidc_url = Unicode(
         D4SCIENCE_OIDC_URL,
@@ -80,38 +98,228 @@ class D4ScienceOauthenticator(GenericOAuthenticator):
                 as param)""",
     )
 
-    _pubkeys = None
+    jwks_cache_ttl = Integer(
+        3600,
+        config=True,
+        help="""Seconds to keep the OIDC public keys when the JWKS response
+                does not include a Cache-Control max-age""",
+    )
+    jwks_refresh_interval = Integer(
+        30,
+        config=True,
+        help="""Minimum seconds between JWKS fetches, applies to the refreshes
+                triggered by tokens signed with an unknown key""",
+    )
+    jwks_prefetch = Bool(
+        False,
+        config=True,
+        help="""Whether to fetch the OIDC public keys at hub startup""",
+    )
+
+    login_step_timeout = Float(
+        30,
+        config=True,
+        help="""Timeout (in seconds) for each of the requests done at login
+                (UMA tokens and Information System)""",
+    )
+    login_step_timeouts = Dict(
+        {},
+        config=True,
+        help="""Timeouts (in seconds) for specific login steps, overriding
+                login_step_timeout. Steps are: uma_client, uma_context and
+                is_resources""",
+    )
+
+    discover_wps = Bool(
+        D4SCIENCE_DISCOVER_WPS.lower() in ["true", "1"],
+        config=True,
+        help="""Whether to discover the DataMiner (WPS) endpoint of the
+                context and pass it as DATAMINER_URL to the servers. The
+                endpoint is looked up in the background after the login and
+                cached per context""",
+    )
+    wps_cache_ttl = Integer(
+        3600,
+        config=True,
+        help="""Seconds to reuse the DataMiner endpoint of a context before
+                looking it up again (in the background while it is used)""",
+    )
+    wps_cache_stale_if_error = Integer(
+        86400,
+        config=True,
+        help="""Seconds after wps_cache_ttl expires where the cached DataMiner
+                endpoint is used if the registry is down or slow""",
+    )
+    wps_cache_revalidate_timeout = Float(
+        5,
+        config=True,
+        help="""Seconds to wait for the registry when looking up a cached
+                DataMiner endpoint again before using the (stale) cached one""",
+    )
+    wps_spawn_timeout = Float(
+        5,
+        config=True,
+        help="""Seconds to wait at spawn for the DataMiner endpoint when it
+                is not cached yet, the server starts without DATAMINER_URL
+                after that""",
+    )
+
+    is_cache_ttl = Integer(
+        300,
+        config=True,
+        help="""Seconds to reuse the resources obtained from the Information
+                System for a context before checking them again""",
+    )
+    is_cache_stale_while_revalidate = Integer(
+        600,
+        config=True,
+        help="""Seconds after is_cache_ttl expires where the cached resources
+                are still used while they are refreshed in the background""",
+    )
+    is_cache_stale_if_error = Integer(
+        86400,
+        config=True,
+        help="""Seconds after is_cache_ttl expires where the cached resources
+                are used if the Information System is down or slow""",
+    )
+    is_cache_revalidate_timeout = Float(
+        5,
+        config=True,
+        help="""Seconds to wait for the Information System before using
+                the (stale) cached resources""",
+    )
+
+    http_client_class = CaselessStrEnum(
+        ["simple", "curl"],
+        "simple",
+        config=True,
+        help="""HTTP client to use for the requests to Keycloak and the
+                Information System: simple (tornado) or curl (needs pycurl,
+                keeps connections alive)""",
+    )
+    http_max_clients = Integer(
+        50,
+        config=True,
+        help="""Maximum number of concurrent requests to the upstreams""",
+    )
+    http_connect_timeout = Float(
+        10,
+        config=True,
+        help="""Default connection timeout (in seconds) for the upstreams""",
+    )
+    http_request_timeout = Float(
+        20,
+        config=True,
+        help="""Default request timeout (in seconds) for the upstreams""",
+    )
+    http_upstream_timeouts = Dict(
+        {},
+        config=True,
+        help="""Timeouts for specific upstreams (oidc, token, is, dataminer) as a
+                dict of upstream to a dict with connect_timeout and/or
+                request_timeout. E.g. {"is": {"request_timeout": 60}}""",
+    )
+    http_retries = Integer(
+        2,
+        config=True,
+        help="""Number of retries of the idempotent (GET) requests that fail
+                with connection errors, timeouts or 502/503/504""",
+    )
+    http_retry_backoff = Float(
+        0.2,
+        config=True,
+        help="""Base delay (in seconds) between retries, doubled in every
+                retry and randomly jittered""",
+    )
+    circuit_breaker_threshold = Integer(
+        5,
+        config=True,
+        help="""Number of consecutive failures of an upstream before failing
+                fast the requests to it""",
+    )
+    circuit_breaker_reset_timeout = Float(
+        30,
+        config=True,
+        help="""Seconds to wait before trying again an upstream that is
+                failing""",
+    )
+
+    uma_token_skew = Integer(
+        60,
+        config=True,
+        help="""Seconds before their expiry when the cached UMA tokens are
+                considered expired""",
+    )
+    uma_refresh_ahead = Integer(
+        300,
+        config=True,
+        help="""Seconds before the expiry of the context token when
+                refresh_user starts refreshing the tokens in the background""",
+    )
+    uma_token_cache_size = Integer(
+        10000,
+        config=True,
+        help="""Maximum number of UMA tokens to keep in memory""",
+    )
+
+    _upstream_client = None
+    _key_store = None
+    _catalog_cache = None
+    _wps_cache = None
+    _token_cache = None
+    _refreshes = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        tracing.setup(self.config)
+        if self.jwks_prefetch:
+            IOLoop.current().add_callback(self.key_store.prefetch)
+
+    @property
+    def upstream_client(self):
+        if self._upstream_client is None:
+            self._upstream_client = UpstreamClient(
+                make_http_client(
+                    self.http_client_class, self.http_max_clients, log=self.log
+                ),
+                connect_timeout=self.http_connect_timeout,
+                request_timeout=self.http_request_timeout,
+                timeouts=self.http_upstream_timeouts,
+                retries=self.http_retries,
+                retry_backoff=self.http_retry_backoff,
+                failure_threshold=self.circuit_breaker_threshold,
+                reset_timeout=self.circuit_breaker_reset_timeout,
+                log=self.log,
+            )
+        return self._upstream_client
+
+    async def _fetch_url(self, url):
+        upstream = "discovery" if url == self.key_store.discovery_url else "jwks"
+        with metrics.track_upstream(upstream):
+            resp = await self.upstream_client.fetch("oidc", url)
+            metrics.observe_response_size(upstream, None, len(resp.body))
+        return resp
+
+    @property
+    def key_store(self):
+        if self._key_store is None:
+            self._key_store = JWKSKeyStore(
+                self.d4science_oidc_url,
+                self._fetch_url,
+                ttl=self.jwks_cache_ttl,
+                refresh_interval=self.jwks_refresh_interval,
+                log=self.log,
+            )
+            metrics.CACHE_STATS.add("jwks", self._key_store.stats)
+        return self._key_store
 
     async def get_iam_public_keys(self):
-        if self._pubkeys:
-            return self._pubkeys
-        discovery_url = url_path_join(
-            self.d4science_oidc_url, ".well-known/openid-configuration"
-        )
-        self.log.debug("Getting OIDC discovery info at %s", discovery_url)
-        http_client = AsyncHTTPClient()
-        req = HTTPRequest(discovery_url, method="GET")
-        try:
-            resp = await http_client.fetch(req)
-        except HTTPError as e:
-            # whatever, get out
-            self.log.warning("Discovery endpoint not working? %s", e)
-            raise web.HTTPError(403)
-        jwks_uri = json.loads(resp.body.decode("utf8", "replace"))["jwks_uri"]
-        self.log.debug("Getting JWKS info at %s", jwks_uri)
-        req = HTTPRequest(jwks_uri, method="GET")
         try:
-            resp = await http_client.fetch(req)
+            return await self.key_store.get_keys()
         except HTTPError as e:
             # whatever, get out
             self.log.warning("Unable to get jwks info: %s", e)
             raise web.HTTPError(403)
-        self._pubkeys = {}
-        jwks_keys = json.loads(resp.body.decode("utf8", "replace"))["keys"]
-        for jwk in jwks_keys:
-            kid = jwk["kid"]
-            self._pubkeys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
-        return self._pubkeys
 
     async def get_uma_token(self, context, audience, access_token, extra_params={}):
         body = {
@@ -120,7 +328,6 @@ class D4ScienceOauthenticator(GenericOAuthenticator):
             "audience": audience,
         }
         body.update(extra_params)
-        http_client = AsyncHTTPClient()
         req = HTTPRequest(
             self.token_url,
             method="POST",
@@ -130,8 +337,13 @@ class D4ScienceOauthenticator(GenericOAuthenticator):
             },
             body=urlencode(body),
         )
+        upstream = "uma_client" if audience == self.client_id else "uma_context"
         try:
-            resp = await http_client.fetch(req)
+            with metrics.track_upstream(upstream, unquote(context)):
+                resp = await self.upstream_client.fetch("token", req)
+                metrics.observe_response_size(
+                    upstream, unquote(context), len(resp.body)
+                )
         except HTTPError as e:
             # whatever, get out
             self.log.warning("Unable to get the permission for user: %s", e)
@@ -139,7 +351,14 @@ class D4ScienceOauthenticator(GenericOAuthenticator):
         self.log.debug("Got UMA ticket from server...")
         token = json.loads(resp.body.decode("utf8", "replace"))["access_token"]
         kid = jwt.get_unverified_header(token)["kid"]
-        key = (await self.get_iam_public_keys())[kid]
+        try:
+            key = await self.key_store.get_key(kid)
+        except HTTPError as e:
+            self.log.warning("Unable to get jwks info: %s", e)
+            raise web.HTTPError(403)
+        except KeyError:
+            self.log.warning("Token signed with unknown key %s", kid)
+            raise web.HTTPError(403)
         decoded_token = jwt.decode(
             token,
             key=key,
@@ -149,112 +368,378 @@ class D4ScienceOauthenticator(GenericOAuthenticator):
         self.log.debug("Decoded token: %s", decoded_token)
         return token, decoded_token
 
-    async def get_wps(self, access_token):
-        # discover WPS if enabled
-        wps_endpoint = {}
-        if D4SCIENCE_DISCOVER_WPS.lower() in ["true", "1"]:
-            http_client = AsyncHTTPClient()
-            req = HTTPRequest(
+    @property
+    def token_cache(self):
+        if self._token_cache is None:
+            self._token_cache = TokenCache(
+                skew=self.uma_token_skew, max_size=self.uma_token_cache_size
+            )
+            metrics.CACHE_STATS.add("uma_tokens", self._token_cache.stats)
+        return self._token_cache
+
+    async def get_cached_uma_token(
+        self, username, context, audience, access_token, extra_params={}, force=False
+    ):
+        """Same as get_uma_token but reusing the tokens of the user for the
+        context and audience until they expire"""
+        return await self.token_cache.fetch(
+            (username, context, audience),
+            lambda: self.get_uma_token(context, audience, access_token, extra_params),
+            force=force,
+        )
+
+    def _client_claims(self, context):
+        return {
+            "claim_token": base64.b64encode(
+                json.dumps({"context": [f"{context}"]}).encode("utf-8")
+            )
+        }
+
+    def _get_roles(self, context, decoded_ws_token):
+        return (
+            decoded_ws_token.get("resource_access", {})
+            .get(context, {})
+            .get("roles", [])
+        )
+
+    @property
+    def wps_cache(self):
+        if self._wps_cache is None:
+            self._wps_cache = CatalogCache(
+                ttl=self.wps_cache_ttl,
+                stale_while_revalidate=self.wps_cache_ttl,
+                stale_if_error=self.wps_cache_stale_if_error,
+                revalidate_timeout=self.wps_cache_revalidate_timeout,
+                log=self.log,
+            )
+            metrics.CACHE_STATS.add("wps", self._wps_cache.stats)
+        return self._wps_cache
+
+    async def _fetch_wps(self, access_token, context, headers):
+        parsers = []
+        headers.update({"Authorization": f"Bearer {access_token}"})
+
+        def make_request():
+            parsers.append(RegistryParser())
+            return HTTPRequest(
                 self.dm_infosys_url,
                 method="GET",
-                headers={
-                    "Authorization": f"Bearer {access_token}",
-                },
+                headers=headers,
+                streaming_callback=parsers[-1].feed,
             )
-            try:
-                resp = await http_client.fetch(req)
-            except HTTPError as e:
-                self.log.warning("Unable to get the resources for user: %s", e)
-                self.log.debug(req)
-                # no need to fail here
-                return wps_endpoint
-            self.log.debug(resp.body)
-            dm = xmltodict.parse(resp.body)
-            try:
-                for ap in dm["serviceEndpoints"]["Resource"]["Profile"]["AccessPoint"]:
-                    if ap["Interface"]["Endpoint"]["@EntryName"] == "Cluster":
-                        wps_endpoint = {
-                            "D4SCIENCE_WPS_URL": ap["Interface"]["Endpoint"]["#text"]
-                        }
-            except KeyError as e:
-                # unexpected xml, just keep going
-                self.log.warning("Unexpected XML: %s", e)
-                self.log.debug(dm)
+
+        context = unquote(context or "")
+        with metrics.track_upstream("wps", context):
+            resp = await self.upstream_client.fetch(
+                "dataminer", make_request, raise_error=False
+            )
+            if resp.code == 304:
+                return None, resp.headers
+            resp.rethrow()
+            metrics.observe_response_size("wps", context, parsers[-1].size)
+        dm = parsers[-1].close()
+        self.log.debug(dm)
+        # empty if there is no endpoint, so it's cached too
+        return dm.endpoint("Cluster") or "", resp.headers
+
+    async def get_wps(self, access_token, context=None):
+        """Returns the DataMiner (WPS) endpoint of the context as a dict with
+        D4SCIENCE_WPS_URL, empty if not found or not enabled
+
+        The endpoint is the same for every user of a context, so it is cached
+        per context"""
+        wps_endpoint = {}
+        if not self.discover_wps:
+            return wps_endpoint
+        try:
+            url = await self.wps_cache.get(
+                context or self.dm_infosys_url,
+                functools.partial(self._fetch_wps, access_token, context),
+            )
+        except HTTPError as e:
+            self.log.warning("Unable to get the resources for user: %s", e)
+            # no need to fail here
+            return wps_endpoint
+        except ET.ParseError as e:
+            # unexpected xml, just keep going
+            self.log.warning("Unexpected XML: %s", e)
+            return wps_endpoint
+        if url:
+            wps_endpoint = {"D4SCIENCE_WPS_URL": url}
         return wps_endpoint
 
-    async def get_resources(self, access_token):
-        http_client = AsyncHTTPClient()
-        req = HTTPRequest(
-            self.jupyterhub_infosys_url,
-            method="GET",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-            },
+    @property
+    def catalog_cache(self):
+        if self._catalog_cache is None:
+            self._catalog_cache = CatalogCache(
+                ttl=self.is_cache_ttl,
+                stale_while_revalidate=self.is_cache_stale_while_revalidate,
+                stale_if_error=self.is_cache_stale_if_error,
+                revalidate_timeout=self.is_cache_revalidate_timeout,
+                log=self.log,
+            )
+            metrics.CACHE_STATS.add("is_resources", self._catalog_cache.stats)
+        return self._catalog_cache
+
+    async def _fetch_resources(self, access_token, context, headers):
+        parsers = []
+        headers.update({"Authorization": f"Bearer {access_token}"})
+
+        def make_request():
+            parsers.append(RegistryParser())
+            return HTTPRequest(
+                self.jupyterhub_infosys_url,
+                method="GET",
+                headers=headers,
+                streaming_callback=parsers[-1].feed,
+            )
+
+        context = unquote(context or "")
+        with metrics.track_upstream("is_resources", context):
+            resp = await self.upstream_client.fetch(
+                "is", make_request, raise_error=False
+            )
+            if resp.code == 304:
+                return None, resp.headers
+            resp.rethrow()
+            metrics.observe_response_size("is_resources", context, parsers[-1].size)
+        resources = parsers[-1].close()
+        catalog = ResourceCatalog.intern(
+            resources.server_options, resources.volume_options
         )
+        return catalog, resp.headers
+
+    async def get_resources(self, access_token, context=None):
+        """Returns the ResourceCatalog of JupyterHub resources from the
+        Information System
+
+        Resources are the same for every user of a context, so they are cached
+        per context"""
         try:
-            resp = await http_client.fetch(req)
-        except HTTPError as e:
+            resources = await self.catalog_cache.get(
+                context or self.jupyterhub_infosys_url,
+                functools.partial(self._fetch_resources, access_token, context),
+            )
+        except (HTTPError, ET.ParseError) as e:
             # whatever, get out
             self.log.warning("Unable to get the resources for user: %s", e)
-            self.log.debug(req)
             raise web.HTTPError(403)
         self.log.debug("Got resources description...")
-        # Assume that this will fly
-        return xmltodict.parse(resp.body)
+        return resources
 
-    def _get_d4science_attr(self, attr_name):
-        v = getattr(self, attr_name, None)
-        if v:
-            return quote_plus(v)
-        return None
+    def get_d4science_params(self, handler):
+        """Returns the (quoted) context, namespace and label of the login
+        from the OAuth state cookie of the callback handler"""
+        state_cookie = handler.get_state_cookie() if handler else None
+        state = _deserialize_state(state_cookie) if state_cookie else {}
+        params = state.get(D4SCIENCE_STATE_KEY, None) or {}
+        return {
+            param: quote_plus(params[param]) if params.get(param) else None
+            for param in D4SCIENCE_PARAMS
+        }
 
+    @tracing.traced("authenticate")
     async def authenticate(self, handler, data=None):
         # first get authorized upstream
         user_data = await super().authenticate(handler, data)
-        context = self._get_d4science_attr("d4science_context")
+        d4science_params = self.get_d4science_params(handler)
+        context = d4science_params["context"]
+        tracing.annotate(user=user_data["name"], context=unquote(context or ""))
         self.log.debug("Context is %s", context)
         if not context:
             self.log.error("Unable to get the user context")
             raise web.HTTPError(403)
         access_token = user_data["auth_state"]["access_token"]
-        extra_params = {
-            "claim_token": base64.b64encode(
-                json.dumps({"context": [f"{context}"]}).encode("utf-8")
-            )
-        }
-        token, decoded_token = await self.get_uma_token(
-            context, self.client_id, access_token, extra_params
+        username = user_data["name"]
+        pipeline = Pipeline(
+            "Login of %s" % user_data["name"],
+            timeout=self.login_step_timeout,
+            timeouts=self.login_step_timeouts,
+            log=self.log,
         )
-        ws_token, decoded_ws_token = await self.get_uma_token(
-            context, context, access_token
+        pipeline.add(
+            "uma_client",
+            lambda: self.get_cached_uma_token(
+                username,
+                context,
+                self.client_id,
+                access_token,
+                self._client_claims(context),
+                force=True,
+            ),
         )
+        pipeline.add(
+            "uma_context",
+            lambda: self.get_cached_uma_token(
+                username, context, context, access_token, force=True
+            ),
+        )
+        pipeline.add(
+            "is_resources",
+            lambda uma_context: self.get_resources(uma_context[0], context),
+            requires=["uma_context"],
+        )
+        try:
+            results = await pipeline.run()
+        except asyncio.TimeoutError:
+            self.log.warning("Timeout while getting user information")
+            raise web.HTTPError(403)
+        token, decoded_token = results["uma_client"]
+        ws_token, decoded_ws_token = results["uma_context"]
         permissions = decoded_token["authorization"]["permissions"]
         self.log.debug("Permissions: %s", permissions)
-        roles = (
-            decoded_ws_token.get("resource_access", {})
-            .get(context, {})
-            .get("roles", [])
-        )
+        roles = self._get_roles(context, decoded_ws_token)
         self.log.debug("Roles: %s", roles)
-        resources = await self.get_resources(ws_token)
+        resources = results["is_resources"]
         self.log.debug("Resources: %s", resources)
         user_data["auth_state"].update(
             {
                 "context_token": ws_token,
-                "permissions": permissions,
                 "context": context,
-                "namespace": self._get_d4science_attr("d4science_namespace"),
-                "label": self._get_d4science_attr("d4science_label"),
-                "resources": resources,
-                "roles": roles,
+                "namespace": d4science_params["namespace"],
+                "label": d4science_params["label"],
             }
         )
-        # get WPS endpoint in also
-        user_data["auth_state"].update(await self.get_wps(ws_token))
+        user_data["auth_state"].update(
+            d4science_auth_state.pack(permissions, roles, resources)
+        )
+        if self.discover_wps and context not in self.wps_cache:
+            # not needed for the login, warm the cache for the spawn
+            IOLoop.current().add_callback(self.get_wps, ws_token, context)
         return user_data
 
+    async def refresh_user(self, user, handler=None, **kwargs):
+        """Refreshes the D4Science tokens of the user
+
+        The context token is reused until it is about to expire: within
+        uma_refresh_ahead seconds of its expiry the tokens are refreshed in
+        the background, once expired they are refreshed before returning.
+        The auth_state is only updated when the context token, the OAuth
+        tokens or the permissions or roles of the user changed.
+        """
+        auth_state = await user.get_auth_state()
+        if not auth_state or "context" not in auth_state:
+            return await super().refresh_user(user, handler, **kwargs)
+        if self._refreshes is None:
+            self._refreshes = SingleFlight()
+        context = auth_state["context"]
+        key = (user.name, context, context)
+        if key not in self.token_cache and auth_state.get("context_token"):
+            # e.g. after a restart, the token was verified when stored
+            self.token_cache.put(key, auth_state["context_token"])
+        expires_in = self.token_cache.expires_in(key)
+        if expires_in is not None and expires_in > 0:
+            if expires_in < self.uma_refresh_ahead and user.name not in self._refreshes:
+                self.log.debug("Refreshing tokens of %s in background", user.name)
+                IOLoop.current().add_callback(self._background_refresh, user)
+            return True
+        return await self._refreshes.run(
+            user.name, self._refresh_d4science, user, auth_state, handler
+        )
+
+    async def _refresh_and_save(self, user, auth_state):
+        if self._refreshes is None:
+            self._refreshes = SingleFlight()
+        auth_model = await self._refreshes.run(
+            user.name, self._refresh_d4science, user, auth_state
+        )
+        if isinstance(auth_model, dict):
+            await user.save_auth_state(auth_model["auth_state"])
+
+    async def _background_refresh(self, user):
+        try:
+            await self._refresh_and_save(user, await user.get_auth_state())
+        except Exception as e:
+            self.log.warning("Unable to refresh tokens of %s: %s", user.name, e)
+
+    async def get_context_token(self, user, min_ttl=0):
+        """Returns the context token of the user, refreshing it if it is
+        valid for less than min_ttl seconds (None if there is no valid
+        token)"""
+        auth_state = await user.get_auth_state()
+        if not auth_state or "context" not in auth_state:
+            return None
+        context = auth_state["context"]
+        key = (user.name, context, context)
+        if key not in self.token_cache and auth_state.get("context_token"):
+            self.token_cache.put(key, auth_state["context_token"])
+        expires_in = self.token_cache.expires_in(key)
+        if expires_in is None or expires_in <= min_ttl:
+            await self._refresh_and_save(user, auth_state)
+        cached = self.token_cache.get(key)
+        return cached[0] if cached else None
+
+    async def _get_uma_tokens(self, username, context, access_token):
+        return await asyncio.gather(
+            self.get_cached_uma_token(
+                username,
+                context,
+                self.client_id,
+                access_token,
+                self._client_claims(context),
+                force=True,
+            ),
+            self.get_cached_uma_token(
+                username, context, context, access_token, force=True
+            ),
+        )
+
+    async def _refresh_d4science(self, user, auth_state, handler=None):
+        context = auth_state["context"]
+        new_state = {}
+        try:
+            tokens = await self._get_uma_tokens(
+                user.name, context, auth_state["access_token"]
+            )
+        except web.HTTPError as e:
+            # assume the access token expired
+            refresh_token = auth_state.get("refresh_token", None)
+            if not refresh_token:
+                self.log.info("Unable to refresh %s: %s", user.name, e)
+                return False
+            self.log.info("Refreshing oauth access token for %s", user.name)
+            try:
+                token_info = await self.get_token_info(
+                    handler, self.build_refresh_token_request_params(refresh_token)
+                )
+                if not token_info.get("refresh_token"):
+                    token_info["refresh_token"] = refresh_token
+                tokens = await self._get_uma_tokens(
+                    user.name, context, token_info["access_token"]
+                )
+            except Exception as e:
+                self.log.info("Unable to refresh %s: %s", user.name, e)
+                return False
+            new_state.update(
+                {
+                    "access_token": token_info["access_token"],
+                    "refresh_token": token_info["refresh_token"],
+                    "id_token": token_info.get("id_token", None),
+                    "token_response": token_info,
+                }
+            )
+        (token, decoded_token), (ws_token, decoded_ws_token) = tokens
+        permissions = decoded_token["authorization"]["permissions"]
+        roles = self._get_roles(context, decoded_ws_token)
+        if d4science_auth_state.needs_update(auth_state, permissions, roles):
+            self.log.info("Permissions of %s changed", user.name)
+            resources = await self.get_resources(ws_token, context)
+            new_state.update(d4science_auth_state.pack(permissions, roles, resources))
+        if ws_token != auth_state.get("context_token"):
+            # seeds the token cache after a restart
+            new_state["context_token"] = ws_token
+        if not new_state:
+            return True
+        state = dict(auth_state, **new_state)
+        if d4science_auth_state.version(auth_state) < d4science_auth_state.VERSION:
+            for key in d4science_auth_state.V1_KEYS:
+                state.pop(key, None)
+        return {"name": user.name, "auth_state": state}
+
+    @tracing.traced("pre_spawn_start")
     async def pre_spawn_start(self, user, spawner):
         """Pass relevant variables to spawner via environment variable"""
+        tracing.annotate(user=user.name, server=spawner.name)
         auth_state = await user.get_auth_state()
         if not auth_state:
             # auth_state not enabled
@@ -265,11 +750,25 @@ class D4ScienceOauthenticator(GenericOAuthenticator):
         label = auth_state.get("label", None)
         if label:
             spawner.extra_labels[self.d4science_label_name] = label
+        # the cached token is newer when auth_state was not updated
+        context = auth_state["context"]
+        cached = self.token_cache.get((user.name, context, context))
+        context_token = cached[0] if cached else auth_state["context_token"]
         # GCUBE_TOKEN should be removed in the future
-        spawner.environment["GCUBE_TOKEN"] = auth_state["context_token"]
-        spawner.environment["D4SCIENCE_TOKEN"] = auth_state["context_token"]
+        spawner.environment["GCUBE_TOKEN"] = context_token
+        spawner.environment["D4SCIENCE_TOKEN"] = context_token
         # GCUBE_CONTEXT should be removed in the future
         spawner.environment["GCUBE_CONTEXT"] = unquote(auth_state["context"])
         spawner.environment["D4SCIENCE_CONTEXT"] = unquote(auth_state["context"])
-        if "D4SCIENCE_WPS_URL" in auth_state:
-            spawner.environment["DATAMINER_URL"] = auth_state["D4SCIENCE_WPS_URL"]
+        # older logins kept the endpoint in the auth_state
+        wps_url = auth_state.get("D4SCIENCE_WPS_URL", None)
+        if self.discover_wps:
+            try:
+                wps_endpoint = await asyncio.wait_for(
+                    self.get_wps(context_token, context), self.wps_spawn_timeout
+                )
+                wps_url = wps_endpoint.get("D4SCIENCE_WPS_URL", wps_url)
+            except asyncio.TimeoutError:
+                self.log.warning("Timeout while getting the DataMiner endpoint")
+        if wps_url:
+            spawner.environment["DATAMINER_URL"] = wps_url
@@ -0,0 +1,57 @@
+"""Caching helpers shared by the D4Science hub components"""
+
+import asyncio
+
+
+def cache_max_age(headers, default):
+    """Returns the max-age (in seconds) announced in a Cache-Control header
+
+    no-cache and no-store are considered as a max-age of 0, while a missing or
+    unparseable header returns the default value"""
+    cache_control = headers.get("Cache-Control", "") if headers else ""
+    directives = [d.strip().lower() for d in cache_control.split(",")]
+    if "no-cache" in directives or "no-store" in directives:
+        return 0
+    for directive in directives:
+        if directive.startswith("max-age="):
+            try:
+                return max(0, int(directive.split("=", 1)[1].strip('"')))
+            except ValueError:
+                break
+    return default
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into a single execution
+
+    The first caller for a key starts the call, any other caller arriving while
+    it is still running waits for that same result (or exception). Callers
+    being cancelled do not cancel the shared call."""
+
+    def __init__(self):
+        self._calls = {}
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _done(self, key, fut):
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        if not fut.cancelled():
+            # mark the exception as retrieved even if every caller went away
+            fut.exception()
+
+    def start(self, key, func, *args, **kwargs):
+        """Starts the call for key (unless already running) and returns its future"""
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._done(key, f))
+        return fut
+
+    async def run(self, key, func, *args, **kwargs):
+        return await asyncio.shield(self.start(key, func, *args, **kwargs))
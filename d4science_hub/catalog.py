@@ -0,0 +1,233 @@
+"""Shared cache of the D4Science Information System catalog"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import time
+import types
+import weakref
+
+from d4science_hub import tracing
+from d4science_hub.cache import SingleFlight
+from d4science_hub.registry import to_state
+
+
+class CatalogEntry:
+    __slots__ = ("value", "etag", "last_modified", "fetched_at")
+
+    def __init__(self, value, etag, last_modified, fetched_at):
+        self.value = value
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+
+class CatalogCache:
+    """Cache of Information System documents, keyed by VRE context
+
+    - entries younger than `ttl` are served directly
+    - entries younger than `ttl + stale_while_revalidate` are served while
+      they are revalidated in the background
+    - older entries are revalidated (using ETag / Last-Modified) before
+      being served, if the revalidation fails or takes more than
+      `revalidate_timeout` seconds, entries younger than
+      `ttl + stale_if_error` are served as last known good values
+
+    Concurrent revalidations of the same key are coalesced.
+
+    `fetch` is a coroutine getting a dict of extra request headers and
+    returning a tuple with the value to cache (None if the upstream answered
+    with 304 Not Modified) and the response headers.
+    """
+
+    def __init__(
+        self,
+        ttl=300,
+        stale_while_revalidate=600,
+        stale_if_error=86400,
+        revalidate_timeout=5,
+        log=None,
+    ):
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.revalidate_timeout = revalidate_timeout
+        self.log = log or logging.getLogger(__name__)
+        self.stats = collections.Counter()
+        self._entries = {}
+        self._flight = SingleFlight()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def items(self):
+        """Returns the cached (key, value) pairs"""
+        return [(key, entry.value) for key, entry in self._entries.items()]
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    async def _revalidate(self, key, fetch):
+        entry = self._entries.get(key)
+        headers = {}
+        if entry:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        value, resp_headers = await fetch(headers)
+        now = time.monotonic()
+        if value is None and entry:
+            self.log.debug("Catalog for %s not modified", key)
+            self.stats["not_modified"] += 1
+            entry.fetched_at = now
+            return entry.value
+        self._entries[key] = CatalogEntry(
+            value,
+            resp_headers.get("ETag", None),
+            resp_headers.get("Last-Modified", None),
+            now,
+        )
+        return value
+
+    async def _background_revalidate(self, key, fetch):
+        try:
+            return await self._revalidate(key, fetch)
+        except Exception as e:
+            self.log.warning("Unable to revalidate catalog for %s: %s", key, e)
+            raise
+
+    async def get(self, key, fetch):
+        entry = self._entries.get(key)
+        if entry:
+            age = time.monotonic() - entry.fetched_at
+            if age < self.ttl:
+                self.stats["hit"] += 1
+                tracing.annotate(catalog_cache="hit")
+                return entry.value
+            if age < self.ttl + self.stale_while_revalidate:
+                self.stats["stale"] += 1
+                tracing.annotate(catalog_cache="stale")
+                self._flight.start(key, self._background_revalidate, key, fetch)
+                return entry.value
+        self.stats["miss"] += 1
+        tracing.annotate(catalog_cache="miss")
+        fut = self._flight.start(key, self._revalidate, key, fetch)
+        if not entry:
+            return await asyncio.shield(fut)
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), self.revalidate_timeout)
+        except Exception as e:
+            age = time.monotonic() - entry.fetched_at
+            if age >= self.ttl + self.stale_if_error:
+                raise
+            self.log.warning("Using last known catalog for %s: %r", key, e)
+            self.stats["stale_if_error"] += 1
+            tracing.annotate(catalog_cache="stale_if_error")
+            return entry.value
+
+
+class ResourceCatalog:
+    """Immutable and indexed set of server and volume options
+
+    Catalogs are interned by content (see `intern`), so every spawner or
+    context with the same options shares the same object. Options are
+    indexed by server option name, AuthId and required role, and volumes by
+    name, so the options a user can see are computed with set operations.
+    """
+
+    __slots__ = (
+        "server_options",
+        "volume_options",
+        "fingerprint",
+        "_by_name",
+        "_by_auth_id",
+        "_by_role",
+        "_volumes",
+        "__weakref__",
+    )
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, server_options=(), volume_options=(), fingerprint=None):
+        self.server_options = tuple(server_options)
+        self.volume_options = tuple(volume_options)
+        self.fingerprint = fingerprint or self.get_fingerprint(
+            self.server_options, self.volume_options
+        )
+        by_name = collections.defaultdict(set)
+        by_auth_id = collections.defaultdict(set)
+        by_role = collections.defaultdict(set)
+        for pos, opt in enumerate(self.server_options):
+            by_name[opt.server_option_name].add(pos)
+            by_auth_id[opt.auth_id].add(pos)
+            by_role[opt.role].add(pos)
+        self._by_name = self._freeze(by_name)
+        self._by_auth_id = self._freeze(by_auth_id)
+        self._by_role = self._freeze(by_role)
+        self._volumes = types.MappingProxyType(
+            {vol.name: vol for vol in self.volume_options}
+        )
+
+    @staticmethod
+    def _freeze(index):
+        return types.MappingProxyType({k: frozenset(v) for k, v in index.items()})
+
+    @staticmethod
+    def get_fingerprint(server_options, volume_options):
+        content = json.dumps(
+            [
+                [to_state(o) for o in server_options],
+                [to_state(v) for v in volume_options],
+            ]
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    @classmethod
+    def intern(cls, server_options=(), volume_options=()):
+        """Returns the shared catalog with the given options"""
+        server_options = tuple(server_options)
+        volume_options = tuple(volume_options)
+        fingerprint = cls.get_fingerprint(server_options, volume_options)
+        catalog = cls._interned.get(fingerprint, None)
+        if catalog is None:
+            catalog = cls(server_options, volume_options, fingerprint)
+            cls._interned[fingerprint] = catalog
+        return catalog
+
+    def __len__(self):
+        return len(self.server_options)
+
+    def _options(self, positions):
+        return tuple(self.server_options[pos] for pos in sorted(positions))
+
+    def _positions_for_roles(self, roles):
+        positions = set(self._by_role.get("", ()))
+        for role in set(roles) & self._by_role.keys():
+            positions |= self._by_role[role]
+        return positions
+
+    def options_for_roles(self, roles):
+        """Returns the options without role or with one of the given roles"""
+        return self._options(self._positions_for_roles(roles))
+
+    def view(self, allowed_profiles, server_option_name=None, roles=None):
+        """Returns the options whose AuthId is in allowed_profiles, optionally
+        restricted to a server option name and to the given roles"""
+        positions = set()
+        for auth_id in set(allowed_profiles) & self._by_auth_id.keys():
+            positions |= self._by_auth_id[auth_id]
+        if server_option_name is not None:
+            positions &= self._by_name.get(server_option_name, frozenset())
+        if roles is not None:
+            positions &= self._positions_for_roles(roles)
+        return self._options(positions)
+
+    def volume(self, name):
+        """Returns the VolumeOption with the given name or None"""
+        return self._volumes.get(name, None)
@@ -0,0 +1,98 @@
+"""Immutable, shared copies of the configuration structures
+
+traitlets deep copies the configured containers (volumes, volume_mappings,
+extra_profiles...) into every spawner and the spawners build the same volume
+and profile dicts for every user of a context. `intern` returns a frozen copy
+of such structures shared by everyone with the same content.
+
+Frozen structures are copy-on-write: `copy` and `copy.deepcopy` (as done by
+KubeSpawner with the profile list) return plain, mutable dicts and lists.
+"""
+
+import copy
+import weakref
+
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError(f"{type(self).__name__} is immutable")
+
+
+class FrozenDict(dict):
+    """dict that cannot be modified"""
+
+    __slots__ = ("__weakref__",)
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def copy(self):
+        return dict(self)
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {k: copy.deepcopy(v, memo) for k, v in self.items()}
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class FrozenList(list):
+    """list that cannot be modified"""
+
+    __slots__ = ("__weakref__",)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+    def copy(self):
+        return list(self)
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return (type(self), (list(self),))
+
+
+_interned = weakref.WeakValueDictionary()
+
+
+def _key(value):
+    """Hashable key of an interned value, telling apart 1, 1.0, True and "1"
+    (interned dicts and lists are shared, so their identity stands for their
+    content and the parent keeps them alive)"""
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return id(value)
+    if isinstance(value, tuple):
+        return (tuple, tuple(_key(v) for v in value))
+    return (type(value), value)
+
+
+def intern(obj):
+    """Returns a frozen copy of obj shared with any other interned object
+    with the same content, nested dicts, lists and tuples are interned too
+    (dicts and lists with unhashable content are frozen but not shared)"""
+    if isinstance(obj, tuple):
+        return tuple(intern(v) for v in obj)
+    if isinstance(obj, dict):
+        items = [(k, intern(v)) for k, v in obj.items()]
+        key = (dict, tuple((_key(k), _key(v)) for k, v in items))
+    elif isinstance(obj, list):
+        items = [intern(v) for v in obj]
+        key = (list, tuple(_key(v) for v in items))
+    else:
+        return obj
+    try:
+        frozen = _interned.get(key, None)
+    except TypeError:
+        key = frozen = None
+    if frozen is None:
+        frozen = FrozenDict(items) if isinstance(obj, dict) else FrozenList(items)
+        if key is not None:
+            _interned[key] = frozen
+    return frozen
@@ -0,0 +1,184 @@
+"""HTTP client layer for the upstream services used by the hub
+
+Wraps a (pooled) tornado AsyncHTTPClient adding per-upstream timeouts,
+jittered retries for idempotent requests and a circuit breaker per upstream
+that fails fast while the upstream is unhealthy.
+"""
+
+import asyncio
+import logging
+import random
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+# upstreams used by the authenticator
+UPSTREAMS = ("oidc", "token", "is", "dataminer")
+
+# codes considered a failure of the upstream (599 is used by tornado
+# for connection errors and timeouts)
+RETRY_CODES = (502, 503, 504, 599)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class CircuitOpenError(HTTPClientError):
+    """Raised when a request is not done as the upstream is unhealthy"""
+
+    def __init__(self, upstream):
+        super().__init__(599, f"Circuit open for upstream {upstream}")
+        self.upstream = upstream
+
+
+class CircuitBreaker:
+    """Tracks the health of an upstream
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    requests fail fast. After `reset_timeout` seconds one request is let
+    through (half-open): if it works the circuit closes, if not it opens
+    again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        # when half-open, only one trial request every reset_timeout
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+def make_http_client(client_class="simple", max_clients=50, log=None):
+    """Returns a new tornado AsyncHTTPClient of the given class
+    (simple or curl) with a pool of max_clients connections"""
+    log = log or logging.getLogger(__name__)
+    if client_class == "curl":
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+
+            return CurlAsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        except ImportError:
+            log.warning("pycurl is not available, using simple HTTP client")
+    return AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+
+
+class UpstreamClient:
+    """Does the requests to the upstreams
+
+    `timeouts` is a dict of upstream -> dict with connect_timeout and/or
+    request_timeout, falling back to the default connect_timeout and
+    request_timeout.
+    """
+
+    def __init__(
+        self,
+        client,
+        connect_timeout=10,
+        request_timeout=20,
+        timeouts=None,
+        retries=2,
+        retry_backoff=0.2,
+        failure_threshold=5,
+        reset_timeout=30,
+        log=None,
+    ):
+        self.client = client
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.timeouts = timeouts or {}
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.log = log or logging.getLogger(__name__)
+        self.breakers = {}
+
+    def breaker(self, upstream):
+        if upstream not in self.breakers:
+            self.breakers[upstream] = CircuitBreaker(
+                upstream, self.failure_threshold, self.reset_timeout
+            )
+        return self.breakers[upstream]
+
+    def _prepare(self, upstream, request):
+        if callable(request):
+            request = request()
+        elif isinstance(request, str):
+            request = HTTPRequest(request)
+        timeouts = self.timeouts.get(upstream, {})
+        request.connect_timeout = timeouts.get("connect_timeout", self.connect_timeout)
+        request.request_timeout = timeouts.get("request_timeout", self.request_timeout)
+        return request
+
+    async def fetch(self, upstream, request, raise_error=True):
+        """Fetches request from the upstream
+
+        request can be an URL, a tornado HTTPRequest or a callable returning
+        a new HTTPRequest for each attempt. Idempotent requests are retried
+        on connection errors, timeouts and 502/503/504 responses unless they
+        have a streaming_callback and are not created by a callable (as the
+        callback would get the body more than once).
+        """
+        breaker = self.breaker(upstream)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(upstream)
+            req = self._prepare(upstream, request)
+            can_retry = (
+                req.method in IDEMPOTENT_METHODS
+                and attempt < self.retries
+                and (callable(request) or req.streaming_callback is None)
+            )
+            try:
+                resp = await self.client.fetch(req, raise_error=False)
+                code = resp.code
+            except HTTPClientError as e:
+                code, resp = e.code, e
+            except OSError as e:
+                code, resp = 599, e
+            if code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if code in RETRY_CODES and can_retry:
+                attempt += 1
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                delay *= random.uniform(0.5, 1.5)
+                self.log.info(
+                    "Retrying request to %s (%s) in %.2fs: %s",
+                    upstream,
+                    req.url,
+                    delay,
+                    code,
+                )
+                await asyncio.sleep(delay)
+                continue
+            if isinstance(resp, Exception):
+                raise resp
+            if raise_error:
+                resp.rethrow()
+            return resp
@@ -0,0 +1,105 @@
+"""Key store for the JWKS published by the D4Science OIDC provider"""
+
+import collections
+import json
+import logging
+import time
+
+import jwt
+from jupyterhub.utils import url_path_join
+
+from d4science_hub import tracing
+from d4science_hub.cache import SingleFlight, cache_max_age
+
+
+class JWKSKeyStore:
+    """Keeps the public keys of the OIDC provider
+
+    Keys are cached for the time announced by the Cache-Control header of the
+    JWKS response (or `ttl` if not announced). Whenever a token is signed
+    with an unknown `kid` the keys are fetched again, but not more often
+    than every `refresh_interval` seconds. Concurrent fetches are coalesced
+    into a single one.
+
+    `fetch` is a coroutine getting an URL and returning a tornado
+    HTTPResponse, errors are propagated to the caller.
+    """
+
+    def __init__(self, oidc_url, fetch, ttl=3600, refresh_interval=30, log=None):
+        self.oidc_url = oidc_url
+        self.fetch = fetch
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.log = log or logging.getLogger(__name__)
+        self._keys = {}
+        self._expires = 0
+        self._last_fetch = None
+        self._jwks_uri = None
+        self._jwks_uri_expires = 0
+        self._flight = SingleFlight()
+        self.stats = collections.Counter()
+
+    @property
+    def discovery_url(self):
+        return url_path_join(self.oidc_url, ".well-known/openid-configuration")
+
+    def _max_age(self, resp):
+        # never go below the refresh interval, even with no-cache
+        return max(cache_max_age(resp.headers, self.ttl), self.refresh_interval)
+
+    async def _get_jwks_uri(self):
+        now = time.monotonic()
+        if self._jwks_uri and now < self._jwks_uri_expires:
+            return self._jwks_uri
+        self.log.debug("Getting OIDC discovery info at %s", self.discovery_url)
+        resp = await self.fetch(self.discovery_url)
+        self._jwks_uri = json.loads(resp.body.decode("utf8", "replace"))["jwks_uri"]
+        self._jwks_uri_expires = now + self._max_age(resp)
+        return self._jwks_uri
+
+    async def _refresh(self):
+        self._last_fetch = time.monotonic()
+        try:
+            jwks_uri = await self._get_jwks_uri()
+            self.log.debug("Getting JWKS info at %s", jwks_uri)
+            resp = await self.fetch(jwks_uri)
+        except Exception as e:
+            if not self._keys:
+                raise
+            # keep using what we have, retry after the refresh interval
+            self.log.warning("Unable to refresh JWKS, using cached keys: %s", e)
+            self._expires = time.monotonic() + self.refresh_interval
+            return self._keys
+        keys = {}
+        for jwk in json.loads(resp.body.decode("utf8", "replace"))["keys"]:
+            keys[jwk["kid"]] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+        self._keys = keys
+        self._expires = time.monotonic() + self._max_age(resp)
+        self.log.debug("Got %d keys from JWKS", len(keys))
+        return keys
+
+    async def get_keys(self, force=False):
+        """Returns the dict of kid -> public key, fetching them if needed"""
+        if self._keys and not force and time.monotonic() < self._expires:
+            self.stats["hit"] += 1
+            tracing.annotate(jwks_cache="hit")
+            return self._keys
+        self.stats["miss"] += 1
+        tracing.annotate(jwks_cache="miss")
+        return await self._flight.run("jwks", self._refresh)
+
+    async def get_key(self, kid):
+        """Returns the key for the given kid, raises KeyError if not found"""
+        keys = await self.get_keys()
+        if kid not in keys:
+            since_last = time.monotonic() - (self._last_fetch or 0)
+            if "jwks" in self._flight or since_last >= self.refresh_interval:
+                self.log.info("Unknown kid %s, refreshing JWKS", kid)
+                keys = await self.get_keys(force=True)
+        return keys[kid]
+
+    async def prefetch(self):
+        try:
+            await self.get_keys()
+        except Exception as e:
+            self.log.warning("Unable to prefetch JWKS: %s", e)
@@ -0,0 +1,121 @@
+"""Prometheus metrics of the D4Science components
+
+Metrics are registered in the default prometheus_client registry, the one
+JupyterHub uses, so they are exposed in the hub /metrics endpoint with the
+same prefix as the JupyterHub metrics (JUPYTERHUB_METRICS_PREFIX).
+
+Upstreams are: discovery, jwks, uma_client, uma_context, is_resources and
+wps. The context label is empty for the upstreams not tied to a VRE.
+
+The spawn queue metrics are labeled with the context (or the namespace) of
+the spawns, see d4science_hub.scheduler.
+"""
+
+import contextlib
+import time
+
+from jupyterhub.metrics import metrics_prefix
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily
+
+from d4science_hub import tracing
+
+UPSTREAM_REQUEST_DURATION_SECONDS = Histogram(
+    "d4science_upstream_request_duration_seconds",
+    "Time taken by the requests to the D4Science upstream services",
+    ["upstream", "context"],
+    namespace=metrics_prefix,
+)
+
+UPSTREAM_REQUEST_ERRORS = Counter(
+    "d4science_upstream_request_errors",
+    "Number of failed requests to the D4Science upstream services",
+    ["upstream", "context"],
+    namespace=metrics_prefix,
+)
+
+UPSTREAM_RESPONSE_SIZE_BYTES = Histogram(
+    "d4science_upstream_response_size_bytes",
+    "Size of the responses of the D4Science upstream services",
+    ["upstream", "context"],
+    buckets=[2**i for i in range(8, 26, 2)] + [float("inf")],
+    namespace=metrics_prefix,
+)
+
+SPAWN_QUEUE_DEPTH = Gauge(
+    "d4science_spawn_queue_depth",
+    "Number of spawns waiting for a start slot",
+    ["context"],
+    namespace=metrics_prefix,
+)
+
+SPAWN_QUEUE_WAIT_SECONDS = Histogram(
+    "d4science_spawn_queue_wait_seconds",
+    "Time spawns waited for a start slot",
+    ["context"],
+    buckets=[0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, float("inf")],
+    namespace=metrics_prefix,
+)
+
+SPAWNS_STARTING = Gauge(
+    "d4science_spawns_starting",
+    "Number of spawns holding a start slot",
+    ["context"],
+    namespace=metrics_prefix,
+)
+
+TOKEN_ROTATIONS = Counter(
+    "d4science_token_rotations",
+    "Number of rotations of the context token of running servers by result",
+    ["result"],
+    namespace=metrics_prefix,
+)
+
+
+class CacheStatsCollector:
+    """Exposes the stats counters of the caches (collections.Counter of
+    result -> count) as a prometheus counter labeled by cache and result"""
+
+    def __init__(self):
+        self.caches = {}
+
+    def add(self, name, stats):
+        self.caches[name] = stats
+
+    def collect(self):
+        family = CounterMetricFamily(
+            f"{metrics_prefix}_d4science_cache_requests",
+            "Number of lookups in the D4Science caches by result",
+            labels=["cache", "result"],
+        )
+        for name, stats in self.caches.items():
+            for result, count in stats.items():
+                family.add_metric([name, result], count)
+        yield family
+
+
+CACHE_STATS = CacheStatsCollector()
+REGISTRY.register(CACHE_STATS)
+
+
+@contextlib.contextmanager
+def track_upstream(upstream, context=None):
+    """Observes the duration (and failure) of the request in the block, also
+    as a span of the current trace"""
+    labels = (upstream, context or "")
+    start = time.perf_counter()
+    try:
+        with tracing.span(f"upstream:{upstream}"):
+            yield
+    except Exception:
+        UPSTREAM_REQUEST_ERRORS.labels(*labels).inc()
+        raise
+    finally:
+        UPSTREAM_REQUEST_DURATION_SECONDS.labels(*labels).observe(
+            time.perf_counter() - start
+        )
+
+
+def observe_response_size(upstream, context, size):
+    tracing.annotate(response_bytes=size)
+    UPSTREAM_RESPONSE_SIZE_BYTES.labels(upstream, context or "").observe(size)
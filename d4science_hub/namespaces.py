@@ -0,0 +1,113 @@
+"""Provisioning of the context namespaces
+
+Every namespace is created (with its quotas, PVCs or any other namespaced
+objects) once per hub and ttl: concurrent spawns in the same namespace wait
+for the same provisioning and later spawns find it in the ready namespaces
+without any call to the Kubernetes API. After ttl seconds (or when it is
+forgotten, e.g. as it was deleted) it is provisioned again, recreating
+what was deleted out of band.
+"""
+
+import asyncio
+import collections
+import copy
+import logging
+import re
+import time
+
+from kubernetes_asyncio.client.rest import ApiException
+
+from d4science_hub.cache import SingleFlight
+
+
+def expand(obj, **values):
+    """Formats every string in obj with values"""
+    if isinstance(obj, str):
+        return obj.format(**values)
+    if isinstance(obj, dict):
+        return {k: expand(v, **values) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [expand(v, **values) for v in obj]
+    return obj
+
+
+def create_method(kind):
+    """Name of the CoreV1Api method creating objects of kind"""
+    return "create_namespaced_" + re.sub(r"(?<!^)(?=[A-Z])", "_", kind).lower()
+
+
+class NamespaceManager:
+    """Creates namespaces and their objects once
+
+    `api` is a kubernetes CoreV1Api. `objects` are manifests (as dicts) of
+    namespaced core objects (e.g. ResourceQuota, LimitRange,
+    PersistentVolumeClaim) to create in every namespace, `{namespace}` is
+    expanded in any of their strings. `ready` maps the provisioned
+    namespaces to the (monotonic) time they are checked again.
+    """
+
+    def __init__(
+        self,
+        api,
+        labels=None,
+        annotations=None,
+        objects=None,
+        request_timeout=3,
+        ttl=300,
+        log=None,
+    ):
+        self.api = api
+        self.labels = labels or {}
+        self.annotations = annotations or {}
+        self.objects = objects or []
+        self.request_timeout = request_timeout
+        self.ttl = ttl
+        self.log = log or logging.getLogger(__name__)
+        self.ready = {}
+        self.stats = collections.Counter()
+        self._flight = SingleFlight()
+
+    async def _create(self, method, *args):
+        try:
+            await asyncio.wait_for(method(*args), self.request_timeout)
+        except ApiException as e:
+            # it's fine if it already exists
+            if e.status != 409:
+                raise
+            return False
+        return True
+
+    async def _provision(self, namespace):
+        body = {
+            "metadata": {
+                "name": namespace,
+                "labels": self.labels,
+                "annotations": self.annotations,
+            }
+        }
+        if await self._create(self.api.create_namespace, body):
+            self.log.info("Created namespace %s", namespace)
+        for manifest in self.objects:
+            manifest = expand(copy.deepcopy(manifest), namespace=namespace)
+            manifest.setdefault("metadata", {})["namespace"] = namespace
+            method = getattr(self.api, create_method(manifest["kind"]))
+            if await self._create(method, namespace, manifest):
+                self.log.info(
+                    "Created %s %s in namespace %s",
+                    manifest["kind"],
+                    manifest["metadata"]["name"],
+                    namespace,
+                )
+        self.ready[namespace] = time.monotonic() + self.ttl
+
+    async def ensure(self, namespace):
+        """Makes sure the namespace and its objects exist"""
+        if self.ready.get(namespace, 0) > time.monotonic():
+            self.stats["hit"] += 1
+            return
+        self.stats["miss"] += 1
+        await self._flight.run(namespace, self._provision, namespace)
+
+    def forget(self, namespace):
+        """Drops the namespace from the ready ones (e.g. if deleted)"""
+        self.ready.pop(namespace, None)
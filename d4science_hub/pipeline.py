@@ -0,0 +1,94 @@
+"""Dependency-aware runner for the network calls done at login"""
+
+import asyncio
+import logging
+import time
+
+from d4science_hub import tracing
+
+
+class PipelineStep:
+    __slots__ = ("name", "func", "requires", "timeout", "optional", "default")
+
+    def __init__(self, name, func, requires, timeout, optional, default):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.timeout = timeout
+        self.optional = optional
+        self.default = default
+
+
+class Pipeline:
+    """Runs a set of async steps as soon as the steps they depend on finish
+
+    Each step is a callable returning an awaitable, it gets as positional
+    arguments the results of the steps listed in `requires`. Independent
+    steps run concurrently. Every step has its own timeout; if a step fails
+    (and it is not optional) the rest of steps are cancelled and the error
+    is raised. Optional steps return `default` on error or timeout.
+    """
+
+    def __init__(self, name="pipeline", timeout=None, timeouts=None, log=None):
+        self.name = name
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.log = log or logging.getLogger(__name__)
+        self.steps = {}
+        self.timings = {}
+
+    def add(self, name, func, requires=(), timeout=None, optional=False, default=None):
+        for dep in requires:
+            if dep not in self.steps:
+                raise ValueError(f"Step {name} requires unknown step {dep}")
+        if timeout is None:
+            timeout = self.timeouts.get(name, self.timeout)
+        self.steps[name] = PipelineStep(
+            name, func, requires, timeout, optional, default
+        )
+
+    async def _run_step(self, step, tasks, t0):
+        args = await asyncio.gather(*[tasks[dep] for dep in step.requires])
+        start = time.perf_counter()
+        try:
+            with tracing.span(step.name):
+                return await asyncio.wait_for(step.func(*args), step.timeout)
+        except Exception as e:
+            if not step.optional:
+                raise
+            self.log.warning("%s step %s failed: %r", self.name, step.name, e)
+            return step.default
+        finally:
+            end = time.perf_counter()
+            self.timings[step.name] = (start - t0, end - start)
+
+    async def run(self):
+        """Runs all the steps and returns a dict with their results"""
+        t0 = time.perf_counter()
+        tasks = {}
+        for name, step in self.steps.items():
+            tasks[name] = asyncio.ensure_future(self._run_step(step, tasks, t0))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        finally:
+            self.log_timings(time.perf_counter() - t0)
+        return {name: task.result() for name, task in tasks.items()}
+
+    def log_timings(self, total):
+        steps = ", ".join(
+            "%s=%.0fms (+%.0fms)" % (name, duration * 1000, offset * 1000)
+            for name, (offset, duration) in self.timings.items()
+        )
+        sequential = sum(duration for _, duration in self.timings.values())
+        self.log.info(
+            "%s took %.0fms (%.0fms if sequential): %s",
+            self.name,
+            total * 1000,
+            sequential * 1000,
+            steps,
+        )
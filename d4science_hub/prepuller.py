@@ -0,0 +1,144 @@
+"""Pre-puller of the images users can pick
+
+Keeps one DaemonSet per node pool whose init containers use each of the
+images, so kubelet pulls them on every eligible node before a user needs
+them. Images of GPU options go to a separate DaemonSet restricted to the GPU
+node pool.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+
+from kubernetes_asyncio.client.rest import ApiException
+
+IMAGES_ANNOTATION = "d4science.org/prepuller-images"
+COMPONENT_LABEL = "d4science-prepuller"
+
+
+def images_hash(images):
+    return hashlib.sha256(json.dumps(sorted(images)).encode()).hexdigest()[:16]
+
+
+def daemonset_manifest(
+    name, images, pause_image, node_selector=None, tolerations=None, labels=None
+):
+    """Returns the DaemonSet pulling the images in its init containers"""
+    images = sorted(images)
+    pod_labels = {"app.kubernetes.io/component": COMPONENT_LABEL, "name": name}
+    pod_labels.update(labels or {})
+    resources = {"requests": {"cpu": "0", "memory": "0"}}
+    spec = {
+        "initContainers": [
+            {
+                "name": f"image-{i}",
+                "image": image,
+                "command": ["/bin/sh", "-c", "echo Pulling complete"],
+                "resources": resources,
+            }
+            for i, image in enumerate(images)
+        ],
+        "containers": [{"name": "pause", "image": pause_image, "resources": resources}],
+        "terminationGracePeriodSeconds": 0,
+        "automountServiceAccountToken": False,
+    }
+    if node_selector:
+        spec["nodeSelector"] = node_selector
+    if tolerations:
+        spec["tolerations"] = tolerations
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {
+            "name": name,
+            "labels": pod_labels,
+            "annotations": {IMAGES_ANNOTATION: images_hash(images)},
+        },
+        "spec": {
+            "selector": {"matchLabels": {"name": name}},
+            "updateStrategy": {
+                "type": "RollingUpdate",
+                "rollingUpdate": {"maxUnavailable": "100%"},
+            },
+            "template": {"metadata": {"labels": pod_labels}, "spec": spec},
+        },
+    }
+
+
+class ImagePrePuller:
+    """Keeps the pre-pull DaemonSets up to date
+
+    `api` is a kubernetes AppsV1Api. `pools` is a dict of pool name to a
+    dict with the node_selector and tolerations of the pool, `sync` takes a
+    dict of pool name to the set of images to pull in that pool.
+    """
+
+    def __init__(
+        self,
+        api,
+        namespace,
+        name="d4science-prepuller",
+        pause_image="registry.k8s.io/pause:3.9",
+        pools=None,
+        log=None,
+    ):
+        self.api = api
+        self.namespace = namespace
+        self.name = name
+        self.pause_image = pause_image
+        self.pools = pools or {"default": {}}
+        self.log = log or logging.getLogger(__name__)
+        # hash of the images of the last applied DaemonSet of every pool
+        self._applied = {}
+
+    def daemonset_name(self, pool):
+        return self.name if pool == "default" else f"{self.name}-{pool}"
+
+    async def _sync_pool(self, pool, images):
+        name = self.daemonset_name(pool)
+        digest = images_hash(images) if images else None
+        if pool in self._applied and self._applied[pool] == digest:
+            return
+        try:
+            current = await self.api.read_namespaced_daemon_set(name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            current = None
+        current_digest = None
+        if current is not None:
+            annotations = current.metadata.annotations or {}
+            current_digest = annotations.get(IMAGES_ANNOTATION, None)
+        if not images:
+            if current is not None:
+                self.log.info("Deleting pre-puller %s", name)
+                await self.api.delete_namespaced_daemon_set(name, self.namespace)
+        elif current_digest != digest:
+            body = daemonset_manifest(
+                name,
+                images,
+                self.pause_image,
+                labels={"d4science.org/pool": pool},
+                **self.pools.get(pool, {}),
+            )
+            self.log.info("Pre-pulling %d images in %s", len(images), name)
+            if current is None:
+                await self.api.create_namespaced_daemon_set(self.namespace, body)
+            else:
+                await self.api.replace_namespaced_daemon_set(name, self.namespace, body)
+        self._applied[pool] = digest
+
+    async def sync(self, images):
+        """Makes the DaemonSets pull the images (dict of pool to images)"""
+        for pool in self.pools:
+            await self._sync_pool(pool, set(images.get(pool, ())))
+
+    async def run(self, get_images, interval=600):
+        """Syncs the images returned by get_images() every interval seconds"""
+        while True:
+            try:
+                await self.sync(get_images())
+            except Exception as e:
+                self.log.warning("Unable to update the pre-puller: %s", e)
+            await asyncio.sleep(interval)
@@ -0,0 +1,271 @@
+"""Streaming parser for the D4Science Information System (registry) responses
+
+Only the elements used by the hub are extracted (ServerOption, VolumeOption
+and AccessPoint endpoints) into compact records, the rest of the document
+is discarded as it is parsed.
+"""
+
+import xml.etree.ElementTree as ET
+from dataclasses import MISSING, dataclass, fields
+
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _child(elem, name):
+    if elem is None:
+        return None
+    for child in elem:
+        if _local(child.tag) == name:
+            return child
+    return None
+
+
+def _text(elem, name=None):
+    if name is not None:
+        elem = _child(elem, name)
+    if elem is None or elem.text is None:
+        return None
+    return elem.text.strip() or None
+
+
+def to_state(record):
+    """Returns the values of a record as a compact list, omitting the
+    trailing values that are equal to their defaults"""
+    record_fields = fields(record)
+    values = [getattr(record, f.name) for f in record_fields]
+    while values:
+        f = record_fields[len(values) - 1]
+        if f.default is MISSING or values[-1] != f.default:
+            break
+        values.pop()
+    return values
+
+
+def from_state(cls, values):
+    """Builds a record from the list returned by to_state"""
+    return cls(*values)
+
+
+@dataclass(frozen=True, slots=True)
+class ServerOption:
+    server_option_name: str
+    auth_id: str
+    name: str = ""
+    description: str = ""
+    image: str = None
+    cores: str = None
+    memory: str = None
+    memory_unit: str = None
+    default: bool = False
+    role: str = ""
+    gpu: bool = False
+
+    @classmethod
+    def from_element(cls, server_option_name, elem):
+        info = _child(elem, "Info")
+        cut = _child(elem, "Cut")
+        memory = _child(cut, "Memory")
+        return cls(
+            server_option_name=server_option_name or "",
+            auth_id=_text(elem, "AuthId") or "",
+            name=_text(info, "Name") or "",
+            description=_text(info, "Description") or "",
+            image=_text(elem, "ImageId"),
+            cores=_text(cut, "Cores"),
+            memory=_text(memory),
+            memory_unit=memory.get("unit") if memory is not None else None,
+            default=elem.get("default", "") == "true",
+            role=elem.get("role", ""),
+            gpu=elem.get("gpu", "") == "true",
+        )
+
+    @classmethod
+    def from_dict(cls, option, server_option_name=None):
+        """Builds the record from the option as parsed by xmltodict"""
+        info = option.get("Info", None) or {}
+        cut = option.get("Cut", None) or {}
+        memory = cut.get("Memory", None)
+        memory_unit = None
+        if isinstance(memory, dict):
+            memory_unit = memory.get("@unit", None)
+            memory = memory.get("#text", None)
+        return cls(
+            server_option_name=(
+                server_option_name or option.get("server_option_name", "")
+            ),
+            auth_id=option.get("AuthId", ""),
+            name=info.get("Name", None) or "",
+            description=info.get("Description", None) or "",
+            image=option.get("ImageId", None),
+            cores=cut.get("Cores", None),
+            memory=memory,
+            memory_unit=memory_unit,
+            default=option.get("@default", "") == "true",
+            role=option.get("@role", ""),
+            gpu=option.get("@gpu", "") == "true",
+        )
+
+    def as_dict(self):
+        """Returns the option as xmltodict would have parsed it"""
+        option = {
+            "AuthId": self.auth_id,
+            "Info": {"Name": self.name, "Description": self.description},
+            "server_option_name": self.server_option_name,
+        }
+        if self.image is not None:
+            option["ImageId"] = self.image
+        cut = {}
+        if self.cores is not None:
+            cut["Cores"] = self.cores
+        if self.memory is not None:
+            cut["Memory"] = {"#text": self.memory, "@unit": self.memory_unit or ""}
+        if cut:
+            option["Cut"] = cut
+        if self.default:
+            option["@default"] = "true"
+        if self.role:
+            option["@role"] = self.role
+        if self.gpu:
+            option["@gpu"] = "true"
+        return option
+
+
+@dataclass(frozen=True, slots=True)
+class VolumeOption:
+    name: str
+    permission: str = ""
+
+    def as_dict(self):
+        return {"Name": self.name, "Permission": self.permission}
+
+
+@dataclass(frozen=True, slots=True)
+class Endpoint:
+    entry_name: str
+    url: str
+
+
+@dataclass(frozen=True, slots=True)
+class RegistryResources:
+    server_options: tuple = ()
+    volume_options: tuple = ()
+    endpoints: tuple = ()
+
+    def endpoint(self, entry_name):
+        """Returns the URL of the last endpoint with the given entry name"""
+        url = None
+        for ep in self.endpoints:
+            if ep.entry_name == entry_name:
+                url = ep.url
+        return url
+
+    def as_dict(self):
+        """Returns a GenericResource document as xmltodict would have parsed
+        it, with only the ServerOption and VolumeOption resources"""
+        resources = [
+            {
+                "Profile": {
+                    "Name": opt.server_option_name,
+                    "Body": {"ServerOption": opt.as_dict()},
+                }
+            }
+            for opt in self.server_options
+        ]
+        resources.extend(
+            {"Profile": {"Body": {"VolumeOption": vol.as_dict()}}}
+            for vol in self.volume_options
+        )
+        return {"genericResources": {"Resource": resources}}
+
+
+class RegistryParser:
+    """Incremental parser for registry responses
+
+    Feed it with the chunks of the response as they arrive (e.g. as the
+    streaming_callback of a tornado request) and get the records with
+    close(). Each Resource element is discarded once processed, so memory
+    use does not grow with the size of the document.
+    """
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._stack = []
+        self._error = None
+        # bytes fed, for the metrics
+        self.size = 0
+        self.server_options = []
+        self.volume_options = []
+        self.endpoints = []
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self._error:
+            return
+        try:
+            self._parser.feed(chunk)
+            self._process()
+        except ET.ParseError as e:
+            self._error = e
+
+    def close(self):
+        """Finishes parsing and returns the RegistryResources found"""
+        if not self._error:
+            try:
+                self._parser.close()
+                self._process()
+            except ET.ParseError as e:
+                self._error = e
+        if self._error:
+            raise self._error
+        return RegistryResources(
+            tuple(self.server_options),
+            tuple(self.volume_options),
+            tuple(self.endpoints),
+        )
+
+    def _process(self):
+        for event, elem in self._parser.read_events():
+            if event == "start":
+                self._stack.append(elem)
+                continue
+            self._stack.pop()
+            # Resources are the direct children of the document root
+            if len(self._stack) == 1 and _local(elem.tag) == "Resource":
+                self._resource(elem)
+                self._stack[0].remove(elem)
+
+    def _resource(self, elem):
+        profile = _child(elem, "Profile")
+        if profile is None:
+            return
+        body = _child(profile, "Body")
+        server_option = _child(body, "ServerOption")
+        if server_option is not None:
+            self.server_options.append(
+                ServerOption.from_element(_text(profile, "Name"), server_option)
+            )
+        volume_option = _child(body, "VolumeOption")
+        if volume_option is not None:
+            self.volume_options.append(
+                VolumeOption(
+                    _text(volume_option, "Name") or "",
+                    _text(volume_option, "Permission") or "",
+                )
+            )
+        for child in profile:
+            if _local(child.tag) != "AccessPoint":
+                continue
+            endpoint = _child(_child(child, "Interface"), "Endpoint")
+            if endpoint is not None:
+                self.endpoints.append(
+                    Endpoint(endpoint.get("EntryName", ""), _text(endpoint) or "")
+                )
+
+
+def parse(document):
+    """Parses a whole registry response"""
+    parser = RegistryParser()
+    parser.feed(document)
+    return parser.close()
@@ -0,0 +1,375 @@
+"""Right-sizing of the CPU and memory guarantees of the server options
+
+The Information System only declares the limits (the Cut) of every
+ServerOption. The guarantees are computed from the usage of the pods of each
+(context, AuthId), as reported by a usage source:
+
+- PrometheusUsageSource: instant queries to a Prometheus HTTP API
+- FileUsageSource: a JSON file, e.g. exported from the monitoring
+
+A usage source returns one sample per observed pod (e.g. the 95th
+percentile of its CPU usage while it ran). The guarantee of an option is
+the configured percentile of its samples times a headroom, within the
+minimum and the declared limit. Options with too few samples keep the
+static guarantees.
+
+`RightSizer.report` projects the node packing of the observed pods with the
+current and the right-sized guarantees.
+"""
+
+import abc
+import asyncio
+import json
+import logging
+import math
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient
+
+UNITS = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+# one sample per pod of the last week, the pods are annotated with their
+# context and profile by the spawner (exported by kube-state-metrics with
+# --metric-annotations-allowlist=pods=[d4science_context,d4science_profile])
+POD_ANNOTATIONS = (
+    " * on (namespace, pod) group_left(annotation_d4science_context,"
+    " annotation_d4science_profile) kube_pod_annotations"
+)
+DEFAULT_CPU_QUERY = (
+    "quantile_over_time(0.95, sum by (namespace, pod) (rate("
+    'container_cpu_usage_seconds_total{container="notebook"}[5m]))[7d:5m])'
+    + POD_ANNOTATIONS
+)
+DEFAULT_MEMORY_QUERY = (
+    "max by (namespace, pod) (max_over_time("
+    'container_memory_working_set_bytes{container="notebook"}[7d]))' + POD_ANNOTATIONS
+)
+
+
+def parse_bytes(value):
+    """Returns the bytes of a memory size like 8G or 8GB (K, M, G and T
+    are powers of 1024, as in KubeSpawner)"""
+    value = str(value).strip()
+    number = value.rstrip("KMGTiBb")
+    unit = value[len(number) :][:1].upper()
+    if unit and unit not in UNITS:
+        raise ValueError(f"Invalid memory size {value!r}")
+    return int(float(number) * UNITS.get(unit, 1))
+
+
+def format_bytes(value):
+    """Returns the memory size in MiB, rounded up"""
+    return f"{math.ceil(value / UNITS['M'])}M"
+
+
+def percentile(values, p):
+    """Returns the p-th percentile (0-100) of values, interpolated"""
+    values = sorted(values)
+    if not values:
+        raise ValueError("No values")
+    rank = (len(values) - 1) * p / 100
+    low = math.floor(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def declared_limits(opt):
+    """Returns the CPU (cores) and memory (bytes) limits of the ServerOption,
+    None if not declared"""
+    cpu = float(opt.cores) if opt.cores is not None else None
+    memory = None
+    if opt.memory is not None:
+        memory = parse_bytes(f"{opt.memory}{opt.memory_unit or ''}")
+    return cpu, memory
+
+
+def static_requests(opt):
+    """Returns the CPU and memory requested by the pods of the ServerOption
+    with the static guarantees of the spawner (without a memory guarantee
+    kubernetes requests the limit)"""
+    cpu, memory = declared_limits(opt)
+    if cpu is not None:
+        cpu = 1 if cpu <= 4 else 2
+    return cpu or 0, memory or 0
+
+
+class UsageSource(abc.ABC):
+    """Source of the usage of the pods"""
+
+    @abc.abstractmethod
+    async def usage(self):
+        """Returns a dict of (context, AuthId) to a dict with the "cpu"
+        (cores) and "memory" (bytes) samples"""
+
+
+class FileUsageSource(UsageSource):
+    """Usage from a JSON file with a list of objects with the context,
+    auth_id, cpu and memory samples of an option, e.g.
+    [{"context": "/gcube/devsec/devVRE", "auth_id": "small-authid",
+      "cpu": [0.5, 1.2], "memory": [1073741824, 2147483648]}]
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    async def usage(self):
+        # not in the event loop of the hub
+        entries = await asyncio.to_thread(self._load)
+        return {
+            (entry["context"], entry["auth_id"]): {
+                "cpu": [float(v) for v in entry.get("cpu", [])],
+                "memory": [float(v) for v in entry.get("memory", [])],
+            }
+            for entry in entries
+        }
+
+
+class PrometheusUsageSource(UsageSource):
+    """Usage from instant queries to a Prometheus HTTP API
+
+    The queries return one sample per pod, with the context and the AuthId
+    of the pod in the context_label and profile_label labels.
+    """
+
+    def __init__(
+        self,
+        url,
+        cpu_query=DEFAULT_CPU_QUERY,
+        memory_query=DEFAULT_MEMORY_QUERY,
+        context_label="annotation_d4science_context",
+        profile_label="annotation_d4science_profile",
+        headers=None,
+        request_timeout=60,
+        http_client=None,
+    ):
+        self.url = url.rstrip("/")
+        self.cpu_query = cpu_query
+        self.memory_query = memory_query
+        self.context_label = context_label
+        self.profile_label = profile_label
+        self.headers = headers or {}
+        self.request_timeout = request_timeout
+        self.http_client = http_client
+
+    async def _query(self, query):
+        client = self.http_client or AsyncHTTPClient()
+        resp = await client.fetch(
+            f"{self.url}/api/v1/query?" + urlencode({"query": query}),
+            headers=self.headers,
+            request_timeout=self.request_timeout,
+        )
+        body = json.loads(resp.body)
+        if body.get("status") != "success":
+            raise RuntimeError(f"Query failed: {body.get('error')}")
+        return body["data"]["result"]
+
+    async def usage(self):
+        usage = {}
+        results = await asyncio.gather(
+            self._query(self.cpu_query), self._query(self.memory_query)
+        )
+        for resource, result in zip(("cpu", "memory"), results):
+            for series in result:
+                labels = series["metric"]
+                context = labels.get(self.context_label, "")
+                auth_id = labels.get(self.profile_label, "")
+                value = float(series["value"][1])
+                if not auth_id or math.isnan(value):
+                    continue
+                samples = usage.setdefault(
+                    (context, auth_id), {"cpu": [], "memory": []}
+                )
+                samples[resource].append(value)
+        return usage
+
+
+def source_from_url(url):
+    """Returns the usage source of url: a Prometheus HTTP API for http(s)
+    URLs, a JSON file otherwise"""
+    if url.startswith(("http://", "https://")):
+        return PrometheusUsageSource(url)
+    return FileUsageSource(url.removeprefix("file://"))
+
+
+class RightSizer:
+    """Computes the guarantees of the options from the usage of source
+
+    `guarantees` is a dict of (context, AuthId) to the computed cpu (cores)
+    and memory (bytes) guarantees before applying the declared limits and
+    the number of samples, `generation` changes whenever they do.
+    """
+
+    def __init__(
+        self,
+        source,
+        cpu_percentile=95,
+        memory_percentile=95,
+        cpu_headroom=1.0,
+        memory_headroom=1.2,
+        min_samples=10,
+        min_cpu=0.1,
+        min_memory=128 * 2**20,
+        log=None,
+    ):
+        self.source = source
+        self.cpu_percentile = cpu_percentile
+        self.memory_percentile = memory_percentile
+        self.cpu_headroom = cpu_headroom
+        self.memory_headroom = memory_headroom
+        self.min_samples = min_samples
+        self.min_cpu = min_cpu
+        self.min_memory = min_memory
+        self.log = log or logging.getLogger(__name__)
+        self.guarantees = {}
+        self.generation = 0
+
+    def compute(self, usage):
+        guarantees = {}
+        for key, samples in usage.items():
+            cpu, memory = samples.get("cpu", []), samples.get("memory", [])
+            if min(len(cpu), len(memory)) < self.min_samples:
+                continue
+            guarantees[key] = {
+                "cpu": max(
+                    self.min_cpu,
+                    percentile(cpu, self.cpu_percentile) * self.cpu_headroom,
+                ),
+                "memory": max(
+                    self.min_memory,
+                    percentile(memory, self.memory_percentile) * self.memory_headroom,
+                ),
+                "samples": min(len(cpu), len(memory)),
+            }
+        return guarantees
+
+    async def refresh(self):
+        guarantees = self.compute(await self.source.usage())
+        if guarantees != self.guarantees:
+            self.guarantees = guarantees
+            self.generation += 1
+            self.log.info("Right-sized %d server options", len(guarantees))
+
+    def requests(self, context, opt):
+        """Returns the right-sized CPU and memory guarantees of the
+        ServerOption within its limits, None if there is not enough usage"""
+        guarantee = self.guarantees.get((context, opt.auth_id), None)
+        if guarantee is None:
+            return None
+        cpu_limit, memory_limit = declared_limits(opt)
+        cpu, memory = guarantee["cpu"], guarantee["memory"]
+        if cpu_limit is not None:
+            cpu = min(cpu, cpu_limit)
+        if memory_limit is not None:
+            memory = min(memory, memory_limit)
+        # whole millicores and MiB, as kubernetes would round them anyway
+        # (rounded first, for the float errors of the percentile)
+        cpu = math.ceil(round(cpu * 1000, 6)) / 1000
+        return cpu, math.ceil(memory / 2**20) * 2**20
+
+    def override(self, context, opt):
+        """Returns the kubespawner_override items of the right-sized
+        guarantees of the ServerOption"""
+        requests = self.requests(context, opt)
+        if requests is None:
+            return {}
+        cpu, memory = requests
+        return {"cpu_guarantee": cpu, "mem_guarantee": format_bytes(memory)}
+
+    def report(self, options, node_cpu, node_memory):
+        """Projects the packing of the observed pods with the static and the
+        right-sized guarantees
+
+        `options` is an iterable of (context, ServerOption), nodes have
+        node_cpu cores and node_memory bytes allocatable. Every option counts
+        once per sample (observed pod).
+        """
+        rows = []
+        totals = {"current": [0, 0], "proposed": [0, 0]}
+        seen = set()
+        for context, opt in options:
+            key = (context, opt.auth_id)
+            requests = self.requests(context, opt)
+            if requests is None or key in seen:
+                continue
+            seen.add(key)
+            pods = self.guarantees[key]["samples"]
+            current = static_requests(opt)
+            row = {"context": context, "auth_id": opt.auth_id, "pods": pods}
+            for name, (cpu, memory) in (("current", current), ("proposed", requests)):
+                row[name] = {
+                    "cpu": cpu,
+                    "memory": memory,
+                    "pods_per_node": min(
+                        math.floor(node_cpu / cpu) if cpu else math.inf,
+                        math.floor(node_memory / memory) if memory else math.inf,
+                    ),
+                }
+                totals[name][0] += cpu * pods
+                totals[name][1] += memory * pods
+            rows.append(row)
+        nodes = {
+            name: max(math.ceil(cpu / node_cpu), math.ceil(memory / node_memory))
+            for name, (cpu, memory) in totals.items()
+        }
+        return {
+            "node_cpu": node_cpu,
+            "node_memory": node_memory,
+            "options": rows,
+            "nodes": nodes,
+            "gain": nodes["current"] / nodes["proposed"] if nodes["proposed"] else 1,
+        }
+
+    async def run(self, interval=3600, on_refresh=None):
+        """Refreshes the guarantees every interval seconds, calling
+        on_refresh() after every refresh"""
+        while True:
+            try:
+                await self.refresh()
+                if on_refresh is not None:
+                    on_refresh()
+            except Exception as e:
+                self.log.warning("Unable to right-size the server options: %s", e)
+            await asyncio.sleep(interval)
+
+
+def format_report(report):
+    """Returns the report as a text table"""
+
+    def pods_per_node(value):
+        return "-" if value == math.inf else str(value)
+
+    lines = [
+        "%-30s %-24s %6s %13s %17s %11s"
+        % ("context", "AuthId", "pods", "cpu", "memory", "pods/node")
+    ]
+    for row in report["options"]:
+        current, proposed = row["current"], row["proposed"]
+        lines.append(
+            "%-30s %-24s %6d %5.2f -> %5.2f %7s -> %6s %4s -> %4s"
+            % (
+                row["context"],
+                row["auth_id"],
+                row["pods"],
+                current["cpu"],
+                proposed["cpu"],
+                format_bytes(current["memory"]),
+                format_bytes(proposed["memory"]),
+                pods_per_node(current["pods_per_node"]),
+                pods_per_node(proposed["pods_per_node"]),
+            )
+        )
+    lines.append(
+        "Nodes (%g cores, %s) for the observed pods: %d -> %d (%.2fx)"
+        % (
+            report["node_cpu"],
+            format_bytes(report["node_memory"]),
+            report["nodes"]["current"],
+            report["nodes"]["proposed"],
+            report["gain"],
+        )
+    )
+    return "\n".join(lines)
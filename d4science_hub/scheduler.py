@@ -0,0 +1,145 @@
+"""Bounded, fair concurrency of the spawns
+
+Starting a server fires several Kubernetes API calls (namespace, PVCs,
+pod) and the workspace setup. `SpawnScheduler` bounds how many spawns do
+so at once, globally and per context: the others wait in a FIFO queue per
+context and the free slots go to the contexts by weighted fair queuing
+(start-time fair queuing, each start advancing the virtual time of its
+context by 1 / weight), so a context with hundreds of spawns waiting gets
+its share of the slots while the others keep getting theirs.
+"""
+
+import asyncio
+import collections
+import time
+
+from d4science_hub import metrics
+
+
+class Ticket:
+    """Spawn waiting for (or holding) a slot"""
+
+    __slots__ = ("context", "future", "enqueued_at")
+
+    def __init__(self, context):
+        self.context = context
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def admitted(self):
+        return self.future.done()
+
+
+class _ContextQueue:
+    __slots__ = ("queue", "active", "vtime")
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.active = 0
+        self.vtime = 0.0
+
+
+class SpawnScheduler:
+    """Gives at most max_concurrent slots (0 for no limit), at most
+    max_per_context of them to the spawns of a context, shared between
+    contexts according to `weights` (context -> weight, 1 by default)"""
+
+    def __init__(self, max_concurrent=0, max_per_context=0, weights=None):
+        self.max_concurrent = max_concurrent
+        self.max_per_context = max_per_context
+        self.weights = weights or {}
+        self.active = 0
+        self._contexts = {}
+        self._vclock = 0.0
+        self._admitted = set()
+
+    def __len__(self):
+        return sum(len(c.queue) for c in self._contexts.values())
+
+    def depth(self, context):
+        """Returns the number of spawns of context waiting"""
+        state = self._contexts.get(context, None)
+        return len(state.queue) if state is not None else 0
+
+    def _eligible(self, state):
+        return state.queue and (
+            not self.max_per_context or state.active < self.max_per_context
+        )
+
+    def _dispatch(self):
+        while not self.max_concurrent or self.active < self.max_concurrent:
+            eligible = [
+                (state.vtime, context)
+                for context, state in self._contexts.items()
+                if self._eligible(state)
+            ]
+            if not eligible:
+                return
+            _, context = min(eligible)
+            state = self._contexts[context]
+            ticket = state.queue.popleft()
+            state.active += 1
+            self.active += 1
+            self._vclock = state.vtime
+            state.vtime += 1 / self.weights.get(context, 1)
+            self._admitted.add(ticket)
+            ticket.future.set_result(True)
+            wait = time.monotonic() - ticket.enqueued_at
+            metrics.SPAWN_QUEUE_WAIT_SECONDS.labels(context).observe(wait)
+            metrics.SPAWN_QUEUE_DEPTH.labels(context).set(len(state.queue))
+            metrics.SPAWNS_STARTING.labels(context).set(state.active)
+
+    def position(self, ticket):
+        """Returns the number of spawns of the context of ticket waiting
+        before it"""
+        return self._contexts[ticket.context].queue.index(ticket)
+
+    def enqueue(self, context):
+        """Returns the ticket of a spawn of context, it gets its slot right
+        away if there is a free one"""
+        state = self._contexts.get(context, None)
+        if state is None:
+            state = self._contexts[context] = _ContextQueue()
+        if not state.queue:
+            # no credit for the time the context was idle
+            state.vtime = max(state.vtime, self._vclock)
+        ticket = Ticket(context)
+        state.queue.append(ticket)
+        metrics.SPAWN_QUEUE_DEPTH.labels(context).set(len(state.queue))
+        self._dispatch()
+        return ticket
+
+    async def wait(self, ticket, timeout=None):
+        """Waits until the ticket gets its slot, it leaves the queue if the
+        wait fails (e.g. timeout or cancelled)"""
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+        except BaseException:
+            self.release(ticket)
+            raise
+
+    def release(self, ticket):
+        """Frees the slot of the ticket (or removes it from the queue)"""
+        state = self._contexts.get(ticket.context, None)
+        if state is None:
+            return
+        if ticket in self._admitted:
+            self._admitted.discard(ticket)
+            state.active -= 1
+            self.active -= 1
+            metrics.SPAWNS_STARTING.labels(ticket.context).set(state.active)
+        elif ticket in state.queue:
+            state.queue.remove(ticket)
+            ticket.future.cancel()
+            metrics.SPAWN_QUEUE_DEPTH.labels(ticket.context).set(len(state.queue))
+        if not state.queue and not state.active and state.vtime <= self._vclock:
+            # nothing to remember about it
+            del self._contexts[ticket.context]
+        self._dispatch()
+
+
+def describe_position(position, depth):
+    """Returns the progress message of a spawn at position in the queue of
+    its context, with depth spawns waiting"""
+    return f"Waiting to start, {position} spawns of the VRE ahead ({depth} waiting)"
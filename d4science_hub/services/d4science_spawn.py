@@ -1,29 +1,171 @@
 """An helper service to redirect users to the right server option.
 
 It expects that the users is already authenticated.
+
+By default it runs a single process with a random cookie secret. To run
+several processes (and replicas) configure these environment variables:
+
+- D4SCIENCE_SPAWN_COOKIE_SECRET (hex encoded) or
+  D4SCIENCE_SPAWN_COOKIE_SECRET_FILE: cookie secret shared by every process,
+  the OAuth state is also encrypted with it so the OAuth callback can be
+  handled by any of them
+- D4SCIENCE_SPAWN_PROCESSES: number of processes (0 for one per CPU), each
+  of them listening on the same port with SO_REUSEPORT
+- D4SCIENCE_SPAWN_USER_CACHE_TTL / D4SCIENCE_SPAWN_USER_CACHE_SIZE: seconds
+  and number of users (per process) to keep the users validated by the Hub
+
+/health answers 200 while the process is serving requests.
+
+With D4SCIENCE_SPAWN_DIRECT=1 the service starts the server itself through
+the Hub REST API (with the profile in the `profile` argument or the default
+one of the server option) and streams the spawn progress, as server-sent
+events if the client asks for them or as a page that goes to the server
+once it is ready. Servers are only started on POST requests with the XSRF
+token of the user: a GET goes to the running server or returns a page
+that posts the start form. The service then needs the `read:users:name`,
+`read:servers` and `servers` scopes. D4SCIENCE_SPAWN_TIMEOUT limits the
+seconds to wait for the spawn.
 """
 
+import base64
+import collections
+import hashlib
+import html
+import json
 import os
 import os.path
-from urllib.parse import urlparse
+import secrets
+import time
+from urllib.parse import quote, urlparse
 
-from jupyterhub.services.auth import HubOAuthCallbackHandler, HubOAuthenticated
+from cryptography.fernet import Fernet, InvalidToken
+from jupyterhub.services.auth import (
+    HubOAuth,
+    HubOAuthCallbackHandler,
+    HubOAuthenticated,
+)
 from jupyterhub.utils import url_path_join
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
-from tornado.web import Application, RequestHandler, authenticated
+from tornado.log import app_log
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes, task_id
+from tornado.web import Application, HTTPError, RequestHandler, authenticated
+from traitlets import Bytes, Instance, default
+
+
+class UserCache:
+    """HubAuth cache of the Hub replies, kept max_age seconds (forever if 0)
+
+    At most max_size replies are kept, dropping the least recently used.
+    """
+
+    def __init__(self, max_age=300, max_size=10000):
+        self.max_age = max_age
+        self.max_size = max_size
+        self._values = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        expires, value = self._values[key]
+        if expires and expires < time.monotonic():
+            del self._values[key]
+            raise KeyError(key)
+        self._values.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        expires = time.monotonic() + self.max_age if self.max_age else 0
+        self._values[key] = (expires, value)
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self._values.clear()
+
+
+class SharedStateHubOAuth(HubOAuth):
+    """HubOAuth keeping the OAuth state (next url, PKCE code verifier)
+    encrypted in the state itself instead of in the memory of the process,
+    so the OAuth callback can be handled by any process sharing the secret"""
+
+    state_secret = Bytes(help="""Secret to encrypt the OAuth state""")
+    cache = Instance(UserCache, allow_none=False)
+
+    @default("cache")
+    def _default_cache(self):
+        return UserCache(self.cache_max_age)
+
+    @property
+    def _fernet(self):
+        key = hashlib.sha256(b"d4science-spawn-state:" + self.state_secret).digest()
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def generate_state(self, next_url=None, **extra_state):
+        state = {"next_url": next_url, "nonce": secrets.token_urlsafe(8)}
+        state.update(extra_state)
+        return self._fernet.encrypt(json.dumps(state).encode()).decode()
+
+    def _decrypt_state(self, state_id):
+        try:
+            state = self._fernet.decrypt(
+                state_id.encode(), ttl=self.oauth_state_max_age
+            )
+        except (InvalidToken, ValueError):
+            return {}
+        return json.loads(state)
+
+    def get_next_url(self, state_id=""):
+        return self._decrypt_state(state_id).get("next_url") or self.base_url
+
+    def get_code_verifier(self, state_id=""):
+        return self._decrypt_state(state_id).get("code_verifier")
+
+    def get_state_cookie_name(self, state_id=""):
+        state = self._decrypt_state(state_id)
+        return state.get("cookie_name") or self.state_cookie_name
+
+    def clear_oauth_state(self, state_id):
+        # nothing stored
+        pass
 
 
 class D4ScienceHandler(HubOAuthenticated, RequestHandler):
     """Simple handler that redirects to the right spawn page
-    for the user depending of the request"""
+    for the user depending of the request, or starts the server directly"""
+
+    hub_auth_class = SharedStateHubOAuth
+
+    async def prepare(self):
+        # check the user with the Hub without blocking the process, the
+        # authenticated decorator then gets the cached user
+        await self.hub_auth.get_user(self, sync=False)
+
+    def _server_name(self):
+        server_name = self.request.path.split("/")[-1]
+        return f"rname-{server_name}" if server_name else ""
 
     @authenticated
-    def get(self):
+    async def get(self):
         user = self.get_current_user()
-        server_name = self.request.path.split("/")[-1]
-        if server_name:
-            server_name = f"rname-{server_name}"
+        server_name = self._server_name()
+        if self.settings.get("direct_spawn"):
+            # never starts the server, only the POST of the start page does
+            await self.start_page(user["name"], server_name)
+            return
         dest_url = url_path_join("/hub/spawn/", user["name"], server_name)
         self.redirect(
             dest_url,
@@ -31,26 +173,222 @@ class D4ScienceHandler(HubOAuthenticated, RequestHandler):
         )
         return
 
+    @authenticated
+    async def post(self):
+        if not self.settings.get("direct_spawn"):
+            raise HTTPError(405)
+        user = self.get_current_user()
+        await self.direct_spawn(user["name"], self._server_name())
 
-def main():
-    app = Application(
+    async def hub_api(self, method, path, **kwargs):
+        """Calls the Hub REST API with the token of the service"""
+        hub_auth = self.hub_auth
+        kwargs.setdefault("request_timeout", 30)
+        return await AsyncHTTPClient().fetch(
+            url_path_join(hub_auth.api_url, path),
+            method=method,
+            headers={"Authorization": f"token {hub_auth.api_token}"},
+            **kwargs,
+        )
+
+    def _server_path(self, user_name, server_name):
+        user_path = f"users/{quote(user_name, safe='')}"
+        if server_name:
+            return f"{user_path}/servers/{quote(server_name, safe='')}"
+        return f"{user_path}/server"
+
+    async def get_server(self, user_name, server_name):
+        """Returns the model of the server of the user ({} if not started)"""
+        try:
+            resp = await self.hub_api("GET", f"users/{quote(user_name, safe='')}")
+        except HTTPClientError as e:
+            raise HTTPError(502, f"Failed to get the servers: {e}")
+        return json.loads(resp.body).get("servers", {}).get(server_name, {})
+
+    async def start_page(self, user_name, server_name):
+        """Goes to the server if it is running, otherwise returns a page
+        that starts it with a POST (with the XSRF token of the user)"""
+        server = await self.get_server(user_name, server_name)
+        if server.get("ready"):
+            self.redirect(server["url"], permanent=False)
+            return
+        if "text/event-stream" in self.request.headers.get("Accept", ""):
+            raise HTTPError(405, "POST to start the server")
+        # not submitted from other sites' frames
+        self.set_header("Content-Security-Policy", "frame-ancestors 'none'")
+        profile = self.get_argument("profile", "")
+        self.finish(
+            "<!DOCTYPE html><html><head><title>Starting server</title></head>"
+            '<body><form id="start" method="post">%s'
+            '<input type="hidden" name="profile" value="%s">'
+            '<noscript><button type="submit">Start server</button></noscript>'
+            "</form><script>document.getElementById('start').submit();</script>"
+            "</body></html>" % (self.xsrf_form_html(), html.escape(profile))
+        )
+
+    async def direct_spawn(self, user_name, server_name):
+        """Starts the server (unless running) and streams its progress"""
+        server_path = self._server_path(user_name, server_name)
+        server = await self.get_server(user_name, server_name)
+        if server.get("ready"):
+            self.redirect(server["url"], permanent=False)
+            return
+        if not server.get("pending"):
+            profile = self.get_argument("profile", "")
+            # without profile the spawner picks the default one of the option
+            body = {"profile": profile} if profile else {}
+            try:
+                await self.hub_api("POST", server_path, body=json.dumps(body))
+            except HTTPClientError as e:
+                # e.g. started meanwhile, the progress tells
+                if e.code != 400:
+                    raise HTTPError(502, f"Failed to start the server: {e}")
+                app_log.warning("Starting %s: %s", server_path, e)
+        await self.stream_progress(user_name, server_name, server_path)
+
+    async def stream_progress(self, user_name, server_name, server_path):
+        event_stream = "text/event-stream" in self.request.headers.get("Accept", "")
+        if event_stream:
+            self.set_header("Content-Type", "text/event-stream")
+            self.set_header("Cache-Control", "no-cache")
+        else:
+            self.write(
+                "<!DOCTYPE html><html><head><title>Starting server</title>"
+                "</head><body><h1>Starting server</h1><ul>"
+            )
+        self.flush()
+        last = {}
+        buffer = b""
+
+        def on_chunk(chunk):
+            nonlocal buffer, last
+            buffer += chunk
+            *events, buffer = buffer.split(b"\n\n")
+            for raw in events:
+                data = [
+                    line[5:].strip()
+                    for line in raw.splitlines()
+                    if line.startswith(b"data:")
+                ]
+                if not data:
+                    # keepalive
+                    continue
+                last = json.loads(b"".join(data))
+                if event_stream:
+                    self.write(raw + b"\n\n")
+                else:
+                    self.write("<li>%s</li>\n" % html.escape(last.get("message", "")))
+                self.flush()
+
+        try:
+            await self.hub_api(
+                "GET",
+                f"{server_path}/progress",
+                streaming_callback=on_chunk,
+                request_timeout=self.settings.get("spawn_timeout", 600),
+            )
+        except HTTPClientError as e:
+            app_log.error("Failed to follow the progress of %s: %s", server_path, e)
+            last = {"failed": True, "message": "Failed to follow the spawn"}
+            if event_stream:
+                self.write(f"data: {json.dumps(last)}\n\n")
+        if not event_stream:
+            if last.get("ready"):
+                url = json.dumps(last["url"]).replace("</", "<\\/")
+                self.write(f"</ul><script>window.location = {url};</script>")
+            else:
+                spawn_url = url_path_join("/hub/spawn/", user_name, server_name)
+                self.write(
+                    '</ul><p>%s, <a href="%s">try again</a></p>'
+                    % (
+                        html.escape(last.get("message", "Spawn failed")),
+                        html.escape(spawn_url),
+                    )
+                )
+            self.write("</body></html>")
+        self.finish()
+
+
+class D4ScienceCallbackHandler(HubOAuthCallbackHandler):
+    hub_auth_class = SharedStateHubOAuth
+
+
+class HealthHandler(RequestHandler):
+    def get(self):
+        self.write({"status": "ok"})
+
+
+def get_cookie_secret():
+    """Returns the configured cookie secret, None if not configured"""
+    secret = os.environ.get("D4SCIENCE_SPAWN_COOKIE_SECRET", "")
+    path = os.environ.get("D4SCIENCE_SPAWN_COOKIE_SECRET_FILE", "")
+    if not secret and path:
+        with open(path) as f:
+            secret = f.read()
+    if not secret.strip():
+        return None
+    return bytes.fromhex(secret.strip())
+
+
+def make_app(
+    cookie_secret,
+    user_cache_ttl=300,
+    user_cache_size=10000,
+    direct_spawn=False,
+    spawn_timeout=600,
+):
+    SharedStateHubOAuth.instance(
+        state_secret=cookie_secret,
+        cache=UserCache(user_cache_ttl, user_cache_size),
+    )
+    prefix = os.environ["JUPYTERHUB_SERVICE_PREFIX"]
+    return Application(
         [
+            ("/health", HealthHandler),
             (
-                url_path_join(
-                    os.environ["JUPYTERHUB_SERVICE_PREFIX"], "oauth_callback"
-                ),
-                HubOAuthCallbackHandler,
+                url_path_join(prefix, "oauth_callback"),
+                D4ScienceCallbackHandler,
             ),
             (
-                r"%s/[^/]*" % os.environ["JUPYTERHUB_SERVICE_PREFIX"],
+                r"%s/[^/]*" % prefix,
                 D4ScienceHandler,
             ),
         ],
-        cookie_secret=os.urandom(32),
+        cookie_secret=cookie_secret,
+        xsrf_cookies=True,
+        direct_spawn=direct_spawn,
+        spawn_timeout=spawn_timeout,
     )
-    http_server = HTTPServer(app)
+
+
+def main():
+    cookie_secret = get_cookie_secret()
+    processes = int(os.environ.get("D4SCIENCE_SPAWN_PROCESSES", "1"))
+    if cookie_secret is None:
+        if processes != 1:
+            raise SystemExit(
+                "D4SCIENCE_SPAWN_COOKIE_SECRET is needed to run several processes"
+            )
+        app_log.warning("No cookie secret configured, using a random one")
+        cookie_secret = os.urandom(32)
     url = urlparse(os.environ["JUPYTERHUB_SERVICE_URL"])
-    http_server.listen(url.port)
+    if processes != 1:
+        # every process listens on its own socket, the kernel balances
+        # the connections among them
+        fork_processes(processes)
+        sockets = bind_sockets(url.port, reuse_port=True)
+        app_log.info("Started process %s", task_id())
+    else:
+        sockets = bind_sockets(url.port)
+    app = make_app(
+        cookie_secret,
+        int(os.environ.get("D4SCIENCE_SPAWN_USER_CACHE_TTL", "300")),
+        int(os.environ.get("D4SCIENCE_SPAWN_USER_CACHE_SIZE", "10000")),
+        os.environ.get("D4SCIENCE_SPAWN_DIRECT", "").lower() in ("1", "true", "yes"),
+        float(os.environ.get("D4SCIENCE_SPAWN_TIMEOUT", "600")),
+    )
+    http_server = HTTPServer(app)
+    http_server.add_sockets(sockets)
     IOLoop.current().start()
 
 
@@ -1,8 +1,235 @@
 """D4Science Authenticator for JupyterHub"""
 
+import asyncio
+import collections
+import functools
+import hashlib
+import json
+import os.path
+import secrets
+from urllib.parse import unquote
+
+from jupyterhub.traitlets import ByteSpecification
 from jupyterhub.utils import maybe_future
+from kubernetes_asyncio.client.rest import ApiException
 from kubespawner import KubeSpawner
-from traitlets import Bool, Callable, Dict, List, Unicode
+from kubespawner.clients import shared_client
+from kubespawner.slugs import safe_slug
+from tornado.ioloop import IOLoop
+from traitlets import (
+    Bool,
+    Callable,
+    Dict,
+    Float,
+    Instance,
+    Integer,
+    List,
+    Unicode,
+    Union,
+    observe,
+)
+
+from d4science_hub import auth_state as d4science_auth_state
+from d4science_hub import (
+    admission,
+    frozen,
+    metrics,
+    rightsizing,
+    scheduler,
+    storage_daemon,
+    token_rotation,
+    tracing,
+    warmpool,
+)
+from d4science_hub.catalog import ResourceCatalog
+from d4science_hub.namespaces import NamespaceManager
+from d4science_hub.prepuller import ImagePrePuller
+from d4science_hub.registry import ServerOption, VolumeOption
+
+
+def override_image(image, repo_override):
+    """Returns image from the repo_override repository (if any)"""
+    if repo_override:
+        image = image.rsplit("/", 1)[-1]
+        image = f"{repo_override}/{image}"
+    return image
+
+
+def catalogs(authenticator):
+    """Returns the (context, ResourceCatalog) of every context seen by the
+    authenticator"""
+    catalog_cache = getattr(authenticator, "catalog_cache", None)
+    if catalog_cache is None:
+        return []
+    return list(catalog_cache.items())
+
+
+def prepull_images(
+    authenticator, server_options_names, extra_profiles, repo_override=""
+):
+    """Returns the images to pre-pull as a dict with the default and the
+    gpu sets of images"""
+    images = {"default": set(), "gpu": set()}
+    for _, catalog in catalogs(authenticator):
+        for opt in catalog.server_options:
+            if opt.image and opt.server_option_name in server_options_names:
+                pool = "gpu" if opt.gpu else "default"
+                images[pool].add(override_image(opt.image, repo_override))
+    for profile in extra_profiles:
+        image = profile.get("kubespawner_override", {}).get("image", None)
+        if image:
+            images["default"].add(image)
+    return images
+
+
+def rightsizing_report(right_sizer, authenticator, node_cpu, node_memory):
+    """Returns the right-sizing report (see RightSizer.report) of the
+    server options of every context seen by the authenticator"""
+    options = [
+        (unquote(context), opt)
+        for context, catalog in catalogs(authenticator)
+        for opt in catalog.server_options
+    ]
+    return right_sizer.report(options, node_cpu, node_memory)
+
+
+def log_rightsizing(right_sizer, authenticator, node_cpu, node_memory, dry_run, log):
+    report = rightsizing.format_report(
+        rightsizing_report(right_sizer, authenticator, node_cpu, node_memory)
+    )
+    if dry_run:
+        log.info("Right-sizing dry run:\n%s", report)
+    else:
+        log.debug("Right-sizing:\n%s", report)
+
+
+async def _run_service(service, api_class, *args):
+    """Runs the loop of a shared service with a shared kubernetes client of
+    api_class (if any)"""
+    if api_class:
+        service.api = shared_client(api_class)
+    await service.run(*args)
+
+
+_services_started = False
+
+
+def _start_services(spawner):
+    """Creates (and starts) the services shared by every spawner of the hub
+    with the configuration of spawner, the first one created: the
+    configuration of later spawners is ignored. The services only keep
+    configuration values and the authenticator of the hub, not the spawner."""
+    global _services_started
+    if _services_started:
+        return
+    _services_started = True
+    authenticator = spawner.authenticator
+    log = spawner.log
+    loop = IOLoop.current()
+    if spawner.prepull_images:
+        gpu_override = spawner.gpu_override
+        D4ScienceSpawner._prepuller = ImagePrePuller(
+            None,
+            spawner.prepull_namespace or spawner.namespace,
+            pause_image=spawner.prepull_pause_image,
+            pools={
+                "default": {"node_selector": spawner.prepull_node_selector},
+                "gpu": {
+                    "node_selector": gpu_override.get("node_selector", {}),
+                    "tolerations": gpu_override.get("tolerations", []),
+                },
+            },
+            log=log,
+        )
+        get_images = functools.partial(
+            prepull_images,
+            authenticator,
+            spawner.server_options_names,
+            spawner.extra_profiles,
+            spawner.image_repo_override,
+        )
+        loop.add_callback(
+            _run_service,
+            D4ScienceSpawner._prepuller,
+            "AppsV1Api",
+            get_images,
+            spawner.prepull_interval,
+        )
+    if spawner.warm_pool_sizes:
+        D4ScienceSpawner._warm_pool = warmpool.WarmPool(
+            None,
+            spawner.namespace,
+            spawner.warm_pool_sizes,
+            handoff_timeout=spawner.warm_pool_handoff_timeout,
+            log=log,
+        )
+        loop.add_callback(
+            _run_service,
+            D4ScienceSpawner._warm_pool,
+            "CoreV1Api",
+            spawner.warm_pool_interval,
+        )
+    if spawner.spawn_concurrency or spawner.spawn_concurrency_per_context:
+        D4ScienceSpawner._spawn_scheduler = scheduler.SpawnScheduler(
+            spawner.spawn_concurrency,
+            spawner.spawn_concurrency_per_context,
+            spawner.spawn_context_weights,
+        )
+    if spawner.token_rotation:
+        D4ScienceSpawner._token_rotator = token_rotation.TokenRotator(
+            None,
+            ahead=spawner.token_rotation_ahead,
+            request_timeout=spawner.k8s_api_request_timeout,
+            log=log,
+        )
+        loop.add_callback(
+            _run_service,
+            D4ScienceSpawner._token_rotator,
+            "CoreV1Api",
+            spawner.token_rotation_interval,
+        )
+    if spawner.gpu_admission:
+        D4ScienceSpawner._gpu_admission = admission.GpuAdmission(
+            None,
+            spawner.gpu_override.get("node_selector", {}),
+            resource=spawner.gpu_resource,
+            log=log,
+        )
+        loop.add_callback(
+            _run_service,
+            D4ScienceSpawner._gpu_admission,
+            "CoreV1Api",
+            spawner.gpu_admission_interval,
+        )
+    if spawner.rightsizing_source:
+        source = spawner.rightsizing_source
+        if isinstance(source, str):
+            source = rightsizing.source_from_url(source)
+        right_sizer = D4ScienceSpawner._right_sizer = rightsizing.RightSizer(
+            source,
+            cpu_percentile=spawner.rightsizing_cpu_percentile,
+            memory_percentile=spawner.rightsizing_memory_percentile,
+            cpu_headroom=spawner.rightsizing_cpu_headroom,
+            memory_headroom=spawner.rightsizing_memory_headroom,
+            min_samples=spawner.rightsizing_min_samples,
+            log=log,
+        )
+        on_refresh = functools.partial(
+            log_rightsizing,
+            right_sizer,
+            authenticator,
+            spawner.rightsizing_node_cpu,
+            spawner.rightsizing_node_memory,
+            spawner.rightsizing_dry_run,
+            log,
+        )
+        loop.add_callback(
+            _run_service,
+            right_sizer,
+            None,
+            spawner.rightsizing_interval,
+            on_refresh,
+        )
 
 
 class D4ScienceSpawner(KubeSpawner):
@@ -25,6 +252,27 @@ class D4ScienceSpawner(KubeSpawner):
         config=True,
         help="""the D4science storage image to use""",
     )
+    use_storage_daemon = Bool(
+        False,
+        config=True,
+        help="""Whether to mount the workspace with the storage daemon of the
+                node (see d4science_hub.storage_daemon) instead of a sidecar
+                in every pod. The workspace is consumed as a hostPath volume,
+                mounted and unmounted by the postStart and preStop hooks of
+                the notebook container (replacing any in lifecycle_hooks)""",
+    )
+    storage_daemon_sockets_path = Unicode(
+        storage_daemon.DEFAULT_SOCKETS,
+        config=True,
+        help="""Path (in the nodes) where the storage daemon serves the
+                socket of every pod, in a directory per pod""",
+    )
+    storage_daemon_mounts_path = Unicode(
+        storage_daemon.DEFAULT_MOUNTS,
+        config=True,
+        help="""Path (in the nodes) where the storage daemon mounts the
+                workspaces""",
+    )
     volume_mappings = Dict(
         {},
         config=True,
@@ -116,6 +364,31 @@ class D4ScienceSpawner(KubeSpawner):
         config=True,
         help="""Whether context-specific namespaces will be used or not""",
     )
+    context_namespace_labels = Dict(
+        {},
+        config=True,
+        help="""Labels of the context namespaces created by the hub""",
+    )
+    context_namespace_annotations = Dict(
+        {},
+        config=True,
+        help="""Annotations of the context namespaces created by the hub""",
+    )
+    context_namespace_objects = List(
+        [],
+        config=True,
+        help="""Manifests of namespaced objects (e.g. ResourceQuota,
+                LimitRange, PersistentVolumeClaim) to create in every context
+                namespace when it is first used. {namespace} is expanded in
+                their strings""",
+    )
+    context_namespace_ttl = Integer(
+        300,
+        config=True,
+        help="""Seconds to consider a context namespace (and its objects)
+                provisioned before checking it again, so the ones deleted
+                out of band are created again""",
+    )
     image_repo_override = Unicode(
         "",
         config=True,
@@ -149,20 +422,565 @@ class D4ScienceSpawner(KubeSpawner):
         """,
     )
 
+    profiles_cache_size = Integer(
+        1024,
+        config=True,
+        help="""Number of profile lists to keep in memory, profile lists are
+                shared by all the spawners with the same options""",
+    )
+
+    prepull_images = Bool(
+        False,
+        config=True,
+        help="""Whether to keep the images of the server options of the
+                Information System (of every context with logins) and of
+                extra_profiles pulled in the nodes with DaemonSets. Images
+                of GPU options are only pulled in the nodes selected by
+                gpu_override""",
+    )
+    prepull_interval = Integer(
+        600,
+        config=True,
+        help="""Seconds between updates of the images to pre-pull""",
+    )
+    prepull_namespace = Unicode(
+        "",
+        config=True,
+        help="""Namespace for the pre-puller DaemonSets, the namespace of the
+                spawner if not set""",
+    )
+    prepull_node_selector = Dict(
+        {},
+        config=True,
+        help="""Node selector of the pre-puller for non-GPU images""",
+    )
+    prepull_pause_image = Unicode(
+        "registry.k8s.io/pause:3.9",
+        config=True,
+        help="""Image for the container kept running by the pre-puller""",
+    )
+
+    warm_pool_sizes = Dict(
+        {},
+        config=True,
+        help="""Number of started pods to keep ready for each server option, as
+                a dict of context to a dict of AuthId to the size, e.g.
+                {"/gcube/devsec/devVRE": {"my-option-authid": 2}}. The size can
+                change with the time of the day (hub local time) with a dict of
+                "HH:MM" to the size from that time on, e.g.
+                {"08:00": 4, "20:00": 1}.
+                Warm pods are created from the pod of the last spawn of the
+                option, users whose pod differs (beyond its environment and
+                labels) get a new pod. All containers need an explicit command
+                (see cmd and sidecar_command)""",
+    )
+    warm_pool_interval = Integer(
+        10,
+        config=True,
+        help="""Seconds between updates of the warm pools""",
+    )
+    warm_pool_handoff_timeout = Float(
+        10,
+        config=True,
+        help="""Timeout (in seconds) for handing off a warm pod to a user,
+                a new pod is started if exceeded""",
+    )
+    sidecar_command = List(
+        [],
+        config=True,
+        help="""Command of the workspace sidecar, the image entrypoint if
+                empty. Needed for warm pods""",
+    )
+    token_rotation = Bool(
+        False,
+        config=True,
+        help="""Whether to keep the context token of the running servers
+                fresh. The token is also kept in a Secret per server,
+                mounted in the notebook and sidecar containers at
+                token_rotation_mount_path (D4SCIENCE_TOKEN_FILE points to
+                it), which the hub replaces with a fresh token before it
+                expires. D4SCIENCE_TOKEN keeps the token of the spawn.
+                Servers with rotation cannot be warm pods""",
+    )
+    token_rotation_mount_path = Unicode(
+        "/var/run/secrets/d4science.org",
+        config=True,
+        help="""Path where the token Secret is mounted in the containers""",
+    )
+    token_rotation_ahead = Integer(
+        600,
+        config=True,
+        help="""Seconds before its expiry when the token of a server is
+                replaced. It leaves time for the kubelet to update the
+                mounted Secret (about a minute) and must be shorter than
+                the lifetime of the context tokens""",
+    )
+    token_rotation_interval = Integer(
+        60,
+        config=True,
+        help="""Interval (in seconds) to look for tokens to rotate""",
+    )
+
+    spawn_concurrency = Integer(
+        0,
+        config=True,
+        help="""Maximum number of spawns starting at once (from loading
+                their user options to creating their pod), 0 for no limit.
+                The other spawns wait in a queue per context, the free
+                slots are shared by the contexts with weighted fair
+                queuing (see spawn_context_weights)""",
+    )
+    spawn_concurrency_per_context = Integer(
+        0,
+        config=True,
+        help="""Maximum number of spawns of a context (D4SCIENCE_CONTEXT, or
+                the namespace if there is none) starting at once, 0 for no
+                limit""",
+    )
+    spawn_context_weights = Dict(
+        {},
+        config=True,
+        help="""Weight of the contexts in the share of the spawn slots when
+                spawns wait, as a dict of context to weight (1 if not set),
+                e.g. {"/gcube/devsec/devVRE": 2}""",
+    )
+
+    gpu_admission = Bool(
+        False,
+        config=True,
+        help="""Whether to admit the spawns of GPU servers (those with
+                gpu_resource in extra_resource_limits, e.g. from
+                gpu_override) only when the nodes selected by the
+                node_selector of gpu_override have free GPUs. Spawns wait
+                in a queue per context otherwise, served round-robin, with
+                their position in the spawn progress. GPU profiles are
+                marked as unavailable if the nodes have no GPUs.
+                The hub then needs a ClusterRole (bound to its service
+                account) allowing to list nodes and to list pods in all
+                namespaces (as they are listed per GPU node), e.g. rules
+                [{"apiGroups": [""], "resources": ["nodes", "pods"],
+                "verbs": ["list"]}]""",
+    )
+    gpu_resource = Unicode(
+        "nvidia.com/gpu",
+        config=True,
+        help="""Name of the GPU resource of the nodes""",
+    )
+    gpu_admission_interval = Integer(
+        10,
+        config=True,
+        help="""Seconds between updates of the GPUs allocated in the
+                nodes""",
+    )
+    gpu_queue_timeout = Float(
+        0,
+        config=True,
+        help="""Maximum seconds a spawn waits for a GPU, 0 to wait as long
+                as the start_timeout allows""",
+    )
+
+    rightsizing_source = Union(
+        [Instance(rightsizing.UsageSource), Unicode()],
+        default_value="",
+        config=True,
+        help="""Source of the usage of the pods to right-size the CPU and
+                memory guarantees of the server options: the URL of a
+                Prometheus HTTP API, the path of a JSON file or a
+                d4science_hub.rightsizing.UsageSource (see
+                d4science_hub.rightsizing). Guarantees are static (1 or 2
+                cores, no memory guarantee) if empty""",
+    )
+    rightsizing_cpu_percentile = Float(
+        95,
+        config=True,
+        help="""Percentile (0-100) of the CPU usage of the pods of an option
+                to guarantee""",
+    )
+    rightsizing_memory_percentile = Float(
+        95,
+        config=True,
+        help="""Percentile (0-100) of the memory usage of the pods of an
+                option to guarantee""",
+    )
+    rightsizing_cpu_headroom = Float(
+        1.0,
+        config=True,
+        help="""Factor applied to the CPU usage percentile""",
+    )
+    rightsizing_memory_headroom = Float(
+        1.2,
+        config=True,
+        help="""Factor applied to the memory usage percentile""",
+    )
+    rightsizing_min_samples = Integer(
+        10,
+        config=True,
+        help="""Minimum number of observed pods of an option to right-size
+                it""",
+    )
+    rightsizing_interval = Integer(
+        3600,
+        config=True,
+        help="""Seconds between updates of the right-sized guarantees""",
+    )
+    rightsizing_dry_run = Bool(
+        False,
+        config=True,
+        help="""Whether to only log the right-sizing report (with the
+                projected node packing) without changing the guarantees""",
+    )
+    rightsizing_node_cpu = Float(
+        8,
+        config=True,
+        help="""Allocatable cores of a node, for the right-sizing report""",
+    )
+    rightsizing_node_memory = ByteSpecification(
+        "32G",
+        config=True,
+        help="""Allocatable memory of a node, for the right-sizing report""",
+    )
+
+    allowed_profiles = List()
+    resource_catalog = Instance(ResourceCatalog, allow_none=True)
+
+    # shared by all spawners, keyed by the fingerprint of the inputs
+    _profiles_cache = collections.OrderedDict()
+    profiles_cache_stats = collections.Counter()
+    _profiles_fingerprint = None
+    _prepuller = None
+    _warm_pool = None
+    _right_sizer = None
+    _gpu_admission = None
+    _spawn_scheduler = None
+    _spawn_ticket = None
+    _token_rotator = None
+    # Secret with the rotated token of the server
+    _token_secret = ""
+    # GPU admission of the current start, _gpu_checked once it is known
+    # whether it needs GPUs
+    _gpu_ticket = None
+    _gpu_checked = False
+    _namespace_manager = None
+    # context of the auth_state, for the right-sized guarantees
+    _context = ""
+    _user_options_loaded = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        tracing.setup(self.config)
         self.allowed_profiles = []
-        self.server_options = []
-        self._orig_volumes = self.volumes
-        self._orig_volume_mounts = self.volume_mounts
+        # traitlets gives every spawner its own copy of the configuration,
+        # share a frozen one instead
+        self.volume_mappings = frozen.intern(self.volume_mappings)
+        self.extra_profiles = frozen.intern(self.extra_profiles)
+        self.gpu_override = frozen.intern(self.gpu_override)
+        self._orig_volumes = frozen.intern(self.volumes)
+        self._orig_volume_mounts = frozen.intern(self.volume_mounts)
         if self.image_repo_override:
             # pylint: disable-next=access-member-before-definition
-            image = self.image.rsplit("/", 1)[-1]
-            self.image = f"{self.image_repo_override}/{image}"
+            self.image = self._override_image(self.image)
+        _start_services(self)
+
+    def _override_image(self, image):
+        return override_image(image, self.image_repo_override)
+
+    def get_rightsizing_report(self):
+        """Returns the right-sizing report (see RightSizer.report) of the
+        server options of every context with logins"""
+        return rightsizing_report(
+            self._right_sizer,
+            self.authenticator,
+            self.rightsizing_node_cpu,
+            self.rightsizing_node_memory,
+        )
+
+    def get_prepull_images(self):
+        """Returns the images to pre-pull as a dict with the default and the
+        gpu sets of images"""
+        return prepull_images(
+            self.authenticator,
+            self.server_options_names,
+            self.extra_profiles,
+            self.image_repo_override,
+        )
+
+    async def _start(self):
+        try:
+            await self.load_user_options()
+            self._user_options_loaded = True
+            await self._acquire_spawn_slot()
+            if self.context_namespaces and not self.enable_user_namespaces:
+                # KubeSpawner only ensures the namespace of user namespaces
+                await self._ensure_namespace()
+            url = await self._start_warm()
+            if url is not None:
+                return url
+            await self._admit_gpus()
+            url = await super()._start()
+            self._release_gpus(created=True)
+            return url
+        finally:
+            self._user_options_loaded = False
+            self._release_gpus()
+            self._release_spawn_slot()
+
+    def _spawn_queue_key(self):
+        return self.environment.get("D4SCIENCE_CONTEXT", "") or self.namespace
+
+    @tracing.traced("spawn_queue")
+    async def _acquire_spawn_slot(self):
+        """Waits for a slot of the spawn scheduler (if any)"""
+        if self._spawn_scheduler is None:
+            return
+        self._spawn_ticket = self._spawn_scheduler.enqueue(self._spawn_queue_key())
+        tracing.annotate(spawn_queued=not self._spawn_ticket.admitted)
+        await self._spawn_scheduler.wait(self._spawn_ticket)
+
+    def _release_spawn_slot(self):
+        if self._spawn_ticket is not None:
+            self._spawn_scheduler.release(self._spawn_ticket)
+        self._spawn_ticket = None
+
+    async def _make_create_pod_request(self, pod, request_timeout):
+        try:
+            if self._token_secret:
+                try:
+                    await self._write_token_secret()
+                except asyncio.TimeoutError:
+                    # just try again
+                    return False
+            created = await super()._make_create_pod_request(pod, request_timeout)
+        except ApiException as e:
+            if e.status != 404 or not self.context_namespaces:
+                raise
+            # the namespace was deleted out of band
+            self.log.warning("Namespace %s not found, creating it", self.namespace)
+            self.namespace_manager.forget(self.namespace)
+            await self._ensure_namespace()
+            return False
+        if created:
+            # the rest of the start is waiting for the pod
+            self._release_spawn_slot()
+            if self._token_secret:
+                await self._own_token_secret()
+        return created
+
+    async def _fresh_context_token(self):
+        return await self.authenticator.get_context_token(
+            self.user, self.token_rotation_ahead
+        )
+
+    async def _write_token_secret(self):
+        token = self.environment.get("D4SCIENCE_TOKEN", "")
+        labels = self._build_common_labels(self._expand_all(self.extra_labels))
+        await self._token_rotator.write(
+            self.namespace, self._token_secret, token, labels
+        )
+        self._token_rotator.add(
+            self.namespace, self._token_secret, self._fresh_context_token, token
+        )
+
+    async def _own_token_secret(self):
+        try:
+            pod = await asyncio.wait_for(
+                self.api.read_namespaced_pod(self.pod_name, self.namespace),
+                self.k8s_api_request_timeout,
+            )
+            await self._token_rotator.own(self.namespace, self._token_secret, pod)
+        except Exception as e:
+            # still deleted when the server stops
+            self.log.warning(
+                "Unable to set the owner of secret %s: %s", self._token_secret, e
+            )
+
+    async def stop(self, now=False):
+        await super().stop(now)
+        if self._token_secret and self._token_rotator is not None:
+            try:
+                await self._token_rotator.delete(self.namespace, self._token_secret)
+            except Exception as e:
+                self.log.warning(
+                    "Unable to delete secret %s: %s", self._token_secret, e
+                )
+
+    def get_state(self):
+        state = super().get_state()
+        if self._token_secret:
+            state["token_secret"] = self._token_secret
+        return state
+
+    def load_state(self, state):
+        super().load_state(state)
+        if "token_secret" in state and self._token_rotator is not None:
+            self._token_secret = state["token_secret"]
+            # the token in the Secret is unknown, replaced in the next round
+            self._token_rotator.add(
+                self.namespace, self._token_secret, self._fresh_context_token
+            )
+
+    def clear_state(self):
+        super().clear_state()
+        self._token_secret = ""
+
+    def _requested_gpus(self):
+        return int(self.extra_resource_limits.get(self.gpu_resource, 0) or 0)
+
+    @tracing.traced("gpu_admission")
+    async def _admit_gpus(self):
+        """Waits until the GPUs of the server (if any) are free"""
+        gpus = self._requested_gpus() if self._gpu_admission is not None else 0
+        if gpus:
+            if not self._gpu_admission.available(gpus):
+                raise RuntimeError(
+                    f"There are not {gpus} GPUs for this server, pick another one"
+                )
+            self._gpu_ticket = self._gpu_admission.enqueue(
+                self.environment.get("D4SCIENCE_CONTEXT", ""), gpus, self.pod_name
+            )
+        self._gpu_checked = True
+        if self._gpu_ticket is None:
+            return
+        tracing.annotate(gpu_queued=not self._gpu_ticket.admitted)
+        if self._gpu_ticket.admitted:
+            return
+        self.log.info(
+            "Spawn of %s waiting for %d GPUs, %d spawns ahead",
+            self._log_name,
+            gpus,
+            self._gpu_admission.position(self._gpu_ticket),
+        )
+        # do not hold a start slot while waiting
+        self._release_spawn_slot()
+        try:
+            await self._gpu_admission.wait(
+                self._gpu_ticket, self.gpu_queue_timeout or None
+            )
+        except asyncio.TimeoutError:
+            raise RuntimeError(
+                f"No GPU was available in {self.gpu_queue_timeout} seconds"
+            )
+        await self._acquire_spawn_slot()
+
+    def _release_gpus(self, created=False):
+        if self._gpu_ticket is not None:
+            self._gpu_admission.release(self._gpu_ticket, created=created)
+        self._gpu_ticket = None
+        self._gpu_checked = False
+
+    async def progress(self):
+        async for event in self._queue_progress():
+            yield event
+        async for event in super().progress():
+            yield event
+
+    def _queue_message(self):
+        slot, gpu = self._spawn_ticket, self._gpu_ticket
+        if slot is not None and not slot.admitted:
+            return scheduler.describe_position(
+                self._spawn_scheduler.position(slot),
+                self._spawn_scheduler.depth(slot.context),
+            )
+        if gpu is not None and not gpu.admitted:
+            return admission.describe_position(self._gpu_admission.position(gpu))
+        return None
+
+    async def _queue_progress(self):
+        """Yields the position of the spawn in the spawn and GPU queues
+        until it gets through them"""
+        if self._spawn_scheduler is None and self._gpu_admission is None:
+            return
+        last = None
+        while not (self._start_future and self._start_future.done()):
+            message = self._queue_message()
+            if message is None and self._gpu_checked:
+                return
+            if message is not None and message != last:
+                yield {"message": message}
+            last = message
+            await asyncio.sleep(0.5)
+
+    @tracing.traced("warm_start")
+    async def _start_warm(self):
+        """Hands off a warm pod to the user, returns its url or None if
+        there is no suitable warm pod"""
+        if self._warm_pool is None:
+            return None
+        key = (
+            self.environment.get("D4SCIENCE_CONTEXT", ""),
+            self.user_options.get("profile", ""),
+        )
+        if (
+            not self._warm_pool.wants(key)
+            or self.namespace != self._warm_pool.namespace
+            or self.enable_user_namespaces
+            or self.internal_ssl
+            or self.services_enabled
+            or self.after_pod_created_hook
+        ):
+            return None
+        await self._start_watching_pods()
+        pod = await self.get_pod_manifest()
+        if self.modify_pod_hook:
+            pod = await maybe_future(self.modify_pod_hook(self, pod))
+        manifest = self.api.api_client.sanitize_for_serialization(pod)
+        identity = (
+            self.user.name,
+            safe_slug(self.user.name),
+            self.name,
+            self.pod_name,
+        )
+        split = warmpool.pod_template(manifest, identity=identity)
+        if split is None:
+            self.log.debug("Pod of %s cannot be warm", self._log_name)
+            return None
+        template, envs = split
+        self._warm_pool.register(key, template)
+        warm = self._warm_pool.claim(key, template)
+        tracing.annotate(warm_pod=warm is not None)
+        if warm is None:
+            return None
+        name = warm["metadata"]["name"]
+        self.log.info("Handing off warm pod %s to %s", name, self._log_name)
+        try:
+            await self._warm_pool.handoff(
+                warm,
+                envs,
+                manifest["metadata"].get("labels", {}),
+                manifest["metadata"].get("annotations", {}),
+            )
+        except Exception as e:
+            self.log.warning("Unable to hand off warm pod %s: %s", name, e)
+            await self._warm_pool.delete(name)
+            return None
+        self.pod_name = name
+        self.dns_name = self.dns_name_template.format(
+            namespace=self.namespace, name=self.pod_name
+        )
+        self.pod_id = warm["metadata"]["uid"]
+        return self._get_pod_url(warm)
+
+    @property
+    def namespace_manager(self):
+        if D4ScienceSpawner._namespace_manager is None:
+            D4ScienceSpawner._namespace_manager = NamespaceManager(
+                self.api,
+                labels=self.context_namespace_labels,
+                annotations=self.context_namespace_annotations,
+                objects=self.context_namespace_objects,
+                request_timeout=self.k8s_api_request_timeout,
+                ttl=self.context_namespace_ttl,
+                log=self.log,
+            )
+            metrics.CACHE_STATS.add(
+                "namespaces", D4ScienceSpawner._namespace_manager.stats
+            )
+        return D4ScienceSpawner._namespace_manager
 
     async def _ensure_namespace(self):
         if not self.context_namespaces:
-            super()._ensure_namespace()
+            await super()._ensure_namespace()
+            return
+        await self.namespace_manager.ensure(self.namespace)
 
     def get_args(self):
         args = super().get_args()
@@ -200,8 +1018,7 @@ class D4ScienceSpawner(KubeSpawner):
                         continue
                     name = profile.get("Name", "")
                     if name in self.server_options_names:
-                        option = p["ServerOption"]
-                        option.update({"server_option_name": name})
+                        option = dict(p["ServerOption"], server_option_name=name)
                         server_options.append(option)
                 elif p.get("VolumeOption", None):
                     volume_options[p["VolumeOption"]["Name"]] = p["VolumeOption"][
@@ -211,26 +1028,37 @@ class D4ScienceSpawner(KubeSpawner):
             self.log.debug("Unexpected resource response from D4Science")
         return server_options, volume_options
 
+    @tracing.traced("auth_state_hook")
     async def auth_state_hook(self, spawner, auth_state):
         if not auth_state:
             return
-        permissions = auth_state.get("permissions", [])
         roles = auth_state.get("roles", [])
         self.log.debug("Roles at hook: %s", roles)
-        self.allowed_profiles = [claim["rsname"] for claim in permissions]
-        resources = auth_state.get("resources", {})
-        self.server_options, volume_options = self.build_resource_options(
-            roles, resources
-        )
+        self.allowed_profiles = d4science_auth_state.allowed_profiles(auth_state)
+        self._context = unquote(auth_state.get("context", None) or "")
+        catalog = d4science_auth_state.load_catalog(auth_state)
+        if catalog is None:
+            # old auth_state with the whole document from the IS
+            server_options, volume_options = self.build_resource_options(
+                roles, auth_state.get("resources", {})
+            )
+            catalog = ResourceCatalog.intern(
+                [ServerOption.from_dict(opt) for opt in server_options],
+                [VolumeOption(*vol) for vol in volume_options.items()],
+            )
+        self.resource_catalog = catalog
 
-        self.volumes = self._orig_volumes.copy()
-        self.volume_mounts = self._orig_volume_mounts.copy()
-        for name, permission in volume_options.items():
+        # the lists are per spawner (hooks may add volumes), their items are
+        # shared by every spawner with the same volumes
+        volumes = list(self._orig_volumes)
+        volume_mounts = list(self._orig_volume_mounts)
+        for volume_option in catalog.volume_options:
+            name, permission = volume_option.name, volume_option.permission
             if name in self.volume_mappings:
                 vol_name = self.get_volume_name(name)
                 vol = {"name": (vol_name)}
                 vol.update(self.volume_mappings[name]["volume"])
-                self.volumes.append(vol)
+                volumes.append(frozen.intern(vol))
                 read_write = (permission == "Read-Write") or (
                     self.data_manager_role in roles
                 )
@@ -239,91 +1067,175 @@ class D4ScienceSpawner(KubeSpawner):
                     permission,
                     self.data_manager_role in roles,
                 )
-                self.volume_mounts.append(
-                    {
-                        "name": vol_name,
-                        "mountPath": self.volume_mappings[name]["mount_path"],
-                        "readOnly": not read_write,
-                    },
+                volume_mounts.append(
+                    frozen.intern(
+                        {
+                            "name": vol_name,
+                            "mountPath": self.volume_mappings[name]["mount_path"],
+                            "readOnly": not read_write,
+                        }
+                    ),
                 )
+        self.volumes = volumes
+        self.volume_mounts = volume_mounts
         self.log.debug("allowed: %s", self.allowed_profiles)
-        self.log.debug("opts: %s", self.server_options)
-        self.log.debug("volume_options %s", volume_options)
+        self.log.debug("%d server options", len(self.server_options))
+        self.log.debug("volume_options %s", catalog.volume_options)
         self.log.debug("volumes: %s", self.volumes)
         self.log.debug("volume_mounts: %s", self.volume_mounts)
         self.log.debug("volume_mappings: %s", self.volume_mappings)
 
-    def profile_list(self, spawner):
-        # returns the list of profiles built according to the permissions
-        # and resource definition that the authenticator obtained initially
-        profiles = []
+    @property
+    def server_options(self):
+        """Server options available for the user (as parsed by xmltodict)"""
+        if self.resource_catalog is None:
+            return []
+        return [
+            opt.as_dict()
+            for opt in self.resource_catalog.server_options
+            if opt.server_option_name in self.server_options_names
+        ]
+
+    @observe(
+        "resource_catalog",
+        "allowed_profiles",
+        "image_repo_override",
+        "gpu_override",
+        "extra_profiles",
+    )
+    def _profile_inputs_changed(self, change):
+        self._profiles_fingerprint = None
 
+    def _get_profiles_fingerprint(self):
+        if self._profiles_fingerprint is None:
+            catalog = self.resource_catalog
+            inputs = json.dumps(
+                [
+                    catalog.fingerprint if catalog is not None else None,
+                    self.allowed_profiles,
+                    self.image_repo_override,
+                    self.gpu_override,
+                    self.extra_profiles,
+                ],
+                sort_keys=True,
+                default=repr,
+            )
+            self._profiles_fingerprint = hashlib.sha256(inputs.encode()).hexdigest()
+        return self._profiles_fingerprint
+
+    @tracing.traced("profile_list")
+    def profile_list(self, spawner):
         # Requires python 3.9!
         server_option_name = (
             spawner.name.removeprefix(self.server_name_prefix)
             if spawner.name
             else self.default_server_option_name
         )
+        # profiles only depend on the inputs in the fingerprint, share them
+        # with any other spawner with the same inputs
+        key = (
+            self._get_profiles_fingerprint(),
+            server_option_name,
+            self._rightsizing_key(),
+            self._gpus_unavailable(),
+        )
+        profiles = self._profiles_cache.get(key, None)
+        tracing.annotate(profiles_cache="miss" if profiles is None else "hit")
+        if profiles is None:
+            self.profiles_cache_stats["miss"] += 1
+            profiles = self._build_profile_list(server_option_name)
+            self._profiles_cache[key] = profiles
+            while len(self._profiles_cache) > self.profiles_cache_size:
+                self._profiles_cache.popitem(last=False)
+        else:
+            self.profiles_cache_stats["hit"] += 1
+            self._profiles_cache.move_to_end(key)
+        return list(profiles)
 
-        if self.allowed_profiles and self.server_options:
-            for p in self.server_options:
-                auth_id = p.get("AuthId", "")
-                if auth_id not in self.allowed_profiles:
-                    continue
-                override = {}
-                name = p.get("Info", {}).get("Name", "")
-                if p.get("server_option_name", "") != server_option_name:
-                    self.log.debug(
-                        "Discarding %s as it uses %s",
-                        name,
-                        p.get("server_option_name", ""),
-                    )
-                    continue
-                if "ImageId" in p:
-                    image = p.get("ImageId", "")
-                    if self.image_repo_override:
-                        image = image.rsplit("/", 1)[-1]
-                        image = f"{self.image_repo_override}/{image}"
-                    override["image"] = image
-                if "Cut" in p:
-                    cut_info = []
-                    if "Cores" in p["Cut"]:
-                        override["cpu_limit"] = float(p["Cut"]["Cores"])
-                        override["cpu_guarantee"] = (
-                            1 if override["cpu_limit"] <= 4 else 2
-                        )
-                        cut_info.append(f"{p['Cut']['Cores']} Cores")
-                    if "Memory" in p["Cut"]:
-                        override["mem_limit"] = (
-                            "%(#text)s%(@unit)s" % p["Cut"]["Memory"]
-                        )
-                        cut_info.append(f"{override['mem_limit']} RAM")
-                    name += " - %s" % " / ".join(cut_info)
-                if p.get("@gpu", {}) == "true":
-                    override.update(self.gpu_override)
-                profile = {
-                    "display_name": name,
-                    "description": p.get("Info", {}).get("Description", ""),
-                    "slug": auth_id,
-                    "kubespawner_override": override,
-                    "default": p.get("@default", {}) == "true",
-                }
+    def _rightsizing_key(self):
+        """Returns what the right-sized guarantees of the profiles depend
+        on, None if they are not right-sized"""
+        if self._right_sizer is None or self.rightsizing_dry_run:
+            return None
+        return (self._context, self._right_sizer.generation)
+
+    def _build_profile_list(self, server_option_name):
+        # returns the list of profiles built according to the permissions
+        # and resource definition that the authenticator obtained initially
+        profiles = []
+
+        if (
+            self.allowed_profiles
+            and self.resource_catalog is not None
+            and server_option_name in self.server_options_names
+        ):
+            for opt in self.resource_catalog.view(
+                self.allowed_profiles, server_option_name
+            ):
+                profile = self._build_profile(opt)
                 if profile["default"]:
                     profiles.insert(0, profile)
                 else:
                     profiles.append(profile)
         if self.extra_profiles:
             profiles.extend(self.extra_profiles)
+        if self._gpus_unavailable():
+            profiles = [self._mark_unavailable(profile) for profile in profiles]
         sorted_profiles = sorted(profiles, key=lambda x: x["display_name"])
         self.log.debug("Profiles: %s", sorted_profiles)
         return sorted_profiles
 
+    def _gpus_unavailable(self):
+        return self._gpu_admission is not None and not self._gpu_admission.available()
+
+    def _mark_unavailable(self, profile):
+        override = profile.get("kubespawner_override", {})
+        if not override.get("extra_resource_limits", {}).get(self.gpu_resource):
+            return profile
+        return frozen.intern(
+            dict(
+                profile,
+                display_name=f"{profile['display_name']} (unavailable: no GPUs)",
+                default=False,
+            )
+        )
+
+    def _build_profile(self, opt):
+        override = {}
+        name = opt.name
+        if opt.image is not None:
+            override["image"] = self._override_image(opt.image)
+        cut_info = []
+        if opt.cores is not None:
+            override["cpu_limit"] = float(opt.cores)
+            override["cpu_guarantee"] = 1 if override["cpu_limit"] <= 4 else 2
+            cut_info.append(f"{opt.cores} Cores")
+        if opt.memory is not None:
+            override["mem_limit"] = f"{opt.memory}{opt.memory_unit or ''}"
+            cut_info.append(f"{override['mem_limit']} RAM")
+        if self._rightsizing_key() is not None:
+            override.update(self._right_sizer.override(self._context, opt))
+        if cut_info:
+            name += " - %s" % " / ".join(cut_info)
+        if opt.gpu:
+            override.update(self.gpu_override)
+        # KubeSpawner deep copies the profiles before using them
+        return frozen.intern(
+            {
+                "display_name": name,
+                "description": opt.description,
+                "slug": opt.auth_id,
+                "kubespawner_override": override,
+                "default": opt.default,
+            }
+        )
+
     def _configure_workspace(self, spawner):
         token = spawner.environment.get("D4SCIENCE_TOKEN", "")
         if not token:
             self.log.debug("Not configuring workspace access, there is no token")
             return
-        if self.use_sidecar:
+        if self.use_sidecar and not self.use_storage_daemon:
             sidecar = {
                 "name": "workspace-sidecar",
                 "image": self.sidecar_image,
@@ -341,16 +1253,111 @@ class D4ScienceSpawner(KubeSpawner):
                     },
                 },
             }
+            if self.sidecar_command:
+                sidecar["command"] = self.sidecar_command
             spawner.extra_containers.append(sidecar)
+        elif self.use_storage_daemon:
+            self._configure_storage_daemon(spawner)
         else:
             spawner.container_security_context = self.workspace_security_context
 
+    def _configure_storage_daemon(self, spawner):
+        # the key of the mount is only known by the pod
+        key = f"{spawner.pod_name}-{secrets.token_hex(8)}"
+        # the pod only sees its own socket
+        socket_dir = "/run/d4science-storage"
+        socket_path = os.path.join(socket_dir, storage_daemon.SOCKET_NAME)
+
+        def client(op):
+            return ["python3", "-c", storage_daemon.CLIENT, socket_path, op]
+
+        # the server starts while the workspace is mounted, as with the
+        # sidecar, it shows up in /workspace with the mount propagation
+        spawner.lifecycle_hooks = dict(
+            spawner.lifecycle_hooks,
+            postStart={"exec": {"command": client("mount")}},
+            preStop={"exec": {"command": client("umount")}},
+        )
+        names = ("workspace", "storage-daemon")
+        spawner.volumes = [v for v in spawner.volumes if v["name"] not in names] + [
+            {
+                "name": "workspace",
+                "hostPath": {
+                    "path": os.path.join(self.storage_daemon_mounts_path, key),
+                    # the daemon mounts the workspace in it
+                    "type": "DirectoryOrCreate",
+                },
+            },
+            {
+                "name": "storage-daemon",
+                "hostPath": {
+                    "path": os.path.join(self.storage_daemon_sockets_path, key),
+                    # the daemon serves the socket of the pod in it
+                    "type": "DirectoryOrCreate",
+                },
+            },
+        ]
+        volume_mounts = [
+            dict(m, mountPropagation="HostToContainer")
+            if m["name"] == "workspace"
+            else m
+            for m in spawner.volume_mounts
+            if m["name"] != "storage-daemon"
+        ]
+        if not any(m["name"] == "workspace" for m in volume_mounts):
+            volume_mounts.append(
+                {
+                    "name": "workspace",
+                    "mountPath": "/workspace",
+                    "mountPropagation": "HostToContainer",
+                }
+            )
+        spawner.volume_mounts = volume_mounts + [
+            {"name": "storage-daemon", "mountPath": socket_dir}
+        ]
+
+    def _configure_token_rotation(self, spawner):
+        if self._token_rotator is None or not spawner.environment.get(
+            "D4SCIENCE_TOKEN", ""
+        ):
+            return
+        spawner._token_secret = f"{spawner.pod_name}-d4science-token"
+        path = self.token_rotation_mount_path
+        spawner.environment["D4SCIENCE_TOKEN_FILE"] = os.path.join(
+            path, token_rotation.TOKEN_KEY
+        )
+        mount = {"name": "d4science-token", "mountPath": path, "readOnly": True}
+        volume = {
+            "name": "d4science-token",
+            "secret": {"secretName": spawner._token_secret},
+        }
+        spawner.volumes = [
+            v for v in spawner.volumes if v["name"] != "d4science-token"
+        ] + [volume]
+        spawner.volume_mounts = [
+            m for m in spawner.volume_mounts if m["name"] != "d4science-token"
+        ] + [mount]
+        for container in spawner.extra_containers:
+            if container["name"] == "workspace-sidecar":
+                container["env"].append(
+                    {
+                        "name": "D4SCIENCE_TOKEN_FILE",
+                        "value": spawner.environment["D4SCIENCE_TOKEN_FILE"],
+                    }
+                )
+                container["volumeMounts"].append(mount)
+
+    @tracing.traced("load_user_options")
     async def load_user_options(self):
+        if self._user_options_loaded:
+            # already loaded to look for a warm pod
+            return
         await super().load_user_options()
         if self.custom_user_options:
             self.log.info("Calling custom_user_options")
             await maybe_future(self.custom_user_options(self))
 
+    @tracing.traced("pre_spawn_hook")
     async def pre_spawn_hook(self, spawner):
         context = spawner.environment.get("D4SCIENCE_CONTEXT", "")
         if context:
@@ -360,6 +1367,14 @@ class D4ScienceSpawner(KubeSpawner):
             vre = context[context.rindex("/") + 1 :]
             spawner.log.debug("VRE: %s", vre)
             spawner.environment["VRE"] = vre
+        profile = spawner.user_options.get("profile", "")
+        if profile:
+            # the AuthId of the pod (needed for right-sizing)
+            spawner.extra_annotations["d4science_profile"] = profile
         # TODO(enolfc): check whether assigning to [] is safe
         spawner.extra_containers = []
         self._configure_workspace(spawner)
+        self._configure_token_rotation(spawner)
+
+
+metrics.CACHE_STATS.add("profiles", D4ScienceSpawner.profiles_cache_stats)
@@ -0,0 +1,235 @@
+"""Storage daemon mounting the D4Science workspaces of the pods of a node
+
+One daemon runs in every node (e.g. as a privileged DaemonSet with the
+storage image, the mounts directory as a hostPath with Bidirectional mount
+propagation and the sockets directory as a hostPath). Every pod gets its
+own directory <sockets>/<key> (a hostPath created by the kubelet), where
+the daemon serves a unix socket for that key only, so a pod can only mount
+and unmount its own workspace. The pods ask for their workspace through it
+(from the postStart and preStop hooks of the notebook container) with a
+JSON line:
+
+- {"op": "mount", "token": <D4Science token>}: mounts the workspace of the
+  token in <mounts>/<key>, running the mount command with MNTPATH and
+  D4SCIENCE_TOKEN in its environment (as the sidecar does)
+- {"op": "umount"}: unmounts it
+
+and get back {"ok": true} or {"ok": false, "error": <message>}. The pods
+consume <mounts>/<key> as a hostPath volume with HostToContainer
+propagation, see `D4ScienceSpawner.use_storage_daemon`. The mounts left by
+a previous run of the daemon are found in /proc/mounts.
+
+Usage: python -m d4science_hub.storage_daemon [--sockets PATH]
+           [--mounts PATH] [--mount-timeout 30] mount-command [args...]
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+from d4science_hub.cache import SingleFlight
+
+DEFAULT_SOCKETS = "/run/d4science-storage/sockets"
+DEFAULT_MOUNTS = "/var/lib/d4science-storage/mounts"
+SOCKET_NAME = "daemon.sock"
+
+# sends a request to the daemon, run in the pods with python3 and
+# D4SCIENCE_TOKEN in the environment. The socket shows up once the daemon
+# sees the directory of the pod
+CLIENT = r"""
+import json, os, socket, sys, time
+path, op = sys.argv[1:3]
+request = {"op": op}
+if op == "mount":
+    request["token"] = os.environ["D4SCIENCE_TOKEN"]
+deadline = time.monotonic() + 30
+while not os.path.exists(path) and time.monotonic() < deadline:
+    time.sleep(0.1)
+s = socket.socket(socket.AF_UNIX)
+s.connect(path)
+s.sendall(json.dumps(request).encode() + b"\n")
+reply = json.loads(s.makefile().readline() or "{}")
+if not reply.get("ok"):
+    sys.exit("Unable to %s the workspace: %s" % (op, reply.get("error")))
+"""
+
+KEY_RE = re.compile(r"^[a-z0-9][a-z0-9.-]{0,252}$")
+
+
+def mounted_keys(mounts_path, proc_mounts="/proc/mounts"):
+    """Returns the keys mounted in mounts_path according to proc_mounts"""
+    keys = set()
+    prefix = os.path.join(mounts_path, "")
+    with open(proc_mounts) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            # spaces and the like are escaped in octal
+            target = re.sub(
+                r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1]
+            )
+            if target.startswith(prefix):
+                key = target[len(prefix) :]
+                if KEY_RE.match(key):
+                    keys.add(key)
+    return keys
+
+
+class StorageDaemon:
+    """Mounts and unmounts workspaces on request, each key is mounted once"""
+
+    def __init__(
+        self,
+        mounts_path=DEFAULT_MOUNTS,
+        mount_command=(),
+        umount_command=("fusermount", "-uz"),
+        mount_timeout=30,
+        log=None,
+    ):
+        self.mounts_path = mounts_path
+        self.mount_command = list(mount_command)
+        self.umount_command = list(umount_command)
+        self.mount_timeout = mount_timeout
+        self.log = log or logging.getLogger(__name__)
+        # key -> mount process (None if mounted by a previous run)
+        self.mounts = {}
+        self.servers = {}
+        self._flight = SingleFlight()
+
+    def path(self, key):
+        if not KEY_RE.match(key or ""):
+            raise ValueError(f"Invalid key {key!r}")
+        return os.path.join(self.mounts_path, key)
+
+    def recover(self, proc_mounts="/proc/mounts"):
+        """Adopts the mounts left by a previous run of the daemon"""
+        for key in mounted_keys(self.mounts_path, proc_mounts):
+            self.log.info("Found mounted workspace %s", key)
+            self.mounts.setdefault(key, None)
+
+    async def _start_mount(self, path, token):
+        """Mounts the workspace of token in path, returns the mount process"""
+        env = dict(os.environ, MNTPATH=path, D4SCIENCE_TOKEN=token)
+        proc = await asyncio.create_subprocess_exec(*self.mount_command, env=env)
+        deadline = time.monotonic() + self.mount_timeout
+        while not os.path.ismount(path):
+            if proc.returncode is not None or time.monotonic() > deadline:
+                await self._stop_mount(path, proc)
+                raise RuntimeError("mount failed")
+            await asyncio.sleep(0.05)
+        return proc
+
+    async def _stop_mount(self, path, proc):
+        if os.path.ismount(path):
+            umount = await asyncio.create_subprocess_exec(*self.umount_command, path)
+            await umount.wait()
+        if proc is not None and proc.returncode is None:
+            proc.terminate()
+            await proc.wait()
+
+    async def _mount(self, key, token):
+        path = self.path(key)
+        os.makedirs(path, exist_ok=True)
+        self.mounts[key] = await self._start_mount(path, token)
+        self.log.info("Mounted workspace %s", key)
+
+    async def mount(self, key, token):
+        if key in self.mounts:
+            # e.g. the pod restarted
+            return
+        await self._flight.run(key, self._mount, key, token)
+
+    async def umount(self, key):
+        path = self.path(key)
+        # unmounted even if unknown, e.g. mounted before a restart
+        await self._stop_mount(path, self.mounts.pop(key, None))
+        shutil.rmtree(path, ignore_errors=True)
+        self.log.info("Unmounted workspace %s", key)
+
+    async def handle(self, key, reader, writer):
+        """Serves a request of the pod of key"""
+        done = False
+        try:
+            request = json.loads(await reader.readline())
+            if request.get("op") == "mount":
+                await self.mount(key, request.get("token", ""))
+            elif request.get("op") == "umount":
+                await self.umount(key)
+                done = True
+            else:
+                raise ValueError("Unknown operation")
+            reply = {"ok": True}
+        except Exception as e:
+            self.log.warning("Failed request of %s: %s", key, e)
+            reply = {"ok": False, "error": str(e)}
+        writer.write(json.dumps(reply).encode() + b"\n")
+        await writer.drain()
+        writer.close()
+        if done:
+            await self.close(key)
+
+    async def serve(self, sockets_path, key):
+        """Serves the socket of key in its directory under sockets_path"""
+        self.path(key)
+        socket_path = os.path.join(sockets_path, key, SOCKET_NAME)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(
+            functools.partial(self.handle, key), socket_path
+        )
+        # the pods do not run as root, only the pod of key sees the socket
+        os.chmod(socket_path, 0o666)
+        self.servers[key] = (sockets_path, server)
+        return server
+
+    async def close(self, key):
+        """Stops serving the socket of key and removes its directory"""
+        sockets_path, server = self.servers.pop(key, (None, None))
+        if server is None:
+            return
+        server.close()
+        await server.wait_closed()
+        shutil.rmtree(os.path.join(sockets_path, key), ignore_errors=True)
+
+    async def scan(self, sockets_path):
+        """Serves the sockets of the new directories in sockets_path"""
+        for key in os.listdir(sockets_path):
+            if key in self.servers or not KEY_RE.match(key):
+                continue
+            try:
+                await self.serve(sockets_path, key)
+            except OSError as e:
+                self.log.warning("Unable to serve %s: %s", key, e)
+
+    async def watch(self, sockets_path=DEFAULT_SOCKETS, interval=0.2):
+        """Serves the sockets of the pods as their directories show up"""
+        os.makedirs(sockets_path, exist_ok=True)
+        while True:
+            await self.scan(sockets_path)
+            await asyncio.sleep(interval)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sockets", default=DEFAULT_SOCKETS)
+    parser.add_argument("--mounts", default=DEFAULT_MOUNTS)
+    parser.add_argument("--mount-timeout", type=float, default=30)
+    parser.add_argument("mount_command", nargs="+")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    daemon = StorageDaemon(
+        args.mounts, args.mount_command, mount_timeout=args.mount_timeout
+    )
+    daemon.recover()
+    await daemon.watch(args.sockets)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,165 @@
+"""Rotation of the context tokens of the running servers
+
+The context token is baked in the environment of the pods at spawn time,
+so long running servers end up with an expired token. With token rotation
+the token is also kept in a Secret per server, mounted in the containers
+(Kubernetes updates the files of mounted Secrets), and `TokenRotator`
+replaces it with a fresh one before it expires. The fresh tokens come from
+the token cache of the authenticator, so the servers of a user in a context
+share the same token and refreshes.
+"""
+
+import asyncio
+import logging
+import time
+
+from kubernetes_asyncio.client.rest import ApiException
+
+from d4science_hub import metrics
+from d4science_hub.tokens import token_expiry
+
+TOKEN_KEY = "token"
+
+
+def secret_manifest(name, token, labels=None):
+    return {
+        "metadata": {"name": name, "labels": labels or {}},
+        "type": "Opaque",
+        "stringData": {TOKEN_KEY: token},
+    }
+
+
+class _Server:
+    __slots__ = ("fetch", "token", "expires")
+
+    def __init__(self, fetch, token):
+        self.fetch = fetch
+        self.token = token
+        self.expires = token_expiry(token) if token else 0
+
+
+class TokenRotator:
+    """Keeps the token Secrets of the servers fresh
+
+    `api` is a kubernetes CoreV1Api. Every server is registered with an
+    async `fetch()` returning a token valid for more than `ahead` seconds
+    (or None if there is none), which replaces the one in its Secret
+    within `ahead` seconds of its expiry.
+    """
+
+    def __init__(self, api, ahead=600, request_timeout=3, log=None):
+        self.api = api
+        self.ahead = ahead
+        self.request_timeout = request_timeout
+        self.log = log or logging.getLogger(__name__)
+        self._servers = {}
+
+    def __len__(self):
+        return len(self._servers)
+
+    def __contains__(self, key):
+        return key in self._servers
+
+    def add(self, namespace, name, fetch, token=None):
+        """Registers the Secret name in namespace, holding token (unknown if
+        None, so it is replaced in the next refresh)"""
+        self._servers[(namespace, name)] = _Server(fetch, token)
+
+    def remove(self, namespace, name):
+        self._servers.pop((namespace, name), None)
+
+    async def own(self, namespace, name, pod):
+        """Makes pod (a V1Pod) the owner of the Secret name in namespace, so
+        Kubernetes deletes it with the pod (e.g. when the pod is deleted
+        while the hub is down)"""
+        owner = {
+            "apiVersion": "v1",
+            "kind": "Pod",
+            "name": pod.metadata.name,
+            "uid": pod.metadata.uid,
+        }
+        patch = {"metadata": {"ownerReferences": [owner]}}
+        await asyncio.wait_for(
+            self.api.patch_namespaced_secret(name, namespace, patch),
+            self.request_timeout,
+        )
+
+    async def write(self, namespace, name, token, labels=None):
+        """Creates (or updates) the Secret name in namespace with token"""
+        body = secret_manifest(name, token, labels)
+        try:
+            await asyncio.wait_for(
+                self.api.create_namespaced_secret(namespace, body),
+                self.request_timeout,
+            )
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            # e.g. left by a previous start of the server
+            await asyncio.wait_for(
+                self.api.patch_namespaced_secret(name, namespace, body),
+                self.request_timeout,
+            )
+
+    async def delete(self, namespace, name):
+        """Unregisters and deletes the Secret name in namespace"""
+        self.remove(namespace, name)
+        try:
+            await asyncio.wait_for(
+                self.api.delete_namespaced_secret(name, namespace),
+                self.request_timeout,
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+    def due(self, now=None):
+        """Returns the (namespace, name) of the Secrets to rotate"""
+        now = now or time.time()
+        return [
+            key
+            for key, server in self._servers.items()
+            if server.expires - self.ahead <= now
+        ]
+
+    async def rotate(self, namespace, name):
+        """Replaces the token of the Secret if there is a newer one, returns
+        whether it was replaced"""
+        server = self._servers[(namespace, name)]
+        token = await server.fetch()
+        if not token or token == server.token:
+            return False
+        patch = {"stringData": {TOKEN_KEY: token}}
+        await asyncio.wait_for(
+            self.api.patch_namespaced_secret(name, namespace, patch),
+            self.request_timeout,
+        )
+        server.token = token
+        server.expires = token_expiry(token)
+        return True
+
+    async def _rotate(self, key):
+        try:
+            if await self.rotate(*key):
+                self.log.debug("Rotated the token of %s/%s", *key)
+                metrics.TOKEN_ROTATIONS.labels("rotated").inc()
+        except KeyError:
+            # removed meanwhile
+            pass
+        except Exception as e:
+            self.log.warning("Unable to rotate the token of %s/%s: %s", *key, e)
+            metrics.TOKEN_ROTATIONS.labels("failed").inc()
+
+    async def refresh(self):
+        """Rotates the tokens about to expire, failed rotations are tried
+        again in the next refresh"""
+        await asyncio.gather(*[self._rotate(key) for key in self.due()])
+
+    async def run(self, interval=60):
+        """Rotates the tokens about to expire every interval seconds"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.log.warning("Unable to rotate the tokens: %s", e)
+            await asyncio.sleep(interval)
@@ -0,0 +1,94 @@
+"""Cache of the UMA tokens obtained from Keycloak
+
+Tokens are kept per (user, context, audience) until they expire (minus a
+skew to account for clock differences and request latency).
+"""
+
+import collections
+import time
+
+import jwt
+
+from d4science_hub import tracing
+from d4science_hub.cache import SingleFlight
+
+
+def token_expiry(token):
+    """Returns the exp claim of a JWT without verifying it, 0 if it cannot
+    be read. Only use it with tokens that were verified before."""
+    try:
+        decoded = jwt.decode(token, options={"verify_signature": False})
+    except jwt.InvalidTokenError:
+        return 0
+    return decoded.get("exp", 0)
+
+
+class TokenCache:
+    """Caches (token, decoded token) tuples by key
+
+    At most max_size tokens are kept, dropping the least recently used.
+    """
+
+    def __init__(self, skew=60, max_size=10000):
+        self.skew = skew
+        self.max_size = max_size
+        self.stats = collections.Counter()
+        self._tokens = collections.OrderedDict()
+        self._inflight = SingleFlight()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def expires_in(self, key):
+        """Seconds until the token of key should be considered expired,
+        None if there is no token"""
+        if key not in self._tokens:
+            return None
+        _, decoded = self._tokens[key]
+        return decoded.get("exp", 0) - self.skew - time.time()
+
+    def get(self, key):
+        """Returns the (token, decoded) tuple of key if it is still valid"""
+        expires_in = self.expires_in(key)
+        if expires_in is None:
+            return None
+        if expires_in <= 0:
+            del self._tokens[key]
+            return None
+        self._tokens.move_to_end(key)
+        return self._tokens[key]
+
+    def put(self, key, token, decoded=None):
+        if decoded is None:
+            decoded = {"exp": token_expiry(token)}
+        self._tokens[key] = (token, decoded)
+        self._tokens.move_to_end(key)
+        while len(self._tokens) > self.max_size:
+            self._tokens.popitem(last=False)
+
+    def invalidate(self, user=None):
+        """Drops the tokens of user (of every user if None)"""
+        if user is None:
+            self._tokens.clear()
+            return
+        for key in [k for k in self._tokens if k[0] == user]:
+            del self._tokens[key]
+
+    async def fetch(self, key, fetch, force=False):
+        """Returns the cached token of key or gets a new one with fetch(),
+        which must return a (token, decoded) tuple. Concurrent fetches of the
+        same key are coalesced."""
+        if not force:
+            cached = self.get(key)
+            if cached is not None:
+                self.stats["hit"] += 1
+                tracing.annotate(token_cache="hit")
+                return cached
+        self.stats["miss"] += 1
+        tracing.annotate(token_cache="miss")
+        token, decoded = await self._inflight.run(key, fetch)
+        self.put(key, token, decoded)
+        return token, decoded
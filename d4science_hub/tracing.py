@@ -0,0 +1,270 @@
+"""Sampled traces of logins and spawns
+
+Opt-in: configure the D4ScienceTracer with a sample_rate > 0 (e.g.
+`c.D4ScienceTracer.sample_rate = 0.1`) and every sampled login or spawn hook
+is written to `c.D4ScienceTracer.path` with its nested spans (upstream
+requests, caches) as one JSON object per line, either in a simple format
+(jsonl) or as OpenTelemetry spans (otlp, as in the OTLP/JSON encoding).
+
+When the tracer is not configured or the trace is not sampled, span()
+returns a shared no-op span so the overhead is a couple of function calls.
+Finished traces are buffered and written to the file in a thread, off the
+event loop.
+"""
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import random
+import threading
+import time
+
+from traitlets import CaselessStrEnum, Float, Unicode
+from traitlets.config import SingletonConfigurable
+
+_current_span = contextvars.ContextVar("d4science_span", default=None)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    __slots__ = (
+        "tracer",
+        "trace",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "attributes",
+        "start",
+        "end",
+        "error",
+        "_token",
+    )
+
+    def __init__(self, tracer, name, parent=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = "%016x" % random.getrandbits(64)
+        if parent is None:
+            self.trace_id = "%032x" % random.getrandbits(128)
+            self.parent_id = None
+            self.trace = []
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.trace = parent.trace
+        self.attributes = dict(attributes or {})
+        self.start = self.end = None
+        self.error = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.time()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time()
+        if exc is not None:
+            self.error = repr(exc)
+        _current_span.reset(self._token)
+        self.trace.append(self)
+        if self.parent_id is None:
+            self.tracer.export(self.trace)
+        return False
+
+    def as_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": (self.end - self.start) * 1000,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def as_otlp(self):
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(self.start * 1e9)),
+            "endTimeUnixNano": str(int(self.end * 1e9)),
+            "attributes": [
+                {"key": k, "value": value(v)} for k, v in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class D4ScienceTracer(SingletonConfigurable):
+    sample_rate = Float(
+        0,
+        config=True,
+        help="""Fraction (0 to 1) of the logins and spawn hooks to trace,
+                0 disables tracing""",
+    )
+    path = Unicode(
+        "d4science-traces.jsonl",
+        config=True,
+        help="""File where the sampled traces are appended""",
+    )
+    format = CaselessStrEnum(
+        ["jsonl", "otlp"],
+        "jsonl",
+        config=True,
+        help="""Format of the spans in the file: jsonl (one span per line)
+                or otlp (one OTLP/JSON resourceSpans object per trace)""",
+    )
+    service_name = Unicode(
+        "jupyterhub",
+        config=True,
+        help="""service.name resource attribute of the otlp spans""",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._flushing = None
+
+    def span(self, name, **attributes):
+        parent = _current_span.get()
+        if parent is None:
+            if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+                return NOOP_SPAN
+        return Span(self, name, parent, attributes)
+
+    def _lines(self, trace):
+        if self.format == "otlp":
+            resource = {
+                "attributes": [
+                    {"key": "service.name", "value": {"stringValue": self.service_name}}
+                ]
+            }
+            scope_spans = [
+                {
+                    "scope": {"name": "d4science_hub"},
+                    "spans": [span.as_otlp() for span in trace],
+                }
+            ]
+            return [
+                {"resourceSpans": [{"resource": resource, "scopeSpans": scope_spans}]}
+            ]
+        return [span.as_dict() for span in trace]
+
+    def export(self, trace):
+        """Buffers the lines of the trace, written to the file in a thread
+        (right away outside of the event loop)"""
+        lines = "".join(json.dumps(line) + "\n" for line in self._lines(trace))
+        with self._lock:
+            self._buffer.append(lines)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write()
+            return
+        if self._flushing is None or self._flushing.done():
+            self._flushing = loop.create_task(self._flush())
+
+    async def _flush(self):
+        while self._buffer:
+            await asyncio.to_thread(self._write)
+
+    async def flush(self):
+        """Writes the buffered traces to the file"""
+        if self._flushing is not None:
+            await self._flushing
+        await self._flush()
+
+    def _write(self):
+        with self._lock:
+            lines = "".join(self._buffer)
+            self._buffer.clear()
+            if not lines:
+                return
+            try:
+                with open(self.path, "a") as f:
+                    f.write(lines)
+            except OSError as e:
+                self.log.warning("Unable to write trace to %s: %s", self.path, e)
+
+
+def span(name, **attributes):
+    """Returns a span (context manager) child of the current span, or a new
+    sampled trace if there is no current span"""
+    if not D4ScienceTracer.initialized():
+        return NOOP_SPAN
+    return D4ScienceTracer.instance().span(name, **attributes)
+
+
+def annotate(**attributes):
+    """Sets attributes (payload sizes, cache outcomes...) in the current span"""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def traced(name):
+    """Decorator tracing every call of the (sync or async) function"""
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def setup(config=None):
+    """Initializes the tracer with the given config (if not done yet)"""
+    if not D4ScienceTracer.initialized():
+        D4ScienceTracer.instance(config=config)
+    return D4ScienceTracer.instance()
@@ -0,0 +1,396 @@
+"""Pool of started, unassigned pods per (context, AuthId)
+
+Warm pods are created from the pod of the last spawn of each server option
+without its environment: the notebook container runs a small receiver on the
+notebook port that waits for the hand-off, and the other containers wait for
+a file in a shared volume. At spawn time the hub claims a warm pod whose
+spec matches the one the user would get, posts the environment (token,
+identity) of every container to the receiver, which starts the original
+commands, and relabels the pod as the user pod.
+
+Containers without an explicit command (e.g. using the image entrypoint)
+cannot wait for the hand-off, spawns of those pods are not pooled.
+"""
+
+import asyncio
+import copy
+import datetime
+import hashlib
+import json
+import logging
+import secrets
+
+from kubernetes_asyncio.client.rest import ApiException
+from tornado.httpclient import AsyncHTTPClient
+
+WARM_LABEL = "d4science.org/warm-pool"
+CONTEXT_ANNOTATION = "d4science.org/warm-context"
+AUTH_ID_ANNOTATION = "d4science.org/warm-auth-id"
+TEMPLATE_ANNOTATION = "d4science.org/warm-template"
+SECRET_ANNOTATION = "d4science.org/warm-secret"
+SECRET_ENV = "D4SCIENCE_HANDOFF_SECRET"
+HANDOFF_VOLUME = "d4science-handoff"
+HANDOFF_DIR = "/etc/d4science-handoff"
+
+# runs in the notebook container: writes the environment of the other
+# containers in HANDOFF_DIR and execs the notebook command with its own
+# argv: port, handoff dir, container name, command...
+RECEIVER = """
+import http.server, json, os, shlex, sys
+
+port, handoff_dir, name, cmd = int(sys.argv[1]), sys.argv[2], sys.argv[3], sys.argv[4:]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.headers.get("Authorization") != "token " + os.environ[%(secret)r]:
+            self.send_response(403)
+            self.end_headers()
+            return
+        envs = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        for container, env in envs.items():
+            if container == name:
+                continue
+            path = os.path.join(handoff_dir, container)
+            with open(path + ".tmp", "w") as f:
+                for k, v in env.items():
+                    f.write("export %%s=%%s\\n" %% (k, shlex.quote(v)))
+            os.rename(path + ".tmp", path)
+        self.server.env = envs.get(name, {})
+        self.send_response(200)
+        self.end_headers()
+
+
+server = http.server.HTTPServer(("", port), Handler)
+server.env = None
+while server.env is None:
+    server.handle_request()
+server.server_close()
+env = dict(os.environ)
+env.pop(%(secret)r)
+env.update(server.env)
+os.execvpe(cmd[0], cmd, env)
+""" % {"secret": SECRET_ENV}
+
+# runs in the other containers: $0 is the container name, $1 the handoff dir
+WAITER = 'f="$1/$0"; shift; while [ ! -s "$f" ]; do sleep 0.1; done; . "$f"; exec "$@"'
+
+
+def pool_size(size, now=None):
+    """Returns the size of a pool at the given time (now if None)
+
+    size is either a number or a dict of "HH:MM" to the size from that time
+    of the day on"""
+    if not isinstance(size, dict):
+        return int(size)
+    if not size:
+        return 0
+    now = now or datetime.datetime.now().time()
+    schedule = sorted(
+        (datetime.time.fromisoformat(start), int(n)) for start, n in size.items()
+    )
+    # before the first entry of the day, the last one of the previous day
+    current = schedule[-1][1]
+    for start, n in schedule:
+        if start <= now:
+            current = n
+    return current
+
+
+def pod_template(manifest, notebook_container="notebook", identity=()):
+    """Splits a pod manifest (as a dict) into the user independent template
+    of its warm pods and the environment of every container
+
+    Returns None if the pod cannot be warm: any container without command or
+    a spec with any of the identity strings (user name, server name) once the
+    environment is removed. Labels with identity strings are left out."""
+    spec = copy.deepcopy(manifest["spec"])
+    envs = {}
+    for container in spec.get("initContainers", None) or []:
+        if container.get("env"):
+            return None
+    for container in spec["containers"]:
+        if not container.get("command"):
+            # the entrypoint of the image would be skipped
+            return None
+        env = container.pop("env", None) or []
+        envs[container["name"]] = {e["name"]: e["value"] for e in env if "value" in e}
+        kept = [e for e in env if "value" not in e]
+        if kept:
+            container["env"] = kept
+    if notebook_container not in envs:
+        return None
+    serialized = json.dumps(spec, sort_keys=True)
+    if any(s and s in serialized for s in identity):
+        return None
+    labels = {
+        k: v
+        for k, v in (manifest["metadata"].get("labels", None) or {}).items()
+        if not any(s and s in v for s in identity)
+    }
+    template = {
+        "labels": labels,
+        "spec": spec,
+        "notebook_container": notebook_container,
+    }
+    return template, envs
+
+
+def template_fingerprint(template):
+    serialized = json.dumps(template, sort_keys=True)
+    return hashlib.sha256(serialized.encode()).hexdigest()[:16]
+
+
+def notebook_port(spec, notebook_container="notebook"):
+    for container in spec["containers"]:
+        if container["name"] == notebook_container:
+            for port in container.get("ports", None) or []:
+                if port.get("name") == "notebook-port":
+                    return port["containerPort"]
+    raise KeyError("No port 'notebook-port' in the notebook container")
+
+
+def warm_pod_manifest(name, template, context, auth_id, secret):
+    """Returns the manifest of a warm pod of the template"""
+    spec = copy.deepcopy(template["spec"])
+    notebook_container = template["notebook_container"]
+    port = notebook_port(spec, notebook_container)
+    mount = {"name": HANDOFF_VOLUME, "mountPath": HANDOFF_DIR}
+    for container in spec["containers"]:
+        argv = (container.pop("command", None) or []) + (
+            container.pop("args", None) or []
+        )
+        if container["name"] == notebook_container:
+            container["command"] = ["python3", "-c", RECEIVER]
+            container["args"] = [str(port), HANDOFF_DIR, container["name"]] + argv
+            container["env"] = (container.get("env", None) or []) + [
+                {"name": SECRET_ENV, "value": secret}
+            ]
+        else:
+            container["command"] = ["/bin/sh", "-c", WAITER]
+            container["args"] = [container["name"], HANDOFF_DIR] + argv
+        container["volumeMounts"] = (container.get("volumeMounts", None) or []) + [
+            mount
+        ]
+    spec["volumes"] = (spec.get("volumes", None) or []) + [
+        {"name": HANDOFF_VOLUME, "emptyDir": {}}
+    ]
+    pod_labels = dict(template["labels"])
+    pod_labels[WARM_LABEL] = template_fingerprint(template)
+    return {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {
+            "name": name,
+            "labels": pod_labels,
+            "annotations": {
+                CONTEXT_ANNOTATION: context,
+                AUTH_ID_ANNOTATION: auth_id,
+                TEMPLATE_ANNOTATION: json.dumps(template, sort_keys=True),
+                SECRET_ANNOTATION: secret,
+            },
+        },
+        "spec": spec,
+    }
+
+
+def is_ready(pod):
+    status = pod.get("status", None) or {}
+    return (
+        status.get("phase") == "Running"
+        and bool(status.get("podIP"))
+        and "deletionTimestamp" not in pod["metadata"]
+        and all(cs.get("ready") for cs in status.get("containerStatuses", None) or [])
+    )
+
+
+class WarmPool:
+    """Keeps warm pods of the (context, AuthId) keys in `sizes`
+
+    `api` is a kubernetes CoreV1Api, `sizes` a dict of context to a dict of
+    AuthId to the size of the pool (see pool_size). Pools are only filled
+    once a template (see pod_template) of the key is registered, either by a
+    spawn or found in the existing warm pods.
+    """
+
+    def __init__(
+        self,
+        api,
+        namespace,
+        sizes,
+        name_prefix="d4science-warm",
+        handoff_timeout=10,
+        http_client=None,
+        log=None,
+    ):
+        self.api = api
+        self.namespace = namespace
+        self.sizes = sizes
+        self.name_prefix = name_prefix
+        self.handoff_timeout = handoff_timeout
+        self.http_client = http_client
+        self.log = log or logging.getLogger(__name__)
+        self.templates = {}
+        # unclaimed warm pods by name, as of the last refresh
+        self.pods = {}
+        self._claimed = set()
+
+    def wants(self, key):
+        context, auth_id = key
+        return auth_id in self.sizes.get(context, {})
+
+    def size(self, key, now=None):
+        context, auth_id = key
+        return pool_size(self.sizes.get(context, {}).get(auth_id, 0), now)
+
+    def register(self, key, template):
+        if self.wants(key):
+            self.templates[key] = template
+
+    @staticmethod
+    def pod_key(pod):
+        annotations = pod["metadata"].get("annotations", None) or {}
+        return (
+            annotations.get(CONTEXT_ANNOTATION, ""),
+            annotations.get(AUTH_ID_ANNOTATION, ""),
+        )
+
+    async def refresh(self):
+        """Lists the warm pods"""
+        pod_list = await self.api.list_namespaced_pod(
+            self.namespace, label_selector=WARM_LABEL
+        )
+        pod_list = self.api.api_client.sanitize_for_serialization(pod_list)
+        pods = {}
+        for pod in pod_list["items"]:
+            name = pod["metadata"]["name"]
+            if name in self._claimed or "deletionTimestamp" in pod["metadata"]:
+                continue
+            pods[name] = pod
+            key = self.pod_key(pod)
+            if key not in self.templates and self.wants(key):
+                annotations = pod["metadata"]["annotations"]
+                self.templates[key] = json.loads(annotations[TEMPLATE_ANNOTATION])
+        # claimed pods are no longer listed once relabeled
+        listed = {pod["metadata"]["name"] for pod in pod_list["items"]}
+        self._claimed &= listed
+        self.pods = pods
+
+    def claim(self, key, template):
+        """Returns a ready warm pod of key built from the template (None if
+        there is none), which is no longer part of the pool"""
+        fingerprint = template_fingerprint(template)
+        for name, pod in self.pods.items():
+            if (
+                self.pod_key(pod) == key
+                and pod["metadata"]["labels"].get(WARM_LABEL) == fingerprint
+                and is_ready(pod)
+            ):
+                del self.pods[name]
+                self._claimed.add(name)
+                return pod
+        return None
+
+    async def handoff(self, pod, envs, labels, annotations):
+        """Starts the servers of the claimed pod with the environment of
+        each container and relabels it as the user pod"""
+        metadata = pod["metadata"]
+        name = metadata["name"]
+        port = notebook_port(pod["spec"], self._notebook_container(pod))
+        http_client = self.http_client or AsyncHTTPClient()
+        await http_client.fetch(
+            f"http://{pod['status']['podIP']}:{port}/",
+            method="POST",
+            headers={
+                "Authorization": f"token {metadata['annotations'][SECRET_ANNOTATION]}",
+                "Content-Type": "application/json",
+            },
+            body=json.dumps(envs),
+            request_timeout=self.handoff_timeout,
+        )
+        drop = {
+            k: None
+            for k in (
+                CONTEXT_ANNOTATION,
+                AUTH_ID_ANNOTATION,
+                TEMPLATE_ANNOTATION,
+                SECRET_ANNOTATION,
+            )
+        }
+        body = {
+            "metadata": {
+                "labels": {**labels, WARM_LABEL: None},
+                "annotations": {**drop, **annotations},
+            }
+        }
+        await self.api.patch_namespaced_pod(name, self.namespace, body)
+
+    @staticmethod
+    def _notebook_container(pod):
+        annotations = pod["metadata"]["annotations"]
+        return json.loads(annotations[TEMPLATE_ANNOTATION])["notebook_container"]
+
+    async def delete(self, name):
+        self.pods.pop(name, None)
+        try:
+            await self.api.delete_namespaced_pod(
+                name, self.namespace, grace_period_seconds=0
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+    async def _create(self, key, template):
+        name = f"{self.name_prefix}-{secrets.token_hex(5)}"
+        manifest = warm_pod_manifest(name, template, *key, secrets.token_hex(16))
+        self.log.info("Creating warm pod %s for %s", name, key)
+        await self.api.create_namespaced_pod(self.namespace, manifest)
+
+    async def replenish(self, now=None):
+        """Creates or deletes warm pods to match the size of every pool"""
+        await self.refresh()
+        by_key = {}
+        for pod in self.pods.values():
+            by_key.setdefault(self.pod_key(pod), []).append(pod)
+        tasks = []
+        for key, pods in by_key.items():
+            template = self.templates.get(key, None)
+            fingerprint = template_fingerprint(template) if template else None
+            if not self.wants(key):
+                pods, stale = [], pods
+            else:
+                stale = [
+                    p
+                    for p in pods
+                    if p["metadata"]["labels"][WARM_LABEL] != fingerprint
+                ]
+                pods = [p for p in pods if p not in stale]
+            # not ready pods first
+            pods.sort(key=is_ready)
+            extra = pods[: max(0, len(pods) - self.size(key, now))]
+            for pod in stale + extra:
+                tasks.append(self.delete(pod["metadata"]["name"]))
+        for key, template in self.templates.items():
+            missing = self.size(key, now) - len(
+                [
+                    p
+                    for p in by_key.get(key, [])
+                    if p["metadata"]["labels"][WARM_LABEL]
+                    == template_fingerprint(template)
+                ]
+            )
+            for _ in range(max(0, missing)):
+                tasks.append(self._create(key, template))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.log.warning("Unable to update the warm pool: %s", result)
+
+    async def run(self, interval=10):
+        """Replenishes the pools every interval seconds"""
+        while True:
+            try:
+                await self.replenish()
+            except Exception as e:
+                self.log.warning("Unable to update the warm pool: %s", e)
+            await asyncio.sleep(interval)
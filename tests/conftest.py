@@ -0,0 +1,78 @@
+"""Shared fixtures for the tests"""
+
+import pytest
+
+RESOURCES = b"""<?xml version="1.0" encoding="UTF-8"?>
+<genericResources>
+  <Resource version="0.4.x">
+    <ID>1</ID>
+    <Profile>
+      <SecondaryType>JupyterHub</SecondaryType>
+      <Name>ServerOption</Name>
+      <Body>
+        <ServerOption default="true" role="foo-role">
+          <AuthId>small-authid</AuthId>
+          <Info>
+            <Name>Small</Name>
+            <Description>A small server</Description>
+          </Info>
+          <ImageId>eginotebooks/d4science:latest</ImageId>
+          <Cut>
+            <Cores>2</Cores>
+            <Memory unit="GB">8</Memory>
+          </Cut>
+        </ServerOption>
+      </Body>
+    </Profile>
+  </Resource>
+  <Resource version="0.4.x">
+    <Profile>
+      <Name>RStudioServerOption</Name>
+      <Body>
+        <ServerOption gpu="true">
+          <AuthId>gpu-authid</AuthId>
+          <Info><Name>GPU</Name><Description>GPU server</Description></Info>
+        </ServerOption>
+      </Body>
+    </Profile>
+  </Resource>
+  <Resource version="0.4.x">
+    <Profile>
+      <Name>VolumeOption</Name>
+      <Body>
+        <VolumeOption>
+          <Name>Data Space</Name>
+          <Permission>Read-Only</Permission>
+        </VolumeOption>
+      </Body>
+    </Profile>
+  </Resource>
+  <Resource version="0.4.x">
+    <Profile><Name>Something else</Name><Body><Other>x</Other></Body></Profile>
+  </Resource>
+</genericResources>
+"""
+
+ENDPOINTS = b"""<serviceEndpoints>
+  <Resource>
+    <Profile>
+      <AccessPoint>
+        <Interface><Endpoint EntryName="GetCapabilities">http://a</Endpoint></Interface>
+      </AccessPoint>
+      <AccessPoint>
+        <Interface><Endpoint EntryName="Cluster">http://cluster</Endpoint></Interface>
+      </AccessPoint>
+    </Profile>
+  </Resource>
+</serviceEndpoints>
+"""
+
+
+@pytest.fixture
+def resources_xml():
+    return RESOURCES
+
+
+@pytest.fixture
+def endpoints_xml():
+    return ENDPOINTS
@@ -0,0 +1,131 @@
+"""Tests for the admission of GPU spawns"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from d4science_hub import admission
+
+POOL = {"pool": "gpu"}
+
+
+def gpu_pod(name, gpus=1, node="gpu-1", phase="Running"):
+    return {
+        "metadata": {"name": name},
+        "spec": {
+            "nodeName": node,
+            "containers": [
+                {"name": "notebook", "resources": {"limits": {"nvidia.com/gpu": gpus}}},
+                {"name": "sidecar", "resources": {}},
+            ],
+        },
+        "status": {"phase": phase},
+    }
+
+
+class FakeCoreApi:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.pods = {}
+        self.api_client = SimpleNamespace(sanitize_for_serialization=lambda o: o)
+
+    async def list_node(self, label_selector):
+        assert label_selector == "pool=gpu"
+        return {
+            "items": [
+                {
+                    "metadata": {"name": name},
+                    "spec": {},
+                    "status": {"allocatable": {"nvidia.com/gpu": str(gpus)}},
+                }
+                for name, gpus in self.nodes.items()
+            ]
+        }
+
+    async def list_pod_for_all_namespaces(self, field_selector):
+        node, phases = field_selector.split(",", 1)
+        assert phases == "status.phase!=Succeeded,status.phase!=Failed"
+        return {
+            "items": [
+                pod
+                for pod in self.pods.values()
+                if f"spec.nodeName={pod['spec']['nodeName']}" == node
+                and pod["status"]["phase"] not in ("Succeeded", "Failed")
+            ]
+        }
+
+    def add(self, pod):
+        self.pods[pod["metadata"]["name"]] = pod
+
+
+@pytest.mark.asyncio
+async def test_capacity():
+    api = FakeCoreApi({"gpu-1": 2, "gpu-2": 2})
+    api.add(gpu_pod("a"))
+    # pods not scheduled yet, in other nodes or done do not count
+    api.add(gpu_pod("b", node=None))
+    api.add(gpu_pod("c", node="cpu-1"))
+    api.add(gpu_pod("d", phase="Succeeded"))
+    gpus = admission.GpuAdmission(api, POOL)
+    assert gpus.capacity is None
+    assert gpus.available()
+    await gpus.refresh()
+    assert (gpus.capacity, gpus.allocated, gpus.free) == (4, 1, 3)
+
+    api.nodes = {}
+    await gpus.refresh()
+    assert not gpus.available()
+
+
+@pytest.mark.asyncio
+async def test_fair_queue():
+    api = FakeCoreApi({"gpu-1": 1})
+    gpus = admission.GpuAdmission(api, POOL)
+    await gpus.refresh()
+    first = gpus.enqueue("/gcube/a", 1, "a-0")
+    assert first.admitted
+    a1 = gpus.enqueue("/gcube/a", 1, "a-1")
+    a2 = gpus.enqueue("/gcube/a", 1, "a-2")
+    b1 = gpus.enqueue("/gcube/b", 1, "b-1")
+    assert [gpus.position(t) for t in (a1, a2, b1)] == [0, 2, 1]
+    assert len(gpus) == 3
+
+    # the pod of the admitted spawn holds the GPU until it is gone
+    await gpus.refresh()
+    assert gpus.free == 0
+    api.add(gpu_pod("a-0"))
+    gpus.release(first, created=True)
+    assert not a1.admitted
+    await gpus.refresh()
+    assert not a1.admitted
+    del api.pods["a-0"]
+    await gpus.refresh()
+    assert a1.admitted
+    assert [gpus.position(t) for t in (b1, a2)] == [0, 1]
+
+    # failed spawns free their GPU, contexts take turns
+    gpus.release(a1)
+    assert b1.admitted and not a2.admitted
+    gpus.release(b1)
+    assert a2.admitted
+
+
+@pytest.mark.asyncio
+async def test_wait():
+    api = FakeCoreApi({"gpu-1": 1})
+    gpus = admission.GpuAdmission(api, POOL)
+    await gpus.refresh()
+    first = gpus.enqueue("/gcube/a", 1, "a")
+    await gpus.wait(first)
+
+    second = gpus.enqueue("/gcube/b", 1, "b")
+    with pytest.raises(asyncio.TimeoutError):
+        await gpus.wait(second, timeout=0.01)
+    assert len(gpus) == 0
+
+    third = gpus.enqueue("/gcube/c", 1, "c")
+    waiter = asyncio.ensure_future(gpus.wait(third))
+    await asyncio.sleep(0)
+    gpus.release(first)
+    await waiter
+    assert third.admitted
@@ -0,0 +1,68 @@
+"""Tests for the auth_state format"""
+
+import json
+
+import pytest
+import xmltodict
+from d4science_hub import auth_state
+from d4science_hub.catalog import ResourceCatalog
+from d4science_hub.registry import parse
+from d4science_hub.spawner import D4ScienceSpawner
+
+PERMISSIONS = [
+    {"rsid": "1", "rsname": "small-authid", "scopes": ["access"]},
+    {"rsid": "2", "rsname": "gpu-authid"},
+]
+
+
+def make_catalog(document):
+    resources = parse(document)
+    return ResourceCatalog.intern(resources.server_options, resources.volume_options)
+
+
+def test_pack_load(resources_xml):
+    catalog = make_catalog(resources_xml)
+    state = json.loads(json.dumps(auth_state.pack(PERMISSIONS, ["foo-role"], catalog)))
+    assert state[auth_state.VERSION_KEY] == auth_state.VERSION
+    assert auth_state.allowed_profiles(state) == ["small-authid", "gpu-authid"]
+    # same options, same shared catalog
+    assert auth_state.load_catalog(state) is catalog
+    assert catalog.volume("Data Space").permission == "Read-Only"
+
+    # role filtering
+    state = auth_state.pack(PERMISSIONS, [], catalog)
+    options = auth_state.load_catalog(state).server_options
+    assert [o.auth_id for o in options] == ["gpu-authid"]
+
+
+@pytest.mark.asyncio
+async def test_old_and_new_formats(resources_xml):
+    roles = ["foo-role"]
+    old_state = {
+        "permissions": PERMISSIONS,
+        "roles": roles,
+        "resources": xmltodict.parse(resources_xml),
+    }
+    new_state = auth_state.pack(PERMISSIONS, roles, make_catalog(resources_xml))
+    assert auth_state.load_catalog(old_state) is None
+
+    spawner = D4ScienceSpawner(_mock=True)
+    spawner.volume_mappings = {
+        "Data Space": {"mount_path": "/data", "volume": {"emptyDir": {}}}
+    }
+    results = []
+    for state in (old_state, new_state):
+        await spawner.auth_state_hook(spawner, state)
+        results.append(
+            (
+                spawner.allowed_profiles,
+                spawner.server_options,
+                spawner.volumes,
+                spawner.volume_mounts,
+            )
+        )
+    assert results[0] == results[1]
+    assert [o["AuthId"] for o in results[1][1]] == ["small-authid", "gpu-authid"]
+    assert results[1][3] == [
+        {"name": "data-space", "mountPath": "/data", "readOnly": True}
+    ]
@@ -0,0 +1,342 @@
+"""Tests for the authenticator"""
+
+import asyncio
+import random
+import time
+from unittest import mock
+
+import pytest
+from d4science_hub import auth_state as d4science_auth_state
+from d4science_hub.authenticator import (
+    D4SCIENCE_STATE_KEY,
+    D4ScienceContextHandler,
+    D4ScienceOauthenticator,
+)
+from d4science_hub.catalog import ResourceCatalog
+from d4science_hub.registry import ServerOption
+from oauthenticator.generic import GenericOAuthenticator
+from oauthenticator.oauth2 import (
+    OAuthLoginHandler,
+    _deserialize_state,
+    _serialize_state,
+)
+from tornado import web
+from tornado.httpclient import HTTPError
+
+RESOURCES = ResourceCatalog(
+    server_options=(
+        ServerOption("ServerOption", "foo"),
+        ServerOption("ServerOption", "admin", role="admin"),
+    )
+)
+
+
+def uma_token(context, audience, access_token, extra_params={}):
+    if audience == "client":
+        decoded = {"authorization": {"permissions": [{"rsname": "foo"}]}}
+    else:
+        decoded = {"resource_access": {context: {"roles": ["member"]}}}
+    return f"token-{audience}", decoded
+
+
+async def slow_uma_token(*args, **kwargs):
+    await asyncio.sleep(0.1)
+    return uma_token(*args, **kwargs)
+
+
+def callback_handler(context="/gcube/vre", user="user", **params):
+    state = {"state_id": "id", D4SCIENCE_STATE_KEY: dict(params, context=context)}
+    handler = mock.MagicMock(user=user)
+    handler.get_state_cookie.return_value = _serialize_state(state)
+    return handler
+
+
+@pytest.fixture
+def authenticator():
+    auth = D4ScienceOauthenticator(client_id="client")
+    with mock.patch.object(
+        GenericOAuthenticator,
+        "authenticate",
+        return_value={"name": "user", "auth_state": {"access_token": "at"}},
+    ):
+        yield auth
+
+
+@pytest.mark.asyncio
+async def test_authenticate(authenticator):
+    authenticator.get_uma_token = mock.AsyncMock(side_effect=slow_uma_token)
+    authenticator.get_resources = mock.AsyncMock(return_value=RESOURCES)
+    authenticator.get_wps = mock.AsyncMock(return_value={"D4SCIENCE_WPS_URL": "wps"})
+    user_data = await authenticator.authenticate(callback_handler())
+    auth_state = user_data["auth_state"]
+    assert auth_state["context_token"] == "token-%2Fgcube%2Fvre"
+    assert auth_state["context"] == "%2Fgcube%2Fvre"
+    assert auth_state["namespace"] is None
+    assert auth_state["allowed_profiles"] == ["foo"]
+    assert auth_state["roles"] == ["member"]
+    assert auth_state["server_options"] == [["ServerOption", "foo"]]
+    assert "D4SCIENCE_WPS_URL" not in auth_state
+    authenticator.get_resources.assert_called_once_with(
+        "token-%2Fgcube%2Fvre", "%2Fgcube%2Fvre"
+    )
+
+
+@pytest.mark.asyncio
+async def test_authenticate_timeout(authenticator):
+    authenticator.login_step_timeouts = {"is_resources": 0.01}
+    authenticator.get_uma_token = mock.AsyncMock(side_effect=uma_token)
+    authenticator.get_resources = mock.AsyncMock(side_effect=slow_uma_token)
+    authenticator.get_wps = mock.AsyncMock(return_value={})
+    with pytest.raises(web.HTTPError):
+        await authenticator.authenticate(callback_handler())
+
+
+class FakeUser:
+    name = "user"
+
+    def __init__(self, auth_state):
+        self.auth_state = auth_state
+        self.saved = None
+
+    async def get_auth_state(self):
+        return self.auth_state
+
+    async def save_auth_state(self, auth_state):
+        self.saved = auth_state
+
+
+def expiring_uma_token(expires_in):
+    def get_uma_token(context, audience, access_token, extra_params={}):
+        if access_token == "expired":
+            raise web.HTTPError(403)
+        token, decoded = uma_token(context, audience, access_token, extra_params)
+        decoded["exp"] = time.time() + expires_in
+        return f"{token}-{access_token}", decoded
+
+    return get_uma_token
+
+
+async def login(authenticator, expires_in=3600):
+    authenticator.get_uma_token = mock.AsyncMock(
+        side_effect=expiring_uma_token(expires_in)
+    )
+    authenticator.get_resources = mock.AsyncMock(return_value=RESOURCES)
+    authenticator.get_wps = mock.AsyncMock(return_value={})
+    user_data = await authenticator.authenticate(callback_handler())
+    authenticator.get_uma_token.reset_mock()
+    return FakeUser(user_data["auth_state"])
+
+
+@pytest.mark.asyncio
+async def test_refresh_user_cached(authenticator):
+    user = await login(authenticator)
+    assert await authenticator.refresh_user(user) is True
+    authenticator.get_uma_token.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_refresh_user_expired(authenticator):
+    user = await login(authenticator, expires_in=30)
+    # same permissions, roles and context token, auth_state is not updated
+    assert await authenticator.refresh_user(user) is True
+    assert authenticator.get_uma_token.call_count == 2
+    authenticator.get_resources.assert_called_once()
+    # new context token, stored for a restart of the hub
+    user.auth_state["context_token"] = "old"
+    authenticator.token_cache.invalidate()
+    auth_model = await authenticator.refresh_user(user)
+    assert auth_model["auth_state"] == dict(
+        user.auth_state, context_token="token-%2Fgcube%2Fvre-at"
+    )
+    authenticator.get_resources.assert_called_once()
+    # new permissions
+    user.auth_state["allowed_profiles"] = []
+    authenticator.token_cache.invalidate()
+    auth_model = await authenticator.refresh_user(user)
+    assert auth_model["auth_state"]["allowed_profiles"] == ["foo"]
+    assert authenticator.get_resources.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_refresh_user_v1_state(authenticator):
+    user = await login(authenticator, expires_in=30)
+    # as stored by older versions
+    for key in list(user.auth_state):
+        if key in ("allowed_profiles", "server_options", "volume_options"):
+            del user.auth_state[key]
+    del user.auth_state[d4science_auth_state.VERSION_KEY]
+    user.auth_state.update(
+        {"permissions": [{"rsname": "foo"}], "resources": {"Resources": {}}}
+    )
+    auth_model = await authenticator.refresh_user(user)
+    auth_state = auth_model["auth_state"]
+    assert d4science_auth_state.version(auth_state) == d4science_auth_state.VERSION
+    assert auth_state["allowed_profiles"] == ["foo"]
+    assert auth_state["server_options"] == [["ServerOption", "foo"]]
+    assert "permissions" not in auth_state and "resources" not in auth_state
+
+
+@pytest.mark.asyncio
+async def test_refresh_user_background(authenticator):
+    user = await login(authenticator, expires_in=120)
+    user.auth_state["roles"] = ["old-role"]
+    assert await authenticator.refresh_user(user) is True
+    authenticator.get_uma_token.assert_not_called()
+    await asyncio.sleep(0.01)
+    assert authenticator.get_uma_token.call_count == 2
+    assert user.saved["roles"] == ["member"]
+
+
+@pytest.mark.asyncio
+async def test_refresh_user_refresh_token(authenticator):
+    user = await login(authenticator, expires_in=30)
+    user.auth_state.update({"access_token": "expired", "refresh_token": "rt"})
+    authenticator.get_token_info = mock.AsyncMock(return_value={"access_token": "new"})
+    auth_model = await authenticator.refresh_user(user)
+    auth_state = auth_model["auth_state"]
+    assert auth_state["access_token"] == "new"
+    assert auth_state["refresh_token"] == "rt"
+    assert auth_state["context_token"] == "token-%2Fgcube%2Fvre-new"
+    authenticator.get_token_info.side_effect = web.HTTPError(400)
+    authenticator.token_cache.invalidate()
+    assert await authenticator.refresh_user(user) is False
+
+
+@pytest.mark.asyncio
+async def test_get_context_token(authenticator):
+    user = await login(authenticator, expires_in=600)
+    token = "token-%2Fgcube%2Fvre-at"
+    assert await authenticator.get_context_token(user, min_ttl=300) == token
+    authenticator.get_uma_token.assert_not_called()
+    # about to expire for the caller, refreshed (once for concurrent calls)
+    authenticator.get_uma_token.side_effect = expiring_uma_token(3600)
+    user.auth_state["roles"] = ["old-role"]
+    tokens = await asyncio.gather(
+        *[authenticator.get_context_token(user, min_ttl=1200) for _ in range(3)]
+    )
+    assert tokens == [token] * 3
+    assert authenticator.get_uma_token.call_count == 2
+    assert user.saved["roles"] == ["member"]
+    key = ("user", "%2Fgcube%2Fvre", "%2Fgcube%2Fvre")
+    assert authenticator.token_cache.expires_in(key) > 3000
+    # unable to refresh, the token is still valid
+    user.auth_state["access_token"] = "expired"
+    assert await authenticator.get_context_token(user, min_ttl=3600) == token
+    assert await authenticator.get_context_token(FakeUser({})) is None
+
+
+@pytest.mark.asyncio
+async def test_pre_spawn_start_cached_token(authenticator):
+    user = await login(authenticator)
+    user.auth_state["context_token"] = "old"
+    spawner = mock.MagicMock(environment={})
+    await authenticator.pre_spawn_start(user, spawner)
+    assert spawner.environment["D4SCIENCE_TOKEN"] == "token-%2Fgcube%2Fvre-at"
+
+
+@pytest.mark.asyncio
+async def test_wps_discovery(authenticator):
+    authenticator.discover_wps = True
+    authenticator.get_uma_token = mock.AsyncMock(side_effect=uma_token)
+    authenticator.get_resources = mock.AsyncMock(return_value=RESOURCES)
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def fetch_wps(access_token, context, headers):
+        started.set()
+        await release.wait()
+        return "http://dataminer/wps", {}
+
+    authenticator._fetch_wps = mock.AsyncMock(side_effect=fetch_wps)
+    user_data = await authenticator.authenticate(callback_handler())
+    # the login does not wait for the DataMiner registry
+    assert "D4SCIENCE_WPS_URL" not in user_data["auth_state"]
+    await started.wait()
+    release.set()
+    user = FakeUser(user_data["auth_state"])
+    spawner = mock.MagicMock(environment={})
+    await authenticator.pre_spawn_start(user, spawner)
+    assert spawner.environment["DATAMINER_URL"] == "http://dataminer/wps"
+    # other logins and spawns in the context use the cached endpoint
+    await authenticator.authenticate(callback_handler(user="other"))
+    await authenticator.pre_spawn_start(user, spawner)
+    authenticator._fetch_wps.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_wps_discovery_failure(authenticator):
+    user = await login(authenticator)
+    del authenticator.get_wps
+    authenticator.discover_wps = True
+    authenticator._fetch_wps = mock.AsyncMock(side_effect=HTTPError(503))
+    spawner = mock.MagicMock(environment={})
+    await authenticator.pre_spawn_start(user, spawner)
+    assert "DATAMINER_URL" not in spawner.environment
+
+    # slow registry, spawns without it
+    authenticator.wps_spawn_timeout = 0.01
+
+    async def slow_fetch_wps(*args):
+        await asyncio.sleep(0.05)
+        raise HTTPError(503)
+
+    authenticator._fetch_wps = mock.AsyncMock(side_effect=slow_fetch_wps)
+    await authenticator.pre_spawn_start(user, spawner)
+    assert "DATAMINER_URL" not in spawner.environment
+    # endpoint from an old login
+    user.auth_state["D4SCIENCE_WPS_URL"] = "http://old/wps"
+    await authenticator.pre_spawn_start(user, spawner)
+    assert spawner.environment["DATAMINER_URL"] == "http://old/wps"
+    # let the lookup finish
+    await asyncio.sleep(0.1)
+
+
+def test_login_handler_state():
+    handler = D4ScienceContextHandler.__new__(D4ScienceContextHandler)
+    args = {"context": "/gcube/vre", "label": "blue-cloud"}
+    handler.get_argument = lambda name, default=None: args.get(name, default)
+    with mock.patch.object(OAuthLoginHandler, "set_state_cookie") as set_cookie:
+        handler.set_state_cookie(_serialize_state({"state_id": "id"}))
+    state = _deserialize_state(set_cookie.call_args[0][0])
+    assert state == {
+        "state_id": "id",
+        D4SCIENCE_STATE_KEY: {
+            "context": "/gcube/vre",
+            "namespace": None,
+            "label": "blue-cloud",
+        },
+    }
+
+
+@pytest.mark.asyncio
+async def test_concurrent_logins(authenticator):
+    # callbacks of logins from different VREs are interleaved, each one
+    # has to get the context and namespace of its own login
+    async def uma_token_delay(context, audience, access_token, extra_params={}):
+        await asyncio.sleep(random.random() / 100)
+        return uma_token(context, audience, access_token, extra_params)
+
+    authenticator.get_uma_token = mock.AsyncMock(side_effect=uma_token_delay)
+    authenticator.get_resources = mock.AsyncMock(return_value=RESOURCES)
+    authenticator.get_wps = mock.AsyncMock(return_value={})
+    logins = list(range(50))
+    random.shuffle(logins)
+
+    async def oauth_user(self, handler, data=None):
+        await asyncio.sleep(random.random() / 100)
+        return {"name": handler.user, "auth_state": {"access_token": "at"}}
+
+    with mock.patch.object(GenericOAuthenticator, "authenticate", oauth_user):
+        results = await asyncio.gather(
+            *[
+                authenticator.authenticate(
+                    callback_handler(f"/gcube/vre{i}", f"user{i}", namespace=f"ns{i}")
+                )
+                for i in logins
+            ]
+        )
+    for i, user_data in zip(logins, results):
+        auth_state = user_data["auth_state"]
+        assert auth_state["context"] == f"%2Fgcube%2Fvre{i}"
+        assert auth_state["namespace"] == f"ns{i}"
+        assert auth_state["context_token"] == f"token-%2Fgcube%2Fvre{i}"
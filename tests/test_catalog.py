@@ -0,0 +1,124 @@
+"""Tests for the Information System catalog cache"""
+
+import asyncio
+
+import pytest
+from d4science_hub.catalog import CatalogCache, ResourceCatalog
+from d4science_hub.registry import ServerOption, VolumeOption
+
+
+class FakeRegistry:
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.requests = []
+        self.body = "v1"
+        self.error = None
+
+    async def fetch(self, headers):
+        self.requests.append(headers)
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        etag = '"%s"' % self.body
+        if headers.get("If-None-Match") == etag:
+            return None, {"ETag": etag}
+        return self.body, {"ETag": etag}
+
+
+def age_entries(cache, seconds):
+    for entry in cache._entries.values():
+        entry.fetched_at -= seconds
+
+
+@pytest.mark.asyncio
+async def test_single_flight_miss():
+    registry = FakeRegistry()
+    cache = CatalogCache(ttl=60)
+    values = await asyncio.gather(
+        *[cache.get("ctx", registry.fetch) for _ in range(50)]
+    )
+    assert values == ["v1"] * 50
+    assert len(registry.requests) == 1
+    # fresh hit, no requests
+    assert await cache.get("ctx", registry.fetch) == "v1"
+    assert len(registry.requests) == 1
+    # other contexts are fetched on their own
+    await cache.get("other", registry.fetch)
+    assert len(registry.requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_conditional_revalidation():
+    registry = FakeRegistry()
+    cache = CatalogCache(ttl=60, stale_while_revalidate=0)
+    await cache.get("ctx", registry.fetch)
+    age_entries(cache, 61)
+    assert await cache.get("ctx", registry.fetch) == "v1"
+    assert registry.requests[-1] == {"If-None-Match": '"v1"'}
+    assert cache.stats["not_modified"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate():
+    registry = FakeRegistry()
+    cache = CatalogCache(ttl=60, stale_while_revalidate=60)
+    await cache.get("ctx", registry.fetch)
+    registry.body = "v2"
+    age_entries(cache, 90)
+    # stale value served, new one fetched in the background
+    assert await cache.get("ctx", registry.fetch) == "v1"
+    await asyncio.sleep(0.05)
+    assert await cache.get("ctx", registry.fetch) == "v2"
+    assert len(registry.requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_last_known_good():
+    registry = FakeRegistry()
+    cache = CatalogCache(
+        ttl=60, stale_while_revalidate=0, stale_if_error=600, revalidate_timeout=0.1
+    )
+    await cache.get("ctx", registry.fetch)
+    age_entries(cache, 120)
+    # registry is down
+    registry.error = OSError("down")
+    assert await cache.get("ctx", registry.fetch) == "v1"
+    # registry is slow
+    registry.error = None
+    registry.delay = 1
+    assert await cache.get("ctx", registry.fetch) == "v1"
+    assert cache.stats["stale_if_error"] == 2
+    # too old to be used
+    registry.error = OSError("down")
+    age_entries(cache, 1000)
+    await asyncio.sleep(1)
+    with pytest.raises(OSError):
+        await cache.get("ctx", registry.fetch)
+
+
+def test_resource_catalog_indexes():
+    options = [
+        ServerOption("ServerOption", "a"),
+        ServerOption("ServerOption", "b", role="manager"),
+        ServerOption("RStudioServerOption", "a"),
+        ServerOption("RStudioServerOption", "c", role="member"),
+    ]
+    catalog = ResourceCatalog.intern(options, [VolumeOption("vol", "Read-Write")])
+    assert (
+        ResourceCatalog.intern(list(options), [VolumeOption("vol", "Read-Write")])
+        is catalog
+    )
+    assert ResourceCatalog.intern(options[:2]) is not catalog
+
+    assert catalog.options_for_roles([]) == (options[0], options[2])
+    assert catalog.options_for_roles(["member", "other"]) == (
+        options[0],
+        options[2],
+        options[3],
+    )
+    assert catalog.view(["a", "c", "x"]) == (options[0], options[2], options[3])
+    assert catalog.view(["a", "b"], "ServerOption") == (options[0], options[1])
+    assert catalog.view(["a", "b"], "ServerOption", roles=[]) == (options[0],)
+    assert catalog.view(["a"], "webODVServerOption") == ()
+    assert catalog.volume("vol").permission == "Read-Write"
+    assert catalog.volume("other") is None
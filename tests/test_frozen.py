@@ -0,0 +1,50 @@
+"""Tests for the frozen, shared structures"""
+
+import copy
+import pickle
+
+import pytest
+from d4science_hub import frozen
+
+
+def test_intern():
+    value = frozen.intern({"a": [{"x": 1}], "b": "c"})
+    assert value == {"a": [{"x": 1}], "b": "c"}
+    assert frozen.intern({"a": [{"x": 1}], "b": "c"}) is value
+    # nested structures are shared too
+    assert frozen.intern([{"x": 1}]) is value["a"]
+    assert frozen.intern({"a": [{"x": "1"}], "b": "c"}) is not value
+    assert frozen.intern({"a": [{"x": True}], "b": "c"}) is not value
+    assert frozen.intern("foo") == "foo"
+    # tuples stay tuples, with their content interned
+    value = frozen.intern(("a", [{"x": 1}]))
+    assert type(value) is tuple and value[1] is frozen.intern([{"x": 1}])
+    # unhashable content, frozen but not shared
+    value = frozen.intern({"a": {1}})
+    assert isinstance(value, frozen.FrozenDict)
+    assert frozen.intern({"a": {1}}) is not value
+
+
+def test_immutable():
+    value = frozen.intern({"a": [{"x": 1}]})
+    with pytest.raises(TypeError):
+        value["b"] = 1
+    with pytest.raises(TypeError):
+        value.update(b=1)
+    with pytest.raises(TypeError):
+        value["a"].append(1)
+    with pytest.raises(TypeError):
+        value["a"][0].pop("x")
+
+
+def test_copy_on_write():
+    value = frozen.intern({"a": [{"x": 1}]})
+    thawed = copy.deepcopy(value)
+    thawed["a"][0]["x"] = 2
+    thawed["a"].append(3)
+    assert type(thawed) is dict and type(thawed["a"]) is list
+    assert value == {"a": [{"x": 1}]}
+    shallow = value.copy()
+    shallow["b"] = 2
+    assert "b" not in value
+    assert pickle.loads(pickle.dumps(value)) == value
@@ -0,0 +1,95 @@
+"""Tests for the upstream HTTP client"""
+
+from unittest import mock
+
+import pytest
+from d4science_hub.httpclient import CircuitOpenError, UpstreamClient
+from tornado.httpclient import HTTPClientError, HTTPRequest, HTTPResponse
+
+
+class FakeClient:
+    def __init__(self, codes):
+        self.codes = list(codes)
+        self.requests = []
+
+    async def fetch(self, req, raise_error=True):
+        self.requests.append(req)
+        code = self.codes.pop(0) if self.codes else 200
+        if code == 599:
+            raise HTTPClientError(599, "Timeout")
+        return HTTPResponse(req, code)
+
+
+def make_client(codes, **kwargs):
+    kwargs.setdefault("retry_backoff", 0)
+    return UpstreamClient(FakeClient(codes), **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_retry_idempotent():
+    client = make_client([503, 599])
+    resp = await client.fetch("is", "http://is")
+    assert resp.code == 200
+    assert len(client.client.requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_no_retry_post():
+    client = make_client([503])
+    req = HTTPRequest("http://token", method="POST", body="")
+    with pytest.raises(HTTPClientError) as e:
+        await client.fetch("token", req)
+    assert e.value.code == 503
+    assert len(client.client.requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_streaming_factory():
+    client = make_client([503])
+    chunks = []
+    req = HTTPRequest("http://is", streaming_callback=chunks.append)
+    with pytest.raises(HTTPClientError):
+        await client.fetch("is", req)
+    assert len(client.client.requests) == 1
+    resp = await client.fetch("is", lambda: req)
+    assert resp.code == 200
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    client = make_client([503] * 4, retries=0, failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        with pytest.raises(HTTPClientError):
+            await client.fetch("is", "http://is")
+    with pytest.raises(CircuitOpenError):
+        await client.fetch("is", "http://is")
+    assert len(client.client.requests) == 3
+    # other upstreams are not affected
+    assert client.breaker("oidc").allow()
+    now = client.breaker("is").opened_at
+    with mock.patch("d4science_hub.httpclient.time") as time:
+        # half-open: the trial request fails and the circuit opens again
+        time.monotonic.return_value = now + 31
+        with pytest.raises(HTTPClientError):
+            await client.fetch("is", "http://is")
+        with pytest.raises(CircuitOpenError):
+            await client.fetch("is", "http://is")
+        # next trial works and closes the circuit
+        time.monotonic.return_value = now + 62
+        assert (await client.fetch("is", "http://is")).code == 200
+    assert client.breaker("is").state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_upstream_timeouts():
+    client = make_client(
+        [],
+        connect_timeout=1,
+        request_timeout=2,
+        timeouts={"is": {"request_timeout": 60}},
+    )
+    await client.fetch("is", "http://is")
+    await client.fetch("oidc", "http://oidc")
+    is_req, oidc_req = client.client.requests
+    assert (is_req.connect_timeout, is_req.request_timeout) == (1, 60)
+    assert (oidc_req.connect_timeout, oidc_req.request_timeout) == (1, 2)
@@ -0,0 +1,94 @@
+"""Tests for the JWKS key store"""
+
+import asyncio
+import contextlib
+import json
+from unittest import mock
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from d4science_hub.jwks import JWKSKeyStore
+
+
+def make_jwk(kid):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+    jwk["kid"] = kid
+    return jwk
+
+
+class FakeOIDC:
+    def __init__(self, kids, cache_control=""):
+        self.jwks = {"keys": [make_jwk(kid) for kid in kids]}
+        self.cache_control = cache_control
+        self.calls = []
+
+    async def fetch(self, url):
+        self.calls.append(url)
+        await asyncio.sleep(0.01)
+        if url.endswith("openid-configuration"):
+            body = {"jwks_uri": "https://oidc/certs"}
+        else:
+            body = self.jwks
+        resp = mock.MagicMock()
+        resp.body = json.dumps(body).encode()
+        resp.headers = {"Cache-Control": self.cache_control}
+        return resp
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    oidc = FakeOIDC(["k1"])
+    store = JWKSKeyStore("https://oidc/", oidc.fetch)
+    results = await asyncio.gather(*[store.get_key("k1") for _ in range(20)])
+    assert len(set(id(k) for k in results)) == 1
+    # one discovery + one jwks
+    assert len(oidc.calls) == 2
+
+
+@contextlib.contextmanager
+def at_time(value):
+    with mock.patch("d4science_hub.jwks.time") as m_time:
+        m_time.monotonic.return_value = value
+        yield
+
+
+@pytest.mark.asyncio
+async def test_cache_control_ttl():
+    oidc = FakeOIDC(["k1"], cache_control="public, max-age=600")
+    store = JWKSKeyStore("https://oidc/", oidc.fetch, ttl=10, refresh_interval=0)
+    with at_time(1000):
+        await store.get_keys()
+    with at_time(1500):
+        await store.get_keys()
+    assert len(oidc.calls) == 2
+    with at_time(1700):
+        await store.get_keys()
+    assert len(oidc.calls) == 4
+
+
+@pytest.mark.asyncio
+async def test_unknown_kid_refresh():
+    oidc = FakeOIDC(["k1"])
+    store = JWKSKeyStore("https://oidc/", oidc.fetch, refresh_interval=30)
+    with at_time(1000):
+        await store.get_key("k1")
+        # key rotation upstream, but too soon to refresh again
+        oidc.jwks["keys"].append(make_jwk("k2"))
+        with pytest.raises(KeyError):
+            await store.get_key("k2")
+    assert len(oidc.calls) == 2
+    with at_time(1031):
+        assert await store.get_key("k2")
+    # discovery document is still cached
+    assert len(oidc.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_refresh_failure_keeps_keys():
+    oidc = FakeOIDC(["k1"], cache_control="max-age=0")
+    store = JWKSKeyStore("https://oidc/", oidc.fetch, refresh_interval=0)
+    key = await store.get_key("k1")
+    store.fetch = mock.AsyncMock(side_effect=OSError("down"))
+    assert await store.get_key("k1") is key
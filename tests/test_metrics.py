@@ -0,0 +1,56 @@
+"""Tests for the metrics"""
+
+import collections
+import io
+from unittest import mock
+
+import pytest
+from d4science_hub import metrics
+from d4science_hub.authenticator import D4ScienceOauthenticator
+from jupyterhub.metrics import metrics_prefix
+from prometheus_client import REGISTRY
+from tornado.httpclient import HTTPClientError, HTTPRequest, HTTPResponse
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(f"{metrics_prefix}_d4science_{name}", labels)
+
+
+def test_track_upstream():
+    labels = {"upstream": "wps", "context": "/gcube/test-track"}
+    with metrics.track_upstream("wps", "/gcube/test-track"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.track_upstream("wps", "/gcube/test-track"):
+            raise ValueError()
+    assert sample("upstream_request_duration_seconds_count", **labels) == 2
+    assert sample("upstream_request_errors_total", **labels) == 1
+
+
+def test_cache_stats():
+    stats = collections.Counter(hit=3)
+    metrics.CACHE_STATS.add("test", stats)
+    stats["miss"] += 1
+    assert sample("cache_requests_total", cache="test", result="hit") == 3
+    assert sample("cache_requests_total", cache="test", result="miss") == 1
+
+
+@pytest.mark.asyncio
+async def test_authenticator_fetch_metrics():
+    authenticator = D4ScienceOauthenticator(d4science_oidc_url="http://oidc/")
+    url = authenticator.key_store.discovery_url
+    client = mock.MagicMock()
+    client.fetch = mock.AsyncMock(
+        return_value=HTTPResponse(HTTPRequest(url), 200, buffer=io.BytesIO(b"x" * 100))
+    )
+    authenticator._upstream_client = client
+    before = sample(
+        "upstream_response_size_bytes_sum", upstream="discovery", context=""
+    )
+    await authenticator._fetch_url(url)
+    after = sample("upstream_response_size_bytes_sum", upstream="discovery", context="")
+    assert after - (before or 0) == 100
+    client.fetch.side_effect = HTTPClientError(500)
+    with pytest.raises(HTTPClientError):
+        await authenticator._fetch_url("http://oidc/certs")
+    assert sample("upstream_request_errors_total", upstream="jwks", context="") >= 1
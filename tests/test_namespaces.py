@@ -0,0 +1,139 @@
+"""Tests for the context namespaces"""
+
+import asyncio
+import collections
+import time
+from unittest import mock
+
+import pytest
+from d4science_hub.namespaces import NamespaceManager, create_method
+from d4science_hub.spawner import D4ScienceSpawner
+from kubernetes_asyncio.client.rest import ApiException
+
+
+class FakeCoreApi:
+    def __init__(self, existing=()):
+        self.objects = {("Namespace", None, name) for name in existing}
+        self.calls = collections.Counter()
+        self.fail = False
+
+    async def _create(self, kind, namespace, body):
+        self.calls[kind] += 1
+        # give other spawns the chance to run concurrently
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise ApiException(status=500)
+        key = (kind, namespace, body["metadata"]["name"])
+        if key in self.objects:
+            raise ApiException(status=409)
+        self.objects.add(key)
+
+    async def create_namespace(self, body):
+        await self._create("Namespace", None, body)
+
+    async def create_namespaced_resource_quota(self, namespace, body):
+        await self._create("ResourceQuota", namespace, body)
+
+    async def create_namespaced_persistent_volume_claim(self, namespace, body):
+        await self._create("PersistentVolumeClaim", namespace, body)
+
+
+OBJECTS = [
+    {"kind": "ResourceQuota", "metadata": {"name": "quota"}, "spec": {}},
+    {
+        "kind": "PersistentVolumeClaim",
+        "metadata": {"name": "{namespace}-shared"},
+        "spec": {},
+    },
+]
+
+
+def test_create_method():
+    assert create_method("ResourceQuota") == "create_namespaced_resource_quota"
+    assert create_method("PersistentVolumeClaim") == (
+        "create_namespaced_persistent_volume_claim"
+    )
+
+
+@pytest.mark.asyncio
+async def test_ensure_once():
+    api = FakeCoreApi()
+    manager = NamespaceManager(api, labels={"a": "b"}, objects=OBJECTS)
+    await asyncio.gather(*(manager.ensure("vre") for _ in range(20)))
+    assert api.calls == {
+        "Namespace": 1,
+        "ResourceQuota": 1,
+        "PersistentVolumeClaim": 1,
+    }
+    assert api.objects == {
+        ("Namespace", None, "vre"),
+        ("ResourceQuota", "vre", "quota"),
+        ("PersistentVolumeClaim", "vre", "vre-shared"),
+    }
+    assert OBJECTS[1]["metadata"]["name"] == "{namespace}-shared"
+    # no more API calls once ready
+    await manager.ensure("vre")
+    assert sum(api.calls.values()) == 3
+    assert manager.stats == {"miss": 20, "hit": 1}
+
+
+@pytest.mark.asyncio
+async def test_ensure_again():
+    api = FakeCoreApi()
+    manager = NamespaceManager(api, objects=OBJECTS, ttl=300)
+    await manager.ensure("vre")
+    # the quota is deleted out of band, created again after ttl
+    api.objects.discard(("ResourceQuota", "vre", "quota"))
+    await manager.ensure("vre")
+    assert api.calls["ResourceQuota"] == 1
+    manager.ready["vre"] = time.monotonic()
+    await manager.ensure("vre")
+    assert ("ResourceQuota", "vre", "quota") in api.objects
+    # or once forgotten
+    api.objects.clear()
+    manager.forget("vre")
+    await manager.ensure("vre")
+    assert ("Namespace", None, "vre") in api.objects
+
+
+@pytest.mark.asyncio
+async def test_ensure_existing_and_errors():
+    api = FakeCoreApi(existing=["vre"])
+    manager = NamespaceManager(api, objects=OBJECTS)
+    await manager.ensure("vre")
+    assert "vre" in manager.ready
+
+    api.fail = True
+    with pytest.raises(ApiException):
+        await manager.ensure("other")
+    assert "other" not in manager.ready
+    # retried on the next spawn
+    api.fail = False
+    await manager.ensure("other")
+    assert "other" in manager.ready
+
+
+@pytest.mark.asyncio
+async def test_spawner_ensure_namespace():
+    spawner = D4ScienceSpawner(_mock=True)
+    with mock.patch(
+        "kubespawner.KubeSpawner._ensure_namespace", new_callable=mock.AsyncMock
+    ) as ensure:
+        await spawner._ensure_namespace()
+    ensure.assert_awaited_once()
+
+    spawner = D4ScienceSpawner(_mock=True, context_namespaces=True)
+    spawner.namespace = "vre"
+    manager = mock.MagicMock(ensure=mock.AsyncMock())
+    with mock.patch.object(D4ScienceSpawner, "_namespace_manager", manager):
+        await spawner._ensure_namespace()
+    manager.ensure.assert_awaited_once_with("vre")
+
+    # namespace deleted out of band, created again and the pod retried
+    with mock.patch.object(D4ScienceSpawner, "_namespace_manager", manager), mock.patch(
+        "kubespawner.KubeSpawner._make_create_pod_request",
+        side_effect=ApiException(status=404),
+    ):
+        assert await spawner._make_create_pod_request(None, 10) is False
+    manager.forget.assert_called_once_with("vre")
+    assert manager.ensure.await_count == 2
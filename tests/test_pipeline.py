@@ -0,0 +1,69 @@
+"""Tests for the login pipeline"""
+
+import asyncio
+import time
+
+import pytest
+from d4science_hub.pipeline import Pipeline
+
+
+async def delayed(value, delay=0.1):
+    await asyncio.sleep(delay)
+    return value
+
+
+@pytest.mark.asyncio
+async def test_pipeline_concurrency():
+    pipeline = Pipeline()
+    pipeline.add("a", lambda: delayed("a"))
+    pipeline.add("b", lambda: delayed("b"))
+    pipeline.add("c", lambda b: delayed(b + "c"), requires=["b"])
+    pipeline.add("d", lambda a, b: delayed(a + b + "d"), requires=["a", "b"])
+    start = time.perf_counter()
+    results = await pipeline.run()
+    elapsed = time.perf_counter() - start
+    assert results == {"a": "a", "b": "b", "c": "bc", "d": "abd"}
+    # two levels of 0.1s, not four
+    assert elapsed < 0.3
+    assert set(pipeline.timings) == {"a", "b", "c", "d"}
+
+
+@pytest.mark.asyncio
+async def test_pipeline_failure_cancels():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fail():
+        raise ValueError("boom")
+
+    pipeline = Pipeline()
+    pipeline.add("slow", slow)
+    pipeline.add("fail", fail)
+    pipeline.add("after", lambda x: delayed(x), requires=["fail"])
+    with pytest.raises(ValueError):
+        await pipeline.run()
+    assert cancelled == [True]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_timeouts():
+    pipeline = Pipeline(timeout=0.05, timeouts={"fast": 1})
+    pipeline.add("fast", lambda: delayed("fast", 0.1))
+    pipeline.add("opt", lambda: delayed("opt", 1), optional=True, default={})
+    assert await pipeline.run() == {"fast": "fast", "opt": {}}
+
+    pipeline.add("slow", lambda: delayed("slow", 1))
+    with pytest.raises(asyncio.TimeoutError):
+        await pipeline.run()
+
+
+def test_pipeline_unknown_dependency():
+    pipeline = Pipeline()
+    with pytest.raises(ValueError):
+        pipeline.add("a", lambda x: delayed(x), requires=["x"])
@@ -0,0 +1,99 @@
+"""Tests for the image pre-puller"""
+
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from d4science_hub.catalog import ResourceCatalog
+from d4science_hub.prepuller import IMAGES_ANNOTATION, ImagePrePuller
+from d4science_hub.registry import ServerOption
+from d4science_hub.spawner import D4ScienceSpawner
+from kubernetes_asyncio.client.rest import ApiException
+
+
+class FakeAppsApi:
+    def __init__(self):
+        self.daemonsets = {}
+        self.calls = []
+
+    async def read_namespaced_daemon_set(self, name, namespace):
+        self.calls.append("read")
+        if (namespace, name) not in self.daemonsets:
+            raise ApiException(status=404)
+        body = self.daemonsets[(namespace, name)]
+        return SimpleNamespace(
+            metadata=SimpleNamespace(annotations=body["metadata"]["annotations"])
+        )
+
+    async def create_namespaced_daemon_set(self, namespace, body):
+        self.calls.append("create")
+        self.daemonsets[(namespace, body["metadata"]["name"])] = body
+
+    async def replace_namespaced_daemon_set(self, name, namespace, body):
+        self.calls.append("replace")
+        self.daemonsets[(namespace, name)] = body
+
+    async def delete_namespaced_daemon_set(self, name, namespace):
+        self.calls.append("delete")
+        del self.daemonsets[(namespace, name)]
+
+
+def pulled_images(daemonset):
+    return [c["image"] for c in daemonset["spec"]["template"]["spec"]["initContainers"]]
+
+
+@pytest.mark.asyncio
+async def test_sync():
+    api = FakeAppsApi()
+    gpu_selector = {"pool": "gpu"}
+    prepuller = ImagePrePuller(
+        api,
+        "jhub",
+        pools={"default": {}, "gpu": {"node_selector": gpu_selector}},
+    )
+    await prepuller.sync({"default": {"b", "a"}, "gpu": {"c"}})
+    default = api.daemonsets[("jhub", "d4science-prepuller")]
+    gpu = api.daemonsets[("jhub", "d4science-prepuller-gpu")]
+    assert pulled_images(default) == ["a", "b"]
+    assert "nodeSelector" not in default["spec"]["template"]["spec"]
+    assert pulled_images(gpu) == ["c"]
+    assert gpu["spec"]["template"]["spec"]["nodeSelector"] == gpu_selector
+    assert api.calls == ["read", "create", "read", "create"]
+
+    # no changes, no calls
+    api.calls.clear()
+    await prepuller.sync({"default": {"a", "b"}, "gpu": {"c"}})
+    assert api.calls == []
+
+    # a new prepuller (e.g. hub restart) does not replace unchanged DaemonSets
+    prepuller = ImagePrePuller(api, "jhub", pools=prepuller.pools)
+    await prepuller.sync({"default": {"a", "b", "d"}})
+    assert api.calls == ["read", "replace", "read", "delete"]
+    default = api.daemonsets[("jhub", "d4science-prepuller")]
+    assert pulled_images(default) == ["a", "b", "d"]
+    assert IMAGES_ANNOTATION in default["metadata"]["annotations"]
+    assert ("jhub", "d4science-prepuller-gpu") not in api.daemonsets
+
+
+@pytest.mark.asyncio
+async def test_spawner_prepull_images():
+    catalog = ResourceCatalog(
+        server_options=(
+            ServerOption("ServerOption", "a", image="eginotebooks/a:1"),
+            ServerOption("RStudioServerOption", "b", image="eginotebooks/b:1"),
+            ServerOption("ServerOption", "g", image="eginotebooks/g:1", gpu=True),
+            ServerOption("OtherOption", "o", image="eginotebooks/o:1"),
+            ServerOption("ServerOption", "n"),
+        )
+    )
+    spawner = D4ScienceSpawner(
+        _mock=True,
+        image_repo_override="myrepo",
+        extra_profiles=[{"kubespawner_override": {"image": "extra:1"}}],
+    )
+    spawner.authenticator = mock.MagicMock()
+    spawner.authenticator.catalog_cache.items.return_value = [("/gcube/vre", catalog)]
+    assert spawner.get_prepull_images() == {
+        "default": {"myrepo/a:1", "myrepo/b:1", "extra:1"},
+        "gpu": {"myrepo/g:1"},
+    }
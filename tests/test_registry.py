@@ -0,0 +1,46 @@
+"""Tests for the registry parser"""
+
+import xml.etree.ElementTree as ET
+
+import pytest
+import xmltodict
+from d4science_hub.registry import RegistryParser, parse
+from d4science_hub.spawner import D4ScienceSpawner
+
+
+def test_parse_chunks(resources_xml):
+    parser = RegistryParser()
+    for i in range(0, len(resources_xml), 7):
+        parser.feed(resources_xml[i : i + 7])
+    resources = parser.close()
+    assert [o.auth_id for o in resources.server_options] == [
+        "small-authid",
+        "gpu-authid",
+    ]
+    small, gpu = resources.server_options
+    assert small.server_option_name == "ServerOption"
+    assert (small.cores, small.memory, small.memory_unit) == ("2", "8", "GB")
+    assert small.default and not small.gpu and small.role == "foo-role"
+    assert gpu.gpu and gpu.image is None
+    assert [v.name for v in resources.volume_options] == ["Data Space"]
+
+
+@pytest.mark.asyncio
+async def test_compatibility_with_xmltodict(resources_xml):
+    spawner = D4ScienceSpawner(_mock=True)
+    roles = ["foo-role"]
+    expected = spawner.build_resource_options(roles, xmltodict.parse(resources_xml))
+    got = spawner.build_resource_options(roles, parse(resources_xml).as_dict())
+    assert got == expected
+
+
+def test_endpoints(endpoints_xml):
+    assert parse(endpoints_xml).endpoint("Cluster") == "http://cluster"
+    assert parse(endpoints_xml).endpoint("Foo") is None
+
+
+def test_parse_error():
+    parser = RegistryParser()
+    parser.feed(b"<html><body>Bad gateway</html>")
+    with pytest.raises(ET.ParseError):
+        parser.close()
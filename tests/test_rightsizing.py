@@ -0,0 +1,141 @@
+"""Tests for the right-sizing of the server options"""
+
+import dataclasses
+import json
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from d4science_hub import rightsizing
+from d4science_hub.registry import ServerOption
+
+GB = 2**30
+SMALL = ServerOption("ServerOption", "small", cores="2", memory="8", memory_unit="GB")
+BIG = ServerOption("ServerOption", "big", cores="8", memory="32", memory_unit="G")
+
+
+class StaticSource(rightsizing.UsageSource):
+    def __init__(self, usage):
+        self._usage = usage
+
+    async def usage(self):
+        return self._usage
+
+
+def test_parse_bytes():
+    assert rightsizing.parse_bytes("8GB") == 8 * GB
+    assert rightsizing.parse_bytes("8G") == 8 * GB
+    assert rightsizing.parse_bytes("512Mi") == 512 * 2**20
+    assert rightsizing.parse_bytes(1024) == 1024
+    with pytest.raises(ValueError):
+        rightsizing.parse_bytes("8X")
+
+
+def test_percentile():
+    assert rightsizing.percentile([3, 1, 2], 50) == 2
+    assert rightsizing.percentile(range(101), 95) == 95
+    assert rightsizing.percentile([1, 2], 50) == 1.5
+
+
+@pytest.mark.asyncio
+async def test_right_sizer():
+    usage = {
+        ("/gcube/vre", "small"): {
+            "cpu": [0.1 * i for i in range(1, 11)],
+            "memory": [GB] * 10,
+        },
+        # usage above the limits
+        ("/gcube/vre", "big"): {"cpu": [16] * 10, "memory": [64 * GB] * 10},
+        # not enough samples
+        ("/gcube/other", "small"): {"cpu": [0.1] * 3, "memory": [GB] * 3},
+    }
+    sizer = rightsizing.RightSizer(StaticSource(usage))
+    await sizer.refresh()
+    assert sizer.generation == 1
+    assert sizer.override("/gcube/vre", SMALL) == {
+        "cpu_guarantee": 0.955,
+        "mem_guarantee": "1229M",
+    }
+    assert sizer.requests("/gcube/vre", BIG) == (8, 32 * GB)
+    assert sizer.override("/gcube/other", SMALL) == {}
+    assert sizer.override("/gcube/vre", dataclasses.replace(SMALL, auth_id="x")) == {}
+
+    # unchanged usage keeps the generation
+    await sizer.refresh()
+    assert sizer.generation == 1
+
+
+@pytest.mark.asyncio
+async def test_report():
+    usage = {("/gcube/vre", "small"): {"cpu": [0.2] * 20, "memory": [GB] * 20}}
+    sizer = rightsizing.RightSizer(StaticSource(usage), memory_headroom=1)
+    await sizer.refresh()
+    report = sizer.report(
+        [("/gcube/vre", SMALL), ("/gcube/vre", BIG), ("/gcube/vre", SMALL)],
+        node_cpu=8,
+        node_memory=32 * GB,
+    )
+    [row] = report["options"]
+    assert row["pods"] == 20
+    # 1 core and 8G (the limit) before, 0.2 cores and 1G after
+    assert row["current"]["pods_per_node"] == 4
+    assert row["proposed"]["pods_per_node"] == 32
+    assert report["nodes"] == {"current": 5, "proposed": 1}
+    assert report["gain"] == 5
+    assert "5 -> 1 (5.00x)" in rightsizing.format_report(report)
+
+
+@pytest.mark.asyncio
+async def test_file_source(tmp_path):
+    path = tmp_path / "usage.json"
+    path.write_text(
+        json.dumps(
+            [{"context": "/gcube/vre", "auth_id": "small", "cpu": [1], "memory": [2]}]
+        )
+    )
+    source = rightsizing.source_from_url(f"file://{path}")
+    assert isinstance(source, rightsizing.FileUsageSource)
+    assert await source.usage() == {
+        ("/gcube/vre", "small"): {"cpu": [1.0], "memory": [2.0]}
+    }
+
+
+@pytest.mark.asyncio
+async def test_prometheus_source():
+    def result(values):
+        return json.dumps(
+            {
+                "status": "success",
+                "data": {
+                    "resultType": "vector",
+                    "result": [
+                        {
+                            "metric": {
+                                "pod": pod,
+                                "annotation_d4science_context": "/gcube/vre",
+                                "annotation_d4science_profile": auth_id,
+                            },
+                            "value": [1700000000, value],
+                        }
+                        for pod, auth_id, value in values
+                    ],
+                },
+            }
+        )
+
+    async def fetch(url, **kwargs):
+        if "cpu" in url:
+            body = result([("a", "small", "0.5"), ("b", "small", "NaN")])
+        else:
+            body = result([("a", "small", "1024"), ("c", "", "1")])
+        return SimpleNamespace(body=body)
+
+    client = mock.MagicMock(fetch=mock.AsyncMock(side_effect=fetch))
+    source = rightsizing.PrometheusUsageSource(
+        "http://prometheus:9090/", http_client=client
+    )
+    assert await source.usage() == {
+        ("/gcube/vre", "small"): {"cpu": [0.5], "memory": [1024.0]}
+    }
+    url = client.fetch.call_args_list[0].args[0]
+    assert url.startswith("http://prometheus:9090/api/v1/query?query=")
@@ -0,0 +1,95 @@
+"""Tests for the spawn scheduler"""
+
+import asyncio
+
+import pytest
+from jupyterhub.metrics import metrics_prefix
+from prometheus_client import REGISTRY
+
+from d4science_hub import scheduler
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(f"{metrics_prefix}_d4science_{name}", labels)
+
+
+def admitted(tickets):
+    return [t.context for t in tickets if t.admitted]
+
+
+@pytest.mark.asyncio
+async def test_limits():
+    spawns = scheduler.SpawnScheduler(max_concurrent=3, max_per_context=2)
+    tickets = [spawns.enqueue(context) for context in "aaab"]
+    assert admitted(tickets) == ["a", "a", "b"]
+    assert spawns.depth("a") == 1
+    assert spawns.position(tickets[2]) == 0
+
+    late = spawns.enqueue("c")
+    # a is at its limit, c gets the slot
+    spawns.release(tickets[3])
+    assert late.admitted and not tickets[2].admitted
+    spawns.release(tickets[0])
+    assert tickets[2].admitted
+    assert len(spawns) == 0 and spawns.active == 3
+
+
+@pytest.mark.asyncio
+async def test_weighted_fair_queuing():
+    spawns = scheduler.SpawnScheduler(max_concurrent=1, weights={"b": 2})
+    first = spawns.enqueue("a")
+    # a course starts: a hundred spawns of a before those of b and c
+    tickets = [spawns.enqueue("a") for _ in range(100)]
+    tickets += [spawns.enqueue("b") for _ in range(10)]
+    tickets += [spawns.enqueue("c") for _ in range(10)]
+    order = []
+    holder = first
+    for _ in range(12):
+        spawns.release(holder)
+        [holder] = [t for t in tickets if t.admitted]
+        tickets.remove(holder)
+        order.append(holder.context)
+    # b gets twice the slots of a and c
+    assert order.count("b") == 6
+    assert order.count("a") == 3 and order.count("c") == 3
+
+
+@pytest.mark.asyncio
+async def test_idle_context_credit():
+    spawns = scheduler.SpawnScheduler(max_concurrent=1)
+    holder = spawns.enqueue("a")
+    for _ in range(5):
+        spawns.release(holder)
+        holder = spawns.enqueue("a")
+    # b was idle meanwhile, it does not get the next 5 slots in a row
+    waiting = [spawns.enqueue("a") for _ in range(3)] + [
+        spawns.enqueue("b") for _ in range(3)
+    ]
+    order = []
+    for _ in range(4):
+        spawns.release(holder)
+        [holder] = [t for t in waiting if t.admitted]
+        waiting.remove(holder)
+        order.append(holder.context)
+    assert order in (["a", "b", "a", "b"], ["b", "a", "b", "a"])
+
+
+@pytest.mark.asyncio
+async def test_wait_and_metrics():
+    spawns = scheduler.SpawnScheduler(max_concurrent=1)
+    holder = spawns.enqueue("/gcube/test-scheduler")
+    ticket = spawns.enqueue("/gcube/test-scheduler")
+    assert sample("spawn_queue_depth", context="/gcube/test-scheduler") == 1
+    with pytest.raises(asyncio.TimeoutError):
+        await spawns.wait(ticket, timeout=0.01)
+    assert sample("spawn_queue_depth", context="/gcube/test-scheduler") == 0
+
+    ticket = spawns.enqueue("/gcube/test-scheduler")
+    waiter = asyncio.ensure_future(spawns.wait(ticket))
+    await asyncio.sleep(0.01)
+    spawns.release(holder)
+    await waiter
+    assert sample("spawns_starting", context="/gcube/test-scheduler") == 1
+    labels = {"context": "/gcube/test-scheduler"}
+    assert sample("spawn_queue_wait_seconds_count", **labels) == 2
+    assert sample("spawn_queue_wait_seconds_sum", **labels) >= 0.01
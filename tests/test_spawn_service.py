@@ -0,0 +1,272 @@
+"""Tests for the d4science_spawn service"""
+
+import json
+import re
+import socket
+import time
+from unittest import mock
+
+import pytest
+from d4science_hub.services import d4science_spawn
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler, create_signed_value
+
+SECRET = b"s" * 32
+
+
+@pytest.fixture
+def hub_auth():
+    d4science_spawn.SharedStateHubOAuth.clear_instance()
+    yield
+    d4science_spawn.SharedStateHubOAuth.clear_instance()
+
+
+def test_user_cache():
+    cache = d4science_spawn.UserCache(max_age=300, max_size=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["a"] = 3
+    cache["c"] = 4
+    assert "b" not in cache
+    assert (cache["a"], cache["c"]) == (3, 4)
+    assert len(cache) == 2
+    # least recently used
+    cache["d"] = 5
+    assert "a" not in cache and "c" in cache
+
+    cache = d4science_spawn.UserCache(max_age=300)
+    cache["a"] = 1
+    with mock.patch("time.monotonic", return_value=time.monotonic() + 301):
+        with pytest.raises(KeyError):
+            cache["a"]
+    assert len(cache) == 0
+
+
+def test_shared_state(hub_auth):
+    auth = d4science_spawn.SharedStateHubOAuth(state_secret=SECRET)
+    # e.g. another process
+    other = d4science_spawn.SharedStateHubOAuth(state_secret=SECRET)
+    state = auth.generate_state("/services/d4science/foo", code_verifier="v")
+    assert other.get_next_url(state) == "/services/d4science/foo"
+    assert other.get_code_verifier(state) == "v"
+    assert other.get_state_cookie_name(state) == other.state_cookie_name
+    state = auth.generate_state("/next", cookie_name="state-x")
+    assert other.get_state_cookie_name(state) == "state-x"
+    assert auth.generate_state("/next") != auth.generate_state("/next")
+    # different secret or tampered state
+    wrong = d4science_spawn.SharedStateHubOAuth(state_secret=b"o" * 32)
+    assert wrong.get_code_verifier(state) is None
+    assert wrong.get_next_url(state) == wrong.base_url
+    assert other.get_code_verifier(state[:-4] + "AAAA") is None
+
+
+def test_cookie_secret(monkeypatch, tmp_path):
+    monkeypatch.delenv("D4SCIENCE_SPAWN_COOKIE_SECRET", raising=False)
+    monkeypatch.delenv("D4SCIENCE_SPAWN_COOKIE_SECRET_FILE", raising=False)
+    assert d4science_spawn.get_cookie_secret() is None
+    path = tmp_path / "secret"
+    path.write_text(SECRET.hex() + "\n")
+    monkeypatch.setenv("D4SCIENCE_SPAWN_COOKIE_SECRET_FILE", str(path))
+    assert d4science_spawn.get_cookie_secret() == SECRET
+    monkeypatch.setenv("D4SCIENCE_SPAWN_COOKIE_SECRET", "00ff")
+    assert d4science_spawn.get_cookie_secret() == b"\x00\xff"
+
+
+class HubUserHandler(RequestHandler):
+    calls = 0
+
+    def get(self):
+        HubUserHandler.calls += 1
+        if self.request.headers.get("Authorization") != "token user-token":
+            self.set_status(403)
+            return
+        self.write({"kind": "user", "name": "alice", "scopes": []})
+
+
+def listen(app):
+    [sock] = bind_sockets(0, "127.0.0.1", family=socket.AF_INET)
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    return server, sock.getsockname()[1]
+
+
+@pytest.mark.asyncio
+async def test_redirect(hub_auth, monkeypatch):
+    hub, hub_port = listen(Application([("/hub/api/user", HubUserHandler)]))
+    monkeypatch.setenv("JUPYTERHUB_API_URL", f"http://127.0.0.1:{hub_port}/hub/api")
+    monkeypatch.setenv("JUPYTERHUB_API_TOKEN", "service-token")
+    monkeypatch.setenv("JUPYTERHUB_CLIENT_ID", "service-d4science")
+    monkeypatch.setenv("JUPYTERHUB_SERVICE_PREFIX", "/services/d4science")
+    service, port = listen(d4science_spawn.make_app(SECRET, user_cache_ttl=60))
+    cookie_name = d4science_spawn.SharedStateHubOAuth.instance().cookie_name
+    cookie = create_signed_value(SECRET, cookie_name, "user-token").decode()
+    client = AsyncHTTPClient()
+    try:
+        HubUserHandler.calls = 0
+        for _ in range(3):
+            resp = await client.fetch(
+                f"http://127.0.0.1:{port}/services/d4science/RStudio",
+                headers={"Cookie": f"{cookie_name}={cookie}"},
+                follow_redirects=False,
+                raise_error=False,
+            )
+            assert resp.code == 302
+            assert resp.headers["Location"] == "/hub/spawn/alice/rname-RStudio"
+        # validated once with the Hub
+        assert HubUserHandler.calls == 1
+
+        resp = await client.fetch(f"http://127.0.0.1:{port}/health")
+        assert resp.code == 200
+    finally:
+        service.stop()
+        hub.stop()
+
+
+@pytest.mark.asyncio
+async def test_oauth_callback(hub_auth, monkeypatch):
+    hub, hub_port = listen(Application([("/hub/api/user", HubUserHandler)]))
+    monkeypatch.setenv("JUPYTERHUB_API_URL", f"http://127.0.0.1:{hub_port}/hub/api")
+    monkeypatch.setenv("JUPYTERHUB_API_TOKEN", "service-token")
+    monkeypatch.setenv("JUPYTERHUB_CLIENT_ID", "service-d4science")
+    monkeypatch.setenv("JUPYTERHUB_SERVICE_PREFIX", "/services/d4science")
+    service, port = listen(d4science_spawn.make_app(SECRET))
+    auth = d4science_spawn.SharedStateHubOAuth.instance()
+    # generated by another process
+    other = d4science_spawn.SharedStateHubOAuth(state_secret=SECRET)
+    state = other.generate_state("/services/d4science/RStudio", code_verifier="v")
+    cookie = create_signed_value(SECRET, auth.state_cookie_name, state).decode()
+    token_for_code = mock.AsyncMock(return_value="user-token")
+    monkeypatch.setattr(auth, "_token_for_code", token_for_code)
+    try:
+        resp = await AsyncHTTPClient().fetch(
+            f"http://127.0.0.1:{port}/services/d4science/oauth_callback"
+            f"?code=c&state={state}",
+            headers={"Cookie": f"{auth.state_cookie_name}={cookie}"},
+            follow_redirects=False,
+            raise_error=False,
+        )
+        assert resp.code == 302
+        assert resp.headers["Location"] == "/services/d4science/RStudio"
+        token_for_code.assert_awaited_once_with("c", "v")
+    finally:
+        service.stop()
+        hub.stop()
+
+
+class HubServersHandler(RequestHandler):
+    servers = {}
+    started = []
+
+    def get(self, name):
+        self.write({"kind": "user", "name": name, "servers": self.servers})
+
+
+class HubServerHandler(RequestHandler):
+    def post(self, name, server_name):
+        HubServersHandler.started.append((server_name, json.loads(self.request.body)))
+        self.set_status(202)
+
+
+class HubProgressHandler(RequestHandler):
+    async def get(self, name, server_name):
+        self.set_header("Content-Type", "text/event-stream")
+        for event in (
+            {"progress": 50, "message": "Pulling <image>"},
+            {"progress": 100, "ready": True, "message": "Ready", "url": "/user/x/"},
+        ):
+            self.write(f"data: {json.dumps(event)}\n\n")
+            await self.flush()
+            # keepalive
+            self.write("\n\n")
+            await self.flush()
+
+
+@pytest.mark.asyncio
+async def test_direct_spawn(hub_auth, monkeypatch):
+    hub, hub_port = listen(
+        Application(
+            [
+                ("/hub/api/user", HubUserHandler),
+                ("/hub/api/users/([^/]+)", HubServersHandler),
+                ("/hub/api/users/([^/]+)/servers/([^/]*)", HubServerHandler),
+                ("/hub/api/users/([^/]+)/servers/([^/]*)/progress", HubProgressHandler),
+            ]
+        )
+    )
+    monkeypatch.setenv("JUPYTERHUB_API_URL", f"http://127.0.0.1:{hub_port}/hub/api")
+    monkeypatch.setenv("JUPYTERHUB_API_TOKEN", "service-token")
+    monkeypatch.setenv("JUPYTERHUB_CLIENT_ID", "service-d4science")
+    monkeypatch.setenv("JUPYTERHUB_SERVICE_PREFIX", "/services/d4science")
+    service, port = listen(d4science_spawn.make_app(SECRET, direct_spawn=True))
+    cookie_name = d4science_spawn.SharedStateHubOAuth.instance().cookie_name
+    cookie = create_signed_value(SECRET, cookie_name, "user-token").decode()
+    client = AsyncHTTPClient()
+    url = f"http://127.0.0.1:{port}/services/d4science/RStudio"
+    headers = {"Cookie": f"{cookie_name}={cookie}"}
+    try:
+        HubServersHandler.servers = {}
+        HubServersHandler.started = []
+        # a GET does not start the server, returns a page posting the form
+        resp = await client.fetch(url + "?profile=big", headers=headers)
+        page = resp.body.decode()
+        assert '<form id="start" method="post">' in page
+        assert '<input type="hidden" name="profile" value="big">' in page
+        assert resp.headers["Content-Security-Policy"] == "frame-ancestors 'none'"
+        assert HubServersHandler.started == []
+        xsrf = re.search(r'name="_xsrf" value="([^"]+)"', page).group(1)
+        xsrf_cookie = resp.headers["Set-Cookie"].split(";")[0]
+        headers["Cookie"] += "; " + xsrf_cookie
+
+        # without the XSRF token
+        resp = await client.fetch(
+            url, method="POST", body="profile=big", headers=headers, raise_error=False
+        )
+        assert resp.code == 403
+        assert HubServersHandler.started == []
+
+        resp = await client.fetch(
+            url,
+            method="POST",
+            body="profile=big",
+            headers=dict(headers, Accept="text/event-stream", **{"X-XSRFToken": xsrf}),
+        )
+        assert resp.headers["Content-Type"] == "text/event-stream"
+        events = [
+            json.loads(line[5:])
+            for line in resp.body.decode().splitlines()
+            if line.startswith("data:")
+        ]
+        assert [e["progress"] for e in events] == [50, 100]
+        assert HubServersHandler.started == [("rname-RStudio", {"profile": "big"})]
+
+        # from a browser, with the default profile
+        resp = await client.fetch(
+            url, method="POST", body=f"_xsrf={xsrf}", headers=headers
+        )
+        assert "<li>Pulling &lt;image&gt;</li>" in resp.body.decode()
+        assert 'window.location = "/user/x/"' in resp.body.decode()
+        assert HubServersHandler.started[-1] == ("rname-RStudio", {})
+
+        # pending spawn, only follows the progress
+        HubServersHandler.servers = {"rname-RStudio": {"pending": "spawn"}}
+        resp = await client.fetch(
+            url, method="POST", body=f"_xsrf={xsrf}", headers=headers
+        )
+        assert resp.code == 200
+        assert len(HubServersHandler.started) == 2
+
+        # running server
+        HubServersHandler.servers = {
+            "rname-RStudio": {"ready": True, "url": "/user/alice/rname-RStudio/"}
+        }
+        resp = await client.fetch(
+            url, headers=headers, follow_redirects=False, raise_error=False
+        )
+        assert resp.code == 302
+        assert resp.headers["Location"] == "/user/alice/rname-RStudio/"
+        assert len(HubServersHandler.started) == 2
+    finally:
+        service.stop()
+        hub.stop()
@@ -1,8 +1,11 @@
 """Tests for the spawner"""
 
+import asyncio
+import os
 from unittest import mock
 
 import pytest
+from d4science_hub import admission, rightsizing, scheduler, token_rotation
 from d4science_hub.spawner import D4ScienceSpawner
 
 
@@ -82,3 +85,371 @@ async def test_get_args():
                 "--ServerApp.default_url=/rstudio",
             ]
         ).issubset(args)
+
+
+@pytest.mark.asyncio
+async def test_profile_list_memo():
+    auth_state = {
+        "d4science_version": 2,
+        "allowed_profiles": ["small", "big"],
+        "roles": [],
+        "server_options": [
+            ["ServerOption", "small", "Small", "", "img", "2", "8", "GB"],
+            ["ServerOption", "big", "Big", "", "img", "8", "32", "GB"],
+        ],
+    }
+    spawner = D4ScienceSpawner(_mock=True, extra_profiles=[])
+    stats = D4ScienceSpawner.profiles_cache_stats
+    stats.clear()
+    await spawner.auth_state_hook(spawner, auth_state)
+    profiles = spawner.profile_list(spawner)
+    assert [p["slug"] for p in profiles] == ["big", "small"]
+    assert profiles[1]["kubespawner_override"] == {
+        "image": "img",
+        "cpu_limit": 2.0,
+        "cpu_guarantee": 1,
+        "mem_limit": "8GB",
+    }
+    assert spawner.profile_list(spawner) == profiles
+    assert stats == {"miss": 1, "hit": 1}
+
+    # same inputs in another spawner are shared
+    other = D4ScienceSpawner(_mock=True, extra_profiles=[])
+    await other.auth_state_hook(other, auth_state)
+    assert other.profile_list(other) == profiles
+    assert stats == {"miss": 1, "hit": 2}
+
+    # changes in the inputs invalidate the memo
+    auth_state["allowed_profiles"] = ["small"]
+    await spawner.auth_state_hook(spawner, auth_state)
+    assert [p["slug"] for p in spawner.profile_list(spawner)] == ["small"]
+    spawner.image_repo_override = "myrepo"
+    profiles = spawner.profile_list(spawner)
+    assert profiles[0]["kubespawner_override"]["image"] == "myrepo/img"
+    assert stats == {"miss": 3, "hit": 2}
+
+
+@pytest.mark.asyncio
+async def test_warm_start():
+    spawner = D4ScienceSpawner(_mock=True, extra_profiles=[])
+    spawner.environment = {"D4SCIENCE_CONTEXT": "/gcube/vre"}
+    manifest = {
+        "metadata": {"name": spawner.pod_name, "labels": {}, "annotations": {}},
+        "spec": {
+            "containers": [
+                {
+                    "name": "notebook",
+                    "command": ["jupyterhub-singleuser"],
+                    "env": [{"name": "JUPYTERHUB_API_TOKEN", "value": "secret"}],
+                    "ports": [{"name": "notebook-port", "containerPort": 8888}],
+                }
+            ]
+        },
+    }
+    warm = {
+        "metadata": {"name": "d4science-warm-0", "uid": "uid"},
+        "status": {"podIP": "10.0.0.1"},
+        "spec": manifest["spec"],
+    }
+    pool = mock.MagicMock(namespace=spawner.namespace)
+    pool.claim.return_value = warm
+    pool.handoff = mock.AsyncMock()
+    spawner._warm_pool = pool
+    with mock.patch.multiple(
+        spawner,
+        _start_watching_pods=mock.AsyncMock(),
+        get_pod_manifest=mock.AsyncMock(return_value=manifest),
+    ):
+        assert await spawner._start() == "http://10.0.0.1:8888"
+    assert spawner.pod_name == "d4science-warm-0"
+    pool.register.assert_called_once_with(("/gcube/vre", ""), mock.ANY)
+    pool.handoff.assert_awaited_once_with(
+        warm, {"notebook": {"JUPYTERHUB_API_TOKEN": "secret"}}, {}, {}
+    )
+
+    # failed hand-off, the pod is deleted and a new one started
+    pool.handoff.side_effect = Exception("unreachable")
+    pool.delete = mock.AsyncMock()
+    with mock.patch.multiple(
+        spawner,
+        _start_watching_pods=mock.AsyncMock(),
+        get_pod_manifest=mock.AsyncMock(return_value=manifest),
+    ), mock.patch(
+        "kubespawner.KubeSpawner._start", return_value="http://cold:8888"
+    ) as cold_start:
+        assert await spawner._start() == "http://cold:8888"
+    pool.delete.assert_awaited_once_with("d4science-warm-0")
+    cold_start.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_shared_structures():
+    auth_state = {
+        "d4science_version": 2,
+        "allowed_profiles": ["small"],
+        "roles": [],
+        "server_options": [
+            ["ServerOption", "small", "Small", "", "img", "2", "8", "G"],
+        ],
+        "volume_options": [["Data", "Read-Only"]],
+    }
+    mappings = {
+        "Data": {
+            "mount_path": "/data",
+            "volume": {"persistentVolumeClaim": {"claimName": "data"}},
+        }
+    }
+    spawners = [
+        D4ScienceSpawner(_mock=True, volume_mappings=mappings, extra_profiles=[])
+        for _ in range(2)
+    ]
+    for spawner in spawners:
+        await spawner.auth_state_hook(spawner, auth_state)
+    first, second = spawners
+    assert first.volume_mappings is second.volume_mappings
+    assert first.volumes == [
+        {"name": "data", "persistentVolumeClaim": {"claimName": "data"}}
+    ]
+    assert first.volumes[-1] is second.volumes[-1]
+    assert first.volume_mounts[-1] is second.volume_mounts[-1]
+    assert first.volume_mounts[-1]["readOnly"]
+    # the lists can still be changed by hooks
+    first.volumes.append({"name": "extra"})
+    assert len(second.volumes) == 1
+    profile = first.profile_list(first)[0]
+    assert profile is second.profile_list(second)[0]
+
+    # KubeSpawner gets its own copy of the profile
+    await first.load_user_options()
+    assert first.cpu_limit == 2.0
+    assert first.mem_limit == 8 * 1024**3
+
+
+@pytest.mark.asyncio
+async def test_storage_daemon():
+    spawner = D4ScienceSpawner(
+        _mock=True,
+        extra_profiles=[],
+        use_storage_daemon=True,
+        volumes=[{"name": "workspace", "emptyDir": {}}],
+        volume_mounts=[{"name": "workspace", "mountPath": "/workspace"}],
+    )
+    spawner.environment = {"D4SCIENCE_TOKEN": "token"}
+    await spawner.pre_spawn_hook(spawner)
+    keys = []
+    # every start gets a new mount
+    for _ in range(2):
+        await spawner.pre_spawn_hook(spawner)
+        assert spawner.extra_containers == []
+        hooks = spawner.lifecycle_hooks
+        socket_path, op = hooks["postStart"]["exec"]["command"][-2:]
+        assert (socket_path, op) == ("/run/d4science-storage/daemon.sock", "mount")
+        assert hooks["preStop"]["exec"]["command"][-2:] == [socket_path, "umount"]
+        workspace, socket = spawner.volumes
+        key = os.path.basename(workspace["hostPath"]["path"])
+        assert key.startswith(spawner.pod_name)
+        # the pod only gets the socket directory of its key
+        assert socket["hostPath"]["path"] == "/run/d4science-storage/sockets/" + key
+        assert spawner.volume_mounts == [
+            {
+                "name": "workspace",
+                "mountPath": "/workspace",
+                "mountPropagation": "HostToContainer",
+            },
+            {"name": "storage-daemon", "mountPath": "/run/d4science-storage"},
+        ]
+        keys.append(key)
+    assert keys[0] != keys[1]
+
+
+@pytest.mark.asyncio
+async def test_rightsizing(monkeypatch):
+    auth_state = {
+        "d4science_version": 2,
+        "context": "%2Fgcube%2Fvre",
+        "allowed_profiles": ["small"],
+        "roles": [],
+        "server_options": [
+            ["ServerOption", "small", "Small", "", "img", "2", "8", "G"],
+        ],
+    }
+    source = mock.MagicMock(
+        usage=mock.AsyncMock(
+            return_value={
+                ("/gcube/vre", "small"): {"cpu": [0.5] * 10, "memory": [2**30] * 10}
+            }
+        )
+    )
+    sizer = rightsizing.RightSizer(source, memory_headroom=1)
+    monkeypatch.setattr(D4ScienceSpawner, "_right_sizer", sizer)
+    spawner = D4ScienceSpawner(_mock=True, extra_profiles=[])
+    await spawner.auth_state_hook(spawner, auth_state)
+    assert "cpu_guarantee" in spawner.profile_list(spawner)[0]["kubespawner_override"]
+    assert (
+        "mem_guarantee" not in spawner.profile_list(spawner)[0]["kubespawner_override"]
+    )
+
+    # new guarantees are applied to the profiles
+    await sizer.refresh()
+    override = spawner.profile_list(spawner)[0]["kubespawner_override"]
+    assert override["cpu_guarantee"] == 0.5
+    assert override["mem_guarantee"] == "1024M"
+    assert override["mem_limit"] == "8G"
+
+    # only the catalogs of the authenticator are reported
+    assert spawner.get_rightsizing_report()["options"] == []
+    spawner.authenticator = mock.MagicMock(
+        catalog_cache={"%2Fgcube%2Fvre": spawner.resource_catalog}
+    )
+    report = spawner.get_rightsizing_report()
+    assert report["nodes"] == {"current": 3, "proposed": 1}
+
+    # only reported in dry run
+    spawner.rightsizing_dry_run = True
+    override = spawner.profile_list(spawner)[0]["kubespawner_override"]
+    assert override["cpu_guarantee"] == 1
+    assert "mem_guarantee" not in override
+
+    # pods are annotated with their AuthId for the usage queries
+    spawner.user_options = {"profile": "small"}
+    await spawner.pre_spawn_hook(spawner)
+    assert spawner.extra_annotations["d4science_profile"] == "small"
+
+
+@pytest.mark.asyncio
+async def test_gpu_admission(monkeypatch):
+    gpus = admission.GpuAdmission(None, {})
+    gpus.capacity = 1
+    monkeypatch.setattr(D4ScienceSpawner, "_gpu_admission", gpus)
+    holder = gpus.enqueue("/gcube/other", 1, "other")
+    spawner = D4ScienceSpawner(_mock=True)
+    spawner.environment = {"D4SCIENCE_CONTEXT": "/gcube/vre"}
+    spawner.extra_resource_limits = {"nvidia.com/gpu": 1}
+
+    # waits for the GPU with its position in the progress
+    messages = []
+
+    async def progress():
+        async for event in spawner._queue_progress():
+            messages.append(event["message"])
+
+    spawner._start_future = asyncio.ensure_future(spawner._admit_gpus())
+    progress_future = asyncio.ensure_future(progress())
+    await asyncio.sleep(0.1)
+    assert messages == ["Waiting for a GPU, next in the queue"]
+    assert not spawner._start_future.done()
+    gpus.release(holder)
+    await spawner._start_future
+    await progress_future
+    spawner._release_gpus(created=True)
+    assert gpus._created == {spawner.pod_name: 1}
+
+    # without GPUs the GPU profiles are unavailable
+    gpus.capacity = 0
+    auth_state = {
+        "d4science_version": 2,
+        "allowed_profiles": ["small", "gpu"],
+        "roles": [],
+        "server_options": [
+            ["ServerOption", "small", "Small", "", "img", "2", "8", "G", True],
+            ["ServerOption", "gpu", "GPU", "", "img", None, None, None, True, "", True],
+        ],
+    }
+    await spawner.auth_state_hook(spawner, auth_state)
+    profiles = {p["slug"]: p for p in spawner.profile_list(spawner)}
+    assert profiles["gpu"]["display_name"] == "GPU (unavailable: no GPUs)"
+    assert not profiles["gpu"]["default"]
+    assert profiles["small"]["display_name"] == "Small - 2 Cores / 8G RAM"
+    with pytest.raises(RuntimeError):
+        await spawner._admit_gpus()
+
+
+@pytest.mark.asyncio
+async def test_spawn_scheduler(monkeypatch):
+    spawns = scheduler.SpawnScheduler(max_per_context=1)
+    monkeypatch.setattr(D4ScienceSpawner, "_spawn_scheduler", spawns)
+    holder = spawns.enqueue("/gcube/vre")
+    spawner = D4ScienceSpawner(_mock=True)
+    spawner.environment = {"D4SCIENCE_CONTEXT": "/gcube/vre"}
+
+    messages = []
+
+    async def progress():
+        async for event in spawner._queue_progress():
+            messages.append(event["message"])
+
+    async def start():
+        await spawner._acquire_spawn_slot()
+        await spawner._admit_gpus()
+
+    spawner._start_future = asyncio.ensure_future(start())
+    progress_future = asyncio.ensure_future(progress())
+    await asyncio.sleep(0.1)
+    assert messages == ["Waiting to start, 0 spawns of the VRE ahead (1 waiting)"]
+    spawns.release(holder)
+    await spawner._start_future
+    await progress_future
+    assert spawns.active == 1
+
+    # the slot is free once the pod is created
+    with mock.patch(
+        "kubespawner.KubeSpawner._make_create_pod_request", return_value=True
+    ):
+        assert await spawner._make_create_pod_request(None, 10)
+    assert spawns.active == 0
+    assert spawner._spawn_ticket is None
+
+
+@pytest.mark.asyncio
+async def test_token_rotation(monkeypatch):
+    rotator = token_rotation.TokenRotator(mock.AsyncMock())
+    monkeypatch.setattr(D4ScienceSpawner, "_token_rotator", rotator)
+    spawner = D4ScienceSpawner(_mock=True, extra_profiles=[])
+    spawner.environment = {"D4SCIENCE_TOKEN": "token"}
+    for _ in range(2):
+        await spawner.pre_spawn_hook(spawner)
+    name = f"{spawner.pod_name}-d4science-token"
+    path = "/var/run/secrets/d4science.org"
+    assert spawner.environment["D4SCIENCE_TOKEN_FILE"] == path + "/token"
+    mount = {"name": "d4science-token", "mountPath": path, "readOnly": True}
+    assert spawner.volumes[-1] == {
+        "name": "d4science-token",
+        "secret": {"secretName": name},
+    }
+    assert spawner.volume_mounts.count(mount) == 1
+    [sidecar] = spawner.extra_containers
+    assert sidecar["volumeMounts"][-1] == mount
+    assert sidecar["env"][-1]["value"] == path + "/token"
+
+    # the secret is written before the pod, and owned by it
+    pod = mock.MagicMock()
+    pod.metadata.name = spawner.pod_name
+    pod.metadata.uid = "uid"
+    with mock.patch(
+        "kubespawner.KubeSpawner._make_create_pod_request", return_value=True
+    ), mock.patch.object(spawner, "api") as api:
+        api.read_namespaced_pod = mock.AsyncMock(return_value=pod)
+        assert await spawner._make_create_pod_request(None, 10)
+    rotator.api.create_namespaced_secret.assert_called_once()
+    assert (spawner.namespace, name) in rotator
+    owner = rotator.api.patch_namespaced_secret.call_args[0][2]["metadata"]
+    assert owner["ownerReferences"] == [
+        {"apiVersion": "v1", "kind": "Pod", "name": spawner.pod_name, "uid": "uid"}
+    ]
+
+    # registered again after a restart of the hub
+    state = spawner.get_state()
+    assert state["token_secret"] == name
+    rotator.remove(spawner.namespace, name)
+    restored = D4ScienceSpawner(_mock=True)
+    restored.load_state(state)
+    assert (spawner.namespace, name) in rotator
+
+    with mock.patch("kubespawner.KubeSpawner.stop"):
+        await restored.stop()
+    rotator.api.delete_namespaced_secret.assert_called_once_with(
+        name, spawner.namespace
+    )
+    assert (spawner.namespace, name) not in rotator
+    restored.clear_state()
+    assert "token_secret" not in restored.get_state()
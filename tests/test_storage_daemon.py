@@ -0,0 +1,122 @@
+"""Tests for the storage daemon"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+from d4science_hub import storage_daemon
+
+# stands for the FUSE mount, runs until killed
+MOUNT = (
+    "import os, time; "
+    "open(os.path.join(os.environ['MNTPATH'], 'token'), 'w')"
+    ".write(os.environ['D4SCIENCE_TOKEN']); "
+    "time.sleep(60)"
+)
+
+
+async def client(socket_path, op, token="secret"):
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-c",
+        storage_daemon.CLIENT,
+        socket_path,
+        op,
+        env=dict(os.environ, D4SCIENCE_TOKEN=token),
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    return proc.returncode, stderr.decode()
+
+
+@pytest.mark.asyncio
+async def test_mount(tmp_path, monkeypatch):
+    mounts = tmp_path / "mounts"
+    sockets = tmp_path / "sockets"
+    # mounted once the mount command wrote the token
+    monkeypatch.setattr(
+        storage_daemon.os.path,
+        "ismount",
+        lambda path: os.path.exists(os.path.join(path, "token")),
+    )
+    daemon = storage_daemon.StorageDaemon(
+        str(mounts),
+        [sys.executable, "-c", MOUNT],
+        umount_command=["true"],
+        mount_timeout=10,
+    )
+    # directories of the pods, as created by the kubelet
+    for key in ("pod-1", "pod-2", "Not_A_Key"):
+        (sockets / key).mkdir(parents=True)
+    await daemon.scan(str(sockets))
+    assert sorted(daemon.servers) == ["pod-1", "pod-2"]
+    socket_1 = str(sockets / "pod-1" / "daemon.sock")
+    socket_2 = str(sockets / "pod-2" / "daemon.sock")
+    try:
+        assert await client(socket_1, "mount") == (0, "")
+        assert (mounts / "pod-1" / "token").read_text() == "secret"
+        proc = daemon.mounts["pod-1"]
+        # mounted only once
+        assert await client(socket_1, "mount") == (0, "")
+        assert daemon.mounts["pod-1"] is proc
+
+        # every pod can only unmount its own workspace
+        assert await client(socket_2, "umount") == (0, "")
+        assert daemon.mounts["pod-1"] is proc
+        assert not (sockets / "pod-2").exists()
+
+        assert await client(socket_1, "umount") == (0, "")
+        assert proc.returncode is not None
+        assert not (mounts / "pod-1").exists()
+        assert not (sockets / "pod-1").exists()
+        assert daemon.mounts == {} and daemon.servers == {}
+    finally:
+        for key in list(daemon.servers):
+            await daemon.close(key)
+        for proc in daemon.mounts.values():
+            proc.kill()
+
+
+@pytest.mark.asyncio
+async def test_recover(tmp_path, monkeypatch):
+    mounts = tmp_path / "mounts"
+    (mounts / "pod-1").mkdir(parents=True)
+    proc_mounts = tmp_path / "proc-mounts"
+    proc_mounts.write_text(
+        "proc /proc proc rw 0 0\n"
+        f"d4science {mounts}/pod-1 fuse rw 0 0\n"
+        f"d4science {mounts}/pod-1/nested fuse rw 0 0\n"
+    )
+    mounted = {str(mounts / "pod-1")}
+    monkeypatch.setattr(storage_daemon.os.path, "ismount", mounted.__contains__)
+    umounted = tmp_path / "umounted"
+    daemon = storage_daemon.StorageDaemon(
+        str(mounts),
+        ["false"],
+        umount_command=["sh", "-c", f'echo "$0" > {umounted}'],
+    )
+    daemon.recover(str(proc_mounts))
+    assert daemon.mounts == {"pod-1": None}
+    # already mounted, not mounted again
+    await daemon.mount("pod-1", "secret")
+    await daemon.umount("pod-1")
+    assert umounted.read_text().strip() == str(mounts / "pod-1")
+    assert not (mounts / "pod-1").exists()
+
+    # unknown keys are unmounted too
+    (mounts / "pod-2").mkdir()
+    mounted.add(str(mounts / "pod-2"))
+    await daemon.umount("pod-2")
+    assert umounted.read_text().strip() == str(mounts / "pod-2")
+
+
+@pytest.mark.asyncio
+async def test_mount_failure(tmp_path):
+    daemon = storage_daemon.StorageDaemon(
+        str(tmp_path), ["false"], umount_command=["true"]
+    )
+    with pytest.raises(RuntimeError):
+        await daemon.mount("pod-1", "secret")
+    assert daemon.mounts == {}
@@ -0,0 +1,114 @@
+"""Tests for the rotation of the context tokens"""
+
+import time
+
+import jwt
+import pytest
+from d4science_hub import token_rotation
+from kubernetes_asyncio.client.rest import ApiException
+
+
+def make_token(expires_in):
+    exp = int(time.time() + expires_in)
+    return jwt.encode({"exp": exp}, "s" * 32, algorithm="HS256")
+
+
+class FakeCoreApi:
+    def __init__(self):
+        self.secrets = {}
+        self.patches = 0
+
+    async def create_namespaced_secret(self, namespace, body):
+        key = (namespace, body["metadata"]["name"])
+        if key in self.secrets:
+            raise ApiException(status=409)
+        self.secrets[key] = body
+
+    async def patch_namespaced_secret(self, name, namespace, body):
+        if (namespace, name) not in self.secrets:
+            raise ApiException(status=404)
+        self.patches += 1
+        self.secrets[(namespace, name)]["stringData"].update(body["stringData"])
+
+    async def delete_namespaced_secret(self, name, namespace):
+        if self.secrets.pop((namespace, name), None) is None:
+            raise ApiException(status=404)
+
+    def token(self, namespace, name):
+        return self.secrets[(namespace, name)]["stringData"]["token"]
+
+
+class Fetcher:
+    def __init__(self, token):
+        self.token = token
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        return self.token
+
+
+@pytest.mark.asyncio
+async def test_write_and_delete():
+    api = FakeCoreApi()
+    rotator = token_rotation.TokenRotator(api)
+    await rotator.write("ns", "pod-token", "a", {"app": "jupyterhub"})
+    assert api.token("ns", "pod-token") == "a"
+    assert api.secrets[("ns", "pod-token")]["metadata"]["labels"] == {
+        "app": "jupyterhub"
+    }
+    # left by a previous start
+    await rotator.write("ns", "pod-token", "b")
+    assert api.token("ns", "pod-token") == "b"
+
+    rotator.add("ns", "pod-token", Fetcher("c"), "b")
+    await rotator.delete("ns", "pod-token")
+    assert ("ns", "pod-token") not in rotator
+    assert not api.secrets
+    # already gone
+    await rotator.delete("ns", "pod-token")
+
+
+@pytest.mark.asyncio
+async def test_rotation():
+    api = FakeCoreApi()
+    rotator = token_rotation.TokenRotator(api, ahead=600)
+    fresh = make_token(3600)
+    for name, expires_in in (("expiring", 300), ("fresh", 3600)):
+        token = make_token(expires_in)
+        await rotator.write("ns", name, token)
+        rotator.add("ns", name, Fetcher(fresh), token)
+    assert rotator.due() == [("ns", "expiring")]
+    await rotator.refresh()
+    assert api.token("ns", "expiring") == fresh
+    assert rotator.due() == []
+
+    # unknown token (e.g. after a restart), the fetched one is written
+    fetch = Fetcher(fresh)
+    rotator.add("ns", "fresh", fetch)
+    await rotator.refresh()
+    assert fetch.calls == 1 and api.patches == 2
+    await rotator.refresh()
+    assert fetch.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_rotation():
+    api = FakeCoreApi()
+    rotator = token_rotation.TokenRotator(api, ahead=600)
+    stale = make_token(60)
+    await rotator.write("ns", "pod-token", stale)
+    # no new token yet
+    fetch = Fetcher(stale)
+    rotator.add("ns", "pod-token", fetch, stale)
+    await rotator.refresh()
+    assert api.patches == 0
+    fetch.token = None
+    await rotator.refresh()
+    assert api.patches == 0
+    # the secret is gone, tried again in the next round
+    fetch.token = make_token(3600)
+    del api.secrets[("ns", "pod-token")]
+    await rotator.refresh()
+    assert rotator.due() == [("ns", "pod-token")]
+    assert fetch.calls == 3
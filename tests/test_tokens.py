@@ -0,0 +1,63 @@
+"""Tests for the UMA token cache"""
+
+import asyncio
+import time
+
+import jwt
+import pytest
+from d4science_hub.tokens import TokenCache, token_expiry
+
+
+def make_token(expires_in):
+    exp = int(time.time() + expires_in)
+    return jwt.encode({"exp": exp}, "s" * 32, algorithm="HS256"), {"exp": exp}
+
+
+def test_expiry_with_skew():
+    cache = TokenCache(skew=60)
+    cache.put(("user", "ctx", "aud"), *make_token(3600))
+    cache.put(("user", "ctx", "other"), *make_token(30))
+    assert ("user", "ctx", "aud") in cache
+    # expires within the skew
+    assert ("user", "ctx", "other") not in cache
+    assert len(cache) == 1
+
+
+def test_put_without_decoded():
+    token, decoded = make_token(3600)
+    assert token_expiry(token) == decoded["exp"]
+    assert token_expiry("not-a-token") == 0
+    cache = TokenCache()
+    cache.put("key", token)
+    assert cache.get("key") == (token, decoded)
+
+
+def test_max_size_and_invalidate():
+    cache = TokenCache(max_size=2)
+    for key in [("a", "c", "1"), ("a", "c", "2"), ("b", "c", "1")]:
+        cache.put(key, *make_token(3600))
+    assert len(cache) == 2
+    assert ("a", "c", "1") not in cache
+    cache.invalidate("a")
+    assert len(cache) == 1
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_fetch_coalesced():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return make_token(3600)
+
+    cache = TokenCache()
+    results = await asyncio.gather(*[cache.fetch("key", fetch) for _ in range(5)])
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+    assert await cache.fetch("key", fetch) == results[0]
+    assert len(calls) == 1
+    await cache.fetch("key", fetch, force=True)
+    assert len(calls) == 2
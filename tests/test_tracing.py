@@ -0,0 +1,76 @@
+"""Tests for the tracing of logins and spawns"""
+
+import asyncio
+import json
+import os
+
+import pytest
+from d4science_hub import tracing
+from d4science_hub.pipeline import Pipeline
+from traitlets.config import Config
+
+
+@pytest.fixture
+def tracer(tmp_path):
+    config = Config()
+    config.D4ScienceTracer.path = str(tmp_path / "traces.jsonl")
+    config.D4ScienceTracer.sample_rate = 1
+    tracing.D4ScienceTracer.clear_instance()
+    yield tracing.setup(config)
+    tracing.D4ScienceTracer.clear_instance()
+
+
+async def read_spans(tracer):
+    # written off the event loop
+    await tracer.flush()
+    with open(tracer.path) as f:
+        return [json.loads(line) for line in f]
+
+
+@tracing.traced("login")
+async def login():
+    tracing.annotate(user="foo")
+    pipeline = Pipeline("test")
+    pipeline.add("step", lambda: asyncio.sleep(0))
+    await pipeline.run()
+    with tracing.span("upstream"):
+        tracing.annotate(response_bytes=10)
+
+
+def test_disabled():
+    tracing.D4ScienceTracer.clear_instance()
+    assert tracing.span("foo") is tracing.NOOP_SPAN
+    tracing.setup()
+    assert tracing.span("foo") is tracing.NOOP_SPAN
+    tracing.D4ScienceTracer.clear_instance()
+
+
+@pytest.mark.asyncio
+async def test_nested_spans(tracer):
+    await login()
+    assert not os.path.exists(tracer.path)
+    spans = {span["name"]: span for span in await read_spans(tracer)}
+    assert set(spans) == {"login", "step", "upstream"}
+    root = spans["login"]
+    assert root["parent_id"] is None
+    assert root["attributes"] == {"user": "foo"}
+    assert spans["step"]["parent_id"] == root["span_id"]
+    assert spans["upstream"]["attributes"] == {"response_bytes": 10}
+    assert len({span["trace_id"] for span in spans.values()}) == 1
+
+
+@pytest.mark.asyncio
+async def test_errors_and_otlp(tracer):
+    tracer.format = "otlp"
+
+    @tracing.traced("failing")
+    def failing():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        failing()
+    (trace,) = await read_spans(tracer)
+    (span,) = trace["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert span["name"] == "failing"
+    assert span["status"]["code"] == 2
+    assert "parentSpanId" not in span
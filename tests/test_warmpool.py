@@ -0,0 +1,278 @@
+"""Tests for the warm pod pool"""
+
+import asyncio
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+from d4science_hub import warmpool
+from kubernetes_asyncio.client.rest import ApiException
+
+KEY = ("/gcube/vre", "authid")
+
+
+def user_manifest(user="alice", volume="data"):
+    return {
+        "metadata": {
+            "name": f"jupyter-{user}",
+            "labels": {"component": "singleuser-server", "username": user},
+            "annotations": {"d4science_context": "/gcube/vre"},
+        },
+        "spec": {
+            "containers": [
+                {
+                    "name": "notebook",
+                    "image": "img",
+                    "command": ["jupyterhub-singleuser"],
+                    "env": [
+                        {"name": "JUPYTERHUB_USER", "value": user},
+                        {"name": "FROM_SECRET", "valueFrom": {"secretKeyRef": {}}},
+                    ],
+                    "ports": [{"name": "notebook-port", "containerPort": 8888}],
+                },
+                {
+                    "name": "workspace-sidecar",
+                    "image": "sidecar",
+                    "command": ["mount.sh"],
+                    "env": [{"name": "D4SCIENCE_TOKEN", "value": f"{user}-token"}],
+                },
+            ],
+            "volumes": [{"name": volume, "emptyDir": {}}],
+        },
+    }
+
+
+class FakeCoreApi:
+    def __init__(self):
+        self.pods = {}
+        self.api_client = SimpleNamespace(sanitize_for_serialization=lambda o: o)
+
+    async def list_namespaced_pod(self, namespace, label_selector):
+        return {
+            "items": [
+                pod
+                for pod in self.pods.values()
+                if label_selector in pod["metadata"]["labels"]
+            ]
+        }
+
+    async def create_namespaced_pod(self, namespace, body):
+        body["metadata"]["uid"] = body["metadata"]["name"]
+        body["status"] = {
+            "phase": "Running",
+            "podIP": "127.0.0.1",
+            "containerStatuses": [{"ready": True}],
+        }
+        self.pods[body["metadata"]["name"]] = body
+
+    async def patch_namespaced_pod(self, name, namespace, body):
+        metadata = self.pods[name]["metadata"]
+        for field in ("labels", "annotations"):
+            for k, v in body["metadata"][field].items():
+                if v is None:
+                    metadata[field].pop(k, None)
+                else:
+                    metadata[field][k] = v
+
+    async def delete_namespaced_pod(self, name, namespace, grace_period_seconds):
+        if name not in self.pods:
+            raise ApiException(status=404)
+        del self.pods[name]
+
+
+class FakeHTTPClient:
+    def __init__(self):
+        self.requests = []
+
+    async def fetch(self, url, **kwargs):
+        self.requests.append((url, kwargs))
+
+
+def test_pool_size():
+    schedule = {"08:00": 4, "20:00": 1}
+    assert warmpool.pool_size(3) == 3
+    assert warmpool.pool_size({}) == 0
+    assert warmpool.pool_size(schedule, datetime.time(9, 30)) == 4
+    assert warmpool.pool_size(schedule, datetime.time(20, 0)) == 1
+    # wraps around midnight
+    assert warmpool.pool_size(schedule, datetime.time(3, 0)) == 1
+
+
+def test_pod_template():
+    template, envs = warmpool.pod_template(user_manifest(), identity=("alice",))
+    assert envs == {
+        "notebook": {"JUPYTERHUB_USER": "alice"},
+        "workspace-sidecar": {"D4SCIENCE_TOKEN": "alice-token"},
+    }
+    assert template["labels"] == {"component": "singleuser-server"}
+    notebook, sidecar = template["spec"]["containers"]
+    assert notebook["env"] == [
+        {"name": "FROM_SECRET", "valueFrom": {"secretKeyRef": {}}}
+    ]
+    assert "env" not in sidecar
+    # users with the same pod share the template
+    other, _ = warmpool.pod_template(user_manifest("other"), identity=("other",))
+    assert other == template
+
+    # user specific spec
+    manifest = user_manifest(volume="alice-data")
+    assert warmpool.pod_template(manifest, identity=("alice",)) is None
+    # containers using the image entrypoint
+    manifest = user_manifest()
+    del manifest["spec"]["containers"][1]["command"]
+    assert warmpool.pod_template(manifest, identity=("alice",)) is None
+    manifest = user_manifest()
+    notebook = manifest["spec"]["containers"][0]
+    notebook["args"] = notebook.pop("command")
+    assert warmpool.pod_template(manifest, identity=("alice",)) is None
+
+
+@pytest.mark.asyncio
+async def test_replenish_and_claim():
+    api = FakeCoreApi()
+    http_client = FakeHTTPClient()
+    pool = warmpool.WarmPool(
+        api, "jhub", {KEY[0]: {KEY[1]: 2}}, http_client=http_client
+    )
+    template, envs = warmpool.pod_template(user_manifest(), identity=("alice",))
+
+    # nothing to do until there is a template
+    await pool.replenish()
+    assert api.pods == {}
+    assert pool.claim(KEY, template) is None
+
+    pool.register(KEY, template)
+    pool.register(("/gcube/other", "authid"), template)
+    await pool.replenish()
+    assert len(api.pods) == 2
+    pod = next(iter(api.pods.values()))
+    notebook, sidecar = pod["spec"]["containers"]
+    assert notebook["command"][:2] == ["python3", "-c"]
+    assert notebook["args"] == ["8888", warmpool.HANDOFF_DIR, "notebook"] + [
+        "jupyterhub-singleuser"
+    ]
+    assert sidecar["args"] == ["workspace-sidecar", warmpool.HANDOFF_DIR, "mount.sh"]
+
+    await pool.refresh()
+    claimed = pool.claim(KEY, template)
+    assert claimed is not None
+    failed = pool.claim(KEY, template)
+    assert failed["metadata"]["name"] != claimed["metadata"]["name"]
+    assert pool.claim(KEY, template) is None
+    # as after a failed hand-off
+    await pool.delete(failed["metadata"]["name"])
+
+    secret = claimed["metadata"]["annotations"][warmpool.SECRET_ANNOTATION]
+    await pool.handoff(claimed, envs, {"username": "alice"}, {"a": "b"})
+    url, request = http_client.requests[0]
+    assert url == "http://127.0.0.1:8888/"
+    assert json.loads(request["body"]) == envs
+    assert request["headers"]["Authorization"] == f"token {secret}"
+    metadata = api.pods[claimed["metadata"]["name"]]["metadata"]
+    assert metadata["labels"] == {"component": "singleuser-server", "username": "alice"}
+    assert metadata["annotations"] == {"a": "b"}
+
+    # the claimed pods are replaced
+    await pool.replenish()
+    warm = [
+        p for p in api.pods.values() if warmpool.WARM_LABEL in p["metadata"]["labels"]
+    ]
+    assert len(warm) == 2
+    await pool.refresh()
+    assert len(pool.pods) == 2
+
+    # new template: pods of the old one are replaced
+    new_template, _ = warmpool.pod_template(
+        user_manifest(volume="other"), identity=("alice",)
+    )
+    pool.register(KEY, new_template)
+    await pool.replenish()
+    await pool.refresh()
+    assert len(pool.pods) == 2
+    assert pool.claim(KEY, template) is None
+    assert pool.claim(KEY, new_template) is not None
+
+    # the templates are recovered from the pods (e.g. after a restart)
+    pool = warmpool.WarmPool(api, "jhub", {KEY[0]: {KEY[1]: 0}})
+    await pool.replenish()
+    assert pool.templates == {KEY: new_template}
+    assert pool.pods == {}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+
+
+@pytest.mark.asyncio
+async def test_handoff(tmp_path):
+    """Runs the receiver and the waiter of the warm pods and hands them off"""
+    api = FakeCoreApi()
+    pool = warmpool.WarmPool(api, "jhub", {KEY[0]: {KEY[1]: 1}})
+    template, envs = warmpool.pod_template(user_manifest(), identity=("alice",))
+    port = free_port()
+    notebook_container = template["spec"]["containers"][0]
+    notebook_container["ports"][0]["containerPort"] = port
+    pool.register(KEY, template)
+    await pool.replenish()
+    pod = next(iter(api.pods.values()))
+    notebook, sidecar = pod["spec"]["containers"]
+
+    def run(container, out):
+        # run the commands of the warm pod with python and sh from here
+        env = dict(os.environ)
+        env.update(
+            {e["name"]: e["value"] for e in container.get("env", []) if "value" in e}
+        )
+        argv = container["command"] + container["args"]
+        argv = [sys.executable if a == "python3" else a for a in argv]
+        argv = [str(tmp_path) if a == warmpool.HANDOFF_DIR else a for a in argv]
+        # the original commands just dump the environment
+        dump = f"import json, os; json.dump(dict(os.environ), open({out!r}, 'w'))"
+        argv = argv[:-1] + [sys.executable, "-c", dump]
+        return subprocess.Popen(argv, env=env)
+
+    processes = [
+        run(notebook, str(tmp_path / "notebook.json")),
+        run(sidecar, str(tmp_path / "sidecar.json")),
+    ]
+    try:
+        await wait_for_port(port)
+        await pool.refresh()
+        start = time.perf_counter()
+        warm = pool.claim(KEY, template)
+        await pool.handoff(warm, envs, {"username": "alice"}, {})
+        elapsed = time.perf_counter() - start
+        for p in processes:
+            assert await asyncio.to_thread(p.wait, 10) == 0
+    finally:
+        for p in processes:
+            p.kill()
+    # the hand-off only waits for the receiver to get the environment
+    assert elapsed < 1
+    notebook_env = json.load(open(tmp_path / "notebook.json"))
+    assert notebook_env["JUPYTERHUB_USER"] == "alice"
+    assert warmpool.SECRET_ENV not in notebook_env
+    sidecar_env = json.load(open(tmp_path / "sidecar.json"))
+    assert sidecar_env["D4SCIENCE_TOKEN"] == "alice-token"